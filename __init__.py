@@ -1 +1,9 @@
-from . import fragmentdb
\ No newline at end of file
+try:
+  import olexFunctions
+except ImportError:
+  # outside of Olex2, only the modules that are independent of olex can be used,
+  # e.g. by validate.py or schema.py:
+  olexFunctions = None
+
+if olexFunctions is not None:
+  from . import fragmentdb
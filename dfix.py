@@ -0,0 +1,133 @@
+'''
+Created on 18.10.2026
+
+Distance restraints from the geometry of a fragment. The bonds are found
+from the covalent radii, then the 1,2 distances become DFIX, the 1,3
+distances DANG and the planar rings FLAT restraints. With numpy, the
+distances are calculated in one array operation.
+
+here are only functions that are completely independent of olex
+'''
+from __future__ import print_function
+
+import math
+from collections import deque
+
+from FragmentDB.graph import BOND_TOLERANCE, FLAT_TOLERANCE, bond_graph, neighbours, plane_deviation
+
+try:
+  import numpy as np
+except ImportError:
+  np = None
+
+__metaclass__ = type  # use new-style classes
+
+# Largest ring that gets a FLAT restraint:
+RING_MAX_SIZE = 8
+
+
+def angle_pairs(size, bonds):
+  """
+  returns the sorted pairs of atoms that are bonded to the same atom, but
+  not to each other.
+
+  >>> angle_pairs(4, [(0, 1), (1, 2), (2, 3)])
+  [(0, 2), (1, 3)]
+  """
+  adjacency = neighbours(size, bonds)
+  pairs = set()
+  for center in range(size):
+    bonded = sorted(adjacency[center])
+    for num, i in enumerate(bonded):
+      for j in bonded[num + 1:]:
+        if j not in adjacency[i]:
+          pairs.add((i, j))
+  return sorted(pairs)
+
+
+def find_rings(size, bonds, max_size=RING_MAX_SIZE):
+  """
+  returns the smallest ring through every bond as list of atoms in ring
+  order. Rings with more than max_size atoms are ignored.
+
+  >>> find_rings(7, [(0, 1), (1, 2), (2, 3), (3, 4), (4, 5), (0, 5), (5, 6)])
+  [[0, 1, 2, 3, 4, 5]]
+  """
+  adjacency = neighbours(size, bonds)
+  rings = {}
+  for i, j in bonds:
+    # the shortest way back from j to i without the bond itself:
+    previous = {j: None}
+    depth = {j: 1}
+    queue = deque([j])
+    while queue and i not in previous:
+      atom = queue.popleft()
+      if depth[atom] >= max_size:
+        continue
+      for other in adjacency[atom]:
+        if other not in previous and not (atom == j and other == i):
+          previous[other] = atom
+          depth[other] = depth[atom] + 1
+          queue.append(other)
+    if i not in previous:
+      continue
+    ring = []
+    atom = i
+    while atom is not None:
+      ring.append(atom)
+      atom = previous[atom]
+    start = ring.index(min(ring))
+    ring = ring[start:] + ring[:start]
+    if ring[-1] < ring[1]:
+      ring = ring[:1] + ring[:0:-1]
+    rings[tuple(ring)] = ring
+  return [rings[key] for key in sorted(rings)]
+
+
+def _distances(xyz, pairs):
+  if np is not None:
+    xyz = np.asarray(xyz, dtype=float).reshape(-1, 3)
+    first = [i for i, _ in pairs]
+    second = [j for _, j in pairs]
+    return np.sqrt(((xyz[first] - xyz[second]) ** 2).sum(axis=1)).tolist()
+  return [math.sqrt(sum((xyz[i][k] - xyz[j][k]) ** 2 for k in range(3))) for i, j in pairs]
+
+
+def generate_restraints(names, numbers, coordinates, tolerance=BOND_TOLERANCE):
+  """
+  returns DFIX restraints for all bonds, DANG restraints for all 1,3
+  distances and FLAT restraints for the planar rings of a fragment as
+  (ShelxName, Atoms) rows like in the database. A planar ring is
+  restrained together with the atoms bonded to it if they lie in the same
+  plane.
+
+  >>> names = ['C{}'.format(i + 1) for i in range(6)] + ['F1']
+  >>> xyz = [(1.39 * math.cos(i * math.pi / 3), 1.39 * math.sin(i * math.pi / 3), 0) for i in range(6)]
+  >>> restraints = generate_restraints(names, [6] * 6 + [9], xyz + [(2.74, 0, 0)])
+  >>> restraints[0], restraints[7], restraints[-1]
+  (('DFIX', '1.390 C1 C2'), ('DANG', '2.408 C1 C3'), ('FLAT', 'C1 C2 C3 C4 C5 C6 F1'))
+  >>> len(restraints)
+  16
+
+  :param names: atom names
+  :type names: list
+  :param numbers: atomic numbers of the atoms
+  :type numbers: list
+  :param coordinates: cartesian (x, y, z) of the atoms
+  :type coordinates: list
+  :rtype: list of (str, str)
+  """
+  size = len(names)
+  bonds = bond_graph(numbers, coordinates, tolerance)
+  restraints = []
+  for card, pairs in (('DFIX', bonds), ('DANG', angle_pairs(size, bonds))):
+    for (i, j), distance in zip(pairs, _distances(coordinates, pairs)):
+      restraints.append((card, '{:.3f} {} {}'.format(distance, names[i], names[j])))
+  adjacency = neighbours(size, bonds)
+  for ring in find_rings(size, bonds):
+    substituents = sorted(set(j for i in ring for j in adjacency[i]) - set(ring))
+    for atoms in (ring + substituents, ring):
+      if plane_deviation([coordinates[i] for i in atoms]) < FLAT_TOLERANCE:
+        restraints.append(('FLAT', ' '.join(names[i] for i in atoms)))
+        break
+  return restraints
@@ -6,14 +6,14 @@ import io
 from PIL import Image, ImageFile, ImageDraw, ImageChops
 import FragmentDB.helper_functions as helper_functions
 from FragmentDB.helper_functions import check_restraints_consistency, initialize_user_db,\
-      invert_atomlist_coordinates, frac_to_cart, atomic_distance
+      invert_atomlist_coordinates, frac_to_cart_many, PeriodicCellList
 import os
 import olex
 import gui.maps
 import olx
 import OlexVFS
 import olex_core
-from FragmentDB.fragmentdb_handler import FragmentTable
+from FragmentDB.fragmentdb_handler import FragmentTable, FRAGMENT_PAGE_SIZE
 from FragmentDB.refine_model_tasks import Refmod
 import pprint
 
@@ -73,6 +73,8 @@ class FragmentDB(PT):
       initialize_user_db(self.userdbfile)
     # for edited fragments:
     self.cell = []
+    # (user database revision, page) of the fragment list in the GUI:
+    self._listed = None
     print(' FragmentDB version:', FDB_VERSION)
     # Better not for now 10.07.2019:
     # Makes residue as default after start:
@@ -84,6 +86,7 @@ class FragmentDB(PT):
     """
     initialize the plugins main form
     """
+    self.refresh()
     self.get_resi_class()
     self.set_fragment_picture()
     self.display_image('FDBMOLEPIC', 'displayimg.png')
@@ -95,6 +98,16 @@ class FragmentDB(PT):
     OV.SetParam('FragmentDB.new_fragment.frag_name', self.get_fragname())
     olx.html.SetValue('LIST_FRAGMENTS', OV.GetParam('FragmentDB.new_fragment.frag_name'))
 
+  def refresh(self):
+    """
+    drops the cached fragments if the user database was changed outside of
+    this plugin. Called once at the start of an action, the single fragment
+    accessors then read from the cache without asking the database.
+    :rtype: int
+    :returns: revision of the user database
+    """
+    return FragmentTable(self.dbfile, self.userdbfile).refresh()
+
   def set_id(self, fragid=0):
     """
     Sets the fragment id in the phil for the search field
@@ -103,11 +116,49 @@ class FragmentDB(PT):
       int(fragid)
     except(ValueError):
       return False
+    self.refresh()
     # print('### Selected fragment {}'.format(fragid))
     OV.SetParam("FragmentDB.fragment.fragId", fragid)
     self.fragId = int(fragid)
     return True
 
+  def get_bundle(self, fragid=None):
+    """
+    returns the FragmentBundle with name, class, reference, atoms and
+    restraints of the fragment fragid (default: the selected one). Repeated
+    calls are served from the fragment cache of the database handler.
+    :rtype: FragmentBundle
+    """
+    fragid = self._fragment_id(fragid)
+    if not fragid:
+      return None
+    db = FragmentTable(self.dbfile, self.userdbfile)
+    return db.get_fragment_bundle(fragid)
+
+  def get_record(self, fragid=None):
+    """
+    returns the fragment fragid (default: the selected one) as Fragment
+    record with split restraints.
+    :rtype: Fragment
+    """
+    fragid = self._fragment_id(fragid)
+    if not fragid:
+      return None
+    db = FragmentTable(self.dbfile, self.userdbfile)
+    return db.get_fragment_record(fragid)
+
+  def _fragment_id(self, fragid=None):
+    """
+    returns fragid or the id of the selected fragment as int, 0 if there is
+    none.
+    """
+    if fragid is None:
+      fragid = self.fragId
+    try:
+      return int(fragid)
+    except(ValueError, TypeError):
+      return 0
+
   def get_cell(self):
     """
     returns the cell from the refinement model
@@ -193,27 +244,53 @@ class FragmentDB(PT):
       OV.SetParam(varname, resiclass.upper())
       # olx.html.SetValue(name, OV.GetParam(varname))
 
-  def list_all_fragments(self):
+  def list_all_fragments(self, page=None):
     """
     returns the available fragments in the database
     the list of names is separated by semicolon
     i[0] => number
     i[1] => name
+    :param page: list this page of the fragment list, default is the current page
+    """
+    if page in (None, ''):
+      page = OV.GetParam('FragmentDB.fragment.list_page')
+    page = int(page)
+    listed = (self.refresh(), page)
+    if listed == self._listed:
+      # nothing changed since the last time:
+      return
+    olx.html.SetItems('LIST_FRAGMENTS', self.get_fragments(page))
+    self._listed = listed
+
+  def get_fragments(self, page=None):
     """
+    returns one page of FRAGMENT_PAGE_SIZE fragments for the combo box, so the
+    list never holds the whole library.
+    :param page: number of the page, starting at 0, default is the current page
+    """
+    if page in (None, ''):
+      page = OV.GetParam('FragmentDB.fragment.list_page')
     db = FragmentTable(self.dbfile, self.userdbfile)
-    items = ';'.join(['{}<-{}'.format(i[1], i[0]) for i in db])
-    olx.html.SetItems('LIST_FRAGMENTS', items)
+    fragments = db.get_fragment_page(int(page))
+    items = ';'.join('{}<-{}'.format(i[1], i[0]) for i in fragments)
+    return items
 
-  def get_fragments(self):
+  def turn_page(self, step=1):
+    """
+    shows the next (step=1) or previous (step=-1) page of the fragment list.
+    :param step: number of pages to turn
+    """
     db = FragmentTable(self.dbfile, self.userdbfile)
-    items = ';'.join(['{}<-{}'.format(i[1], i[0]) for i in db])
-    return items
+    last_page = max(len(db) - 1, 0) // FRAGMENT_PAGE_SIZE
+    page = OV.GetParam('FragmentDB.fragment.list_page') + int(step)
+    page = min(max(page, 0), last_page)
+    OV.SetParam('FragmentDB.fragment.list_page', page)
+    self.list_all_fragments(page)
 
   def search_fragments(self, search_string):
     """
     performs a search for an unsharp name in a list
     """
-    selected_list = ''
     if not search_string:
       print("Empty search string.")
       self.list_all_fragments()
@@ -225,9 +302,17 @@ class FragmentDB(PT):
       if len(selected_results) == 1:
         print('Nothing found...')
         return
-      selected_list = ';'.join(['{}<-{}'.format(i[1], i[0]) for i in selected_results])
+    self.show_search_results(selected_results)
+
+  def show_search_results(self, selected_results):
+    """
+    puts the [Id, Name] of selected_results into the fragment list and selects
+    the first one.
+    """
+    selected_list = ';'.join(['{}<-{}'.format(i[1], i[0]) for i in selected_results])
     # propagate the smaller list to the combo-box:
     olx.html.SetItems('LIST_FRAGMENTS', selected_list)
+    self._listed = None
     # show the first result in combo box and intialize the fragment:
     olx.html.SetValue('LIST_FRAGMENTS', '{}'.format(selected_results[0][1]))
     frag_id = int(selected_results[0][0])
@@ -235,6 +320,43 @@ class FragmentDB(PT):
     self.fragId = frag_id
     self.init_plugin()
 
+  def search_by_shape(self, k=8):
+    """
+    lists the fragments that look like the selected atoms in the fragment list,
+    e.g. to identify a badly resolved solvent molecule.
+    """
+    atoms = self.get_selected_atom_names()
+    if len(atoms) < 3:
+      print('Please select at least three atoms.')
+      return
+    coords = [[float(i) for i in olx.Crd(x).split()] for x in atoms]
+    names = [y.split('_')[0] for y in atoms]
+    db = FragmentTable(self.dbfile, self.userdbfile)
+    selected_results = db.find_fragment_by_shape(coords, int(k), names)
+    if not selected_results:
+      print('Nothing found...')
+      return
+    for fragid, name, rmsd in selected_results:
+      print('{:>8.3f}  {}'.format(rmsd, name))
+    self.show_search_results(selected_results)
+
+  def search_substructure(self, substructure):
+    """
+    lists the fragments that contain a substructure like 'CF3', 'aryl' or
+    'C(F)(F)F' in the fragment list.
+    """
+    db = FragmentTable(self.dbfile, self.userdbfile)
+    try:
+      selected_results = db.find_substructure(substructure)
+    except ValueError as e:
+      print(e)
+      return
+    if not selected_results:
+      print('Nothing found...')
+      return
+    print('{} fragments contain "{}".'.format(len(selected_results), substructure))
+    self.show_search_results(selected_results)
+
   def format_atoms_for_importfrag(self, atoms):
     """
     format the input atoms to use them with importfarg
@@ -282,15 +404,13 @@ class FragmentDB(PT):
     """
     this method looks around every atom of the fitted fragment and removes
     atoms that are near a certain distance.
-    go through all fragment atoms and look for each atom for all atoms in
-    part 0 if they are nearer as remdist to them
+    the part 0 atoms are put into a periodic cell list, so each fragment atom
+    only looks at the atoms around it, also in the neighbouring cells
     :param frag_atoms: atom ids of the fitting fragment ['21', '22', '23', '24']
     :type frag_atoms: list
     :param remdist: distance below atoms shoud be deleted.
     :type remdist: float
     """
-    cell = self.get_cell()
-    atoms_to_delete = []
     all_atoms_dict = self.get_atoms_list(part=0, notype='')
     frag_crd_dict = {}
     for i in frag_atoms:
@@ -298,16 +418,13 @@ class FragmentDB(PT):
       frag_crd_dict[i] = all_atoms_dict[int(i)]
       # remove fragment atoms from structure:
       all_atoms_dict.pop(int(i), None)
-    for aa_id in all_atoms_dict:
-      if all_atoms_dict[aa_id][2] == 0:
-        for f_id in frag_crd_dict:
-          at1 = all_atoms_dict[aa_id][1]  # coordinates
-          at2 = frag_crd_dict[f_id][1]  # coordinates
-          d = atomic_distance(at1, at2, cell)
-          # now the atoms inside the remdist go into deltion list
-          if d < remdist:
-            atoms_to_delete.append(str(aa_id))
-    return list(set(atoms_to_delete))
+    part0_ids = [aa_id for aa_id in all_atoms_dict if all_atoms_dict[aa_id][2] == 0]
+    if not frag_crd_dict or not part0_ids:
+      return []
+    index = PeriodicCellList([all_atoms_dict[aa_id][1] for aa_id in part0_ids], self.get_cell(), remdist)
+    # now the atoms inside the remdist go into deltion list:
+    near = index.query_many([frag_crd_dict[f_id][1] for f_id in frag_crd_dict])
+    return [str(part0_ids[num]) for num in sorted(near)]
 
   def insert_frag_with_ImportFrag(self, fragId, part=-1, occ=1, afix=False):
     """
@@ -325,11 +442,10 @@ class FragmentDB(PT):
     # then defines the further properties of the fragment:
     OV.registerCallback('onFragmentImport', self.onImport)
     fragpath = os.sep.join([OV.StrDir(), 'fragment.txt'])
-    db = FragmentTable(self.dbfile, self.userdbfile)
-    try:
-      atoms = self.format_atoms_for_importfrag([i for i in db[fragId]])
-    except(IndexError):
+    bundle = self.get_bundle(fragId)
+    if not bundle or not bundle.atoms:
       return
+    atoms = self.format_atoms_for_importfrag(bundle.atoms)
     try:
       with open(fragpath, 'w') as f:
         f.write(atoms)
@@ -363,6 +479,7 @@ class FragmentDB(PT):
       # no fragment chosen-> do nothing
       print('No fragment selected!')
       return False
+    self.refresh()
     # saves the current state into the history:
     self.make_history()
     OV.cmd("labels false")
@@ -396,15 +513,18 @@ class FragmentDB(PT):
     :param atomids: atomic olex2 ids of the atoms
     :type atomids: list
     """
-    db = FragmentTable(self.dbfile, self.userdbfile)
     resiclass = OV.GetParam('FragmentDB.fragment.resi_class')
     freevar = int(OV.GetParam('FragmentDB.fragment.frag_fvar'))
     partnum = OV.GetParam('FragmentDB.fragment.frag_part')
     if not OV.GetParam('FragmentDB.fragment.use_dfix'):
       print('Applying fragment properties:')
+    bundle = self.get_bundle()
+    if not bundle:
+      print('Database Fragment {} not found.'.format(self.fragId))
+      return False
     labeldict = OrderedDict()
     atomids = [str(x) for x in atomids]
-    dbatom_names = [i[0].upper() for i in db[self.fragId]]
+    dbatom_names = [i[0].upper() for i in bundle.atoms]
     for at_id, name in zip(atomids, dbatom_names):
       labeldict[name.upper()] = at_id
     # select all atomids to do the fit:
@@ -420,7 +540,7 @@ class FragmentDB(PT):
         self.atomrenamer(labeldict)
     # Placing restraints:
     if not OV.GetParam('FragmentDB.fragment.use_dfix') and not OV.GetParam('FragmentDB.fragment.roff'):
-      self.make_restraints(labeldict, resinum, resiclass)
+      self.make_restraints(atomids, resinum, resiclass)
     self.make_part(atomids, partnum)
     return atomids
 
@@ -451,45 +571,35 @@ class FragmentDB(PT):
       OV.cmd("sel #c{}".format(' #c'.join(atoms)))
       OV.cmd("RESI {}".format(resinum))
 
-  def make_restraints(self, labeldict, resinum=0, resiclass=''):
+  def make_restraints(self, atomids, resinum=0, resiclass=''):
     """
     Applies restraints to atoms.
-    :param labeldict: a dictionary where the keys are atom names and the
-                      values are Olex2 atom Ids
-    :type labeldict: dictionary
+    The restraints are compiled once per fragment into a RestraintProgram
+    with resolved ranges, here only the atom ids are filled in.
+    :param atomids: Olex2 ids of the atoms in the order of the database
+    :type atomids: list
     """
+    fragid = self._fragment_id()
+    if not fragid:
+      return
     db = FragmentTable(self.dbfile, self.userdbfile)
-    restraints = db.get_restraints(self.fragId)
-    if not restraints:
+    program = db.get_restraint_program(fragid)
+    if not program:
       return
-    for num, i in enumerate(restraints):
-      # i[0] is restraint like SADI or DFIX
-      # i[1] is a string of atoms like 'C1 C2'
-      restraint_atoms = i[1].upper()
-      if '>' in restraint_atoms or '<' in restraint_atoms:
-        restraint_atoms = self.range_resolver(restraint_atoms.split(), list(labeldict.keys()))
-      line = []
-      for at in restraint_atoms.split():
-        # is it a potential atom (starts with alphabetic character):
-        if at[0].isalpha():
-          try:
-            line.append('#c' + labeldict[at.upper()])
-          except KeyError:
-            # in this case, an atom name in the restraint does not
-            # exist in the fragments atom list!
-            print('\nUnknown restraint or atom found in restraints line {}.\n'.format(num + 1))
-            # I must exit here!
-            return
-        else:
-          line.append(at)
+    for card, line in program.apply(atomids):
       # Applies the implicit restraint to atoms in line:
       # I disabled implicit restraints because they cause trouble during atom
       # renaming. Update: It seems to work now, enabling again.
-      if i[0] in helper_functions.IMPL_RESTRAINT_CARDS and resinum != 0 and resiclass:
-        OV.cmd("{} -i {}".format(i[0], ' '.join(line)))
+      if card in helper_functions.IMPL_RESTRAINT_CARDS and resinum != 0 and resiclass:
+        OV.cmd("{} -i {}".format(card, line))
       else:
         # applies direct restraints:
-        OV.cmd("{} {}".format(i[0], ' '.join(line)))
+        OV.cmd("{} {}".format(card, line))
+    unknown_line = program.unknown_line_for(len(atomids))
+    if unknown_line:
+      # in this case, an atom name in the restraint does not
+      # exist in the fragments atom list or was not fitted!
+      print('\nUnknown restraint or atom found in restraints line {}.\n'.format(unknown_line))
 
   def prepare_picture(self, im, max_size=120, ratiolim=0.6):
     """
@@ -533,9 +643,9 @@ class FragmentDB(PT):
     :param max_size: maximum size of the picture in pixels
     :type max_size: int
     """
-    db = FragmentTable(self.dbfile, self.userdbfile)
     max_size = int(max_size)
-    pic = db.get_picture(self.fragId)
+    bundle = self.get_bundle()
+    pic = bundle.picture if bundle else None
     if not pic:
       # print('No fragment picture found.')
       return False
@@ -589,41 +699,6 @@ class FragmentDB(PT):
     OlexVFS.save_image_to_olex(im, 'displayimg.png', 0)
     olx.html.SetImage('Inputfrag.MOLEPIC2', 'displayimg.png')
 
-  def range_resolver(self, restraintat, atom_names):
-    """
-    resolves the atom names of ranges like "C1 > C5"
-    works for each restraint line separately.
-    :param restraintat: atoms with a range definition
-    :type restraintat: list
-    :param atom_names: names of atoms in the fragment
-    :type atom_names: list
-    """
-    # dict with lists of positions of the > or < sign:
-    rightleft = {'>': [], '<': []}
-    for rl in rightleft:
-      for num, i in enumerate(restraintat):
-        i = i.upper()
-        if rl == i:
-          # fill the dictionary:
-          rightleft[rl].append(num)
-    for rl in rightleft:
-      # for each sign:
-      for i in rightleft[rl]:
-        # for each position of < or >:
-        if rl == '>':
-          # forward range
-          left = atom_names.index(restraintat[i - 1]) + 1
-          right = atom_names.index(restraintat[i + 1])
-          restraintat[i:i + 1] = atom_names[left:right]
-        else:
-          # backward range
-          left = atom_names.index(restraintat[i - 1])
-          right = atom_names.index(restraintat[i + 1]) + 1
-          names = atom_names[right:left]
-          names.reverse()  # counting backwards
-          restraintat[i:i + 1] = names
-    return ' '.join(restraintat)
-
   def find_free_residue_num(self):
     """
     Determines which residue number is unused.
@@ -672,8 +747,12 @@ class FragmentDB(PT):
     """
     sets the residue class from the respective database fragment.
     """
-    db = FragmentTable(self.dbfile, self.userdbfile)
-    resiclass = db.get_residue_class(int(self.fragId))
+    bundle = self.get_bundle()
+    if bundle:
+      resiclass = bundle.resiclass
+    else:
+      print('Could not find residue class.')
+      resiclass = ''
     OV.SetParam('FragmentDB.fragment.resi_class', resiclass)
     OV.SetParam('FragmentDB.new_fragment.frag_resiclass', resiclass)
     # set the class in the text field of the gui:
@@ -684,8 +763,8 @@ class FragmentDB(PT):
     show the reference of a fragment in the GUI
     :type edit: bool
     """
-    db = FragmentTable(self.dbfile, self.userdbfile)
-    ref = db.get_reference(self.fragId)
+    bundle = self.get_bundle()
+    ref = bundle.reference if bundle else 'no reference found'
     if not edit:
       pass
       # disabled, because replace checkbox is there
@@ -954,15 +1033,11 @@ class FragmentDB(PT):
     :type as_html: bool
     """
     atlist = []
-    atoms_list = []
-    db = FragmentTable(self.dbfile, self.userdbfile)
-    try:
-      atoms_list = db[self.fragId]
-    except IndexError:
-      return False
+    bundle = self.get_bundle()
+    if not bundle or not bundle.atoms:
       # print('Database Fragment {} not found.'.format(fragId))
-    if not atoms_list:
       return False
+    atoms_list = bundle.atoms
     atoms_list = [[i for i in y] for y in atoms_list]
     for num, i in enumerate(atoms_list):
       try:
@@ -990,9 +1065,8 @@ class FragmentDB(PT):
     """
     prepare the fragment name to display in a multiline edit field
     """
-    db = FragmentTable(self.dbfile, self.userdbfile)
     try:
-      name = str(db.get_fragment_name(self.fragId))
+      name = str(self.get_bundle().name)
     except:
       print('Could not get a name from the database.')
       return False
@@ -1002,8 +1076,8 @@ class FragmentDB(PT):
     """
     prepare the fragment restraints to display in a multiline edit field
     """
-    db = FragmentTable(self.dbfile, self.userdbfile)
-    restr_list = db.get_restraints(self.fragId)
+    bundle = self.get_bundle()
+    restr_list = bundle.restraints if bundle else None
     if not restr_list:
       return False
     restr_list = [[str(i) for i in y] for y in restr_list]
@@ -1051,14 +1125,27 @@ class FragmentDB(PT):
       print('No picture found')
       pic_data = ''
     coords = self.prepare_coords_for_storage(atlines)
+    if not coords:
+      print('\nFragment was not updated, no valid atoms found!')
+      return
     if not check_restraints_consistency(restraints, atlines, fragname):
       print('\nFragment was not added to the database!')
       return
     if restraints:
       helper_functions.check_sadi_consistence(atlines, restraints, self.frag_cell, fragname)
-    self.delete_fragment(reset=False)
+    if not self.fragId:
+      print('Can not update a fragment, because no fragment is selected.')
+      return
     db = FragmentTable(self.dbfile, self.userdbfile)
-    frag_id = db.store_fragment(fragname, coords, resiclass, restraints, reference, picture=pic_data)
+    # replace the old fragment in one step, the GUI only changes after the commit:
+    try:
+      with db.transaction():
+        del db[self.fragId]
+        frag_id = db.store_fragment(fragname, coords, resiclass, restraints, reference, picture=pic_data)
+    except Exception as e:
+      print(e)
+      print('\nFragment was not updated, the database is unchanged.')
+      return
     print('Updated fragment "{0}".'.format(fragname))
     if frag_id:
       olx.SetVar('fragment_ID', frag_id)
@@ -1082,6 +1169,7 @@ class FragmentDB(PT):
     :rtype: list
     """
     coords = []
+    frac_coords = []
     for line in atlines:
       try:
         frac_coord = [float(i) for i in line[1:4]]
@@ -1091,9 +1179,11 @@ class FragmentDB(PT):
       if len(frac_coord) < 3:
         print('Coordinate value missing in "{}".'.format(' '.join(line)))
         continue
-      coord = frac_to_cart(frac_coord, self.frag_cell)
-      line[1:4] = coord
+      frac_coords.append(frac_coord)
       coords.append(line)
+    # orthogonalize all atoms in one step:
+    for line, coord in zip(coords, frac_to_cart_many(frac_coords, self.frag_cell)):
+      line[1:4] = [float(i) for i in coord]
     return coords
 
   def get_frag_for_gui(self):
@@ -1110,8 +1200,8 @@ class FragmentDB(PT):
       name = "Could not get a fragment name from the database"
     restr = self.prepare_restraints()
     residue = self.prepare_residue_class()
-    db = FragmentTable(self.dbfile, self.userdbfile)
-    reference = db.get_reference(self.fragId)
+    bundle = self.get_bundle()
+    reference = bundle.reference if bundle else 'no reference found'
     cell = '1  1  1  90  90  90'
     olx.html.SetValue('Inputfrag.SET_ATOM', at)
     olx.html.SetValue('Inputfrag.set_cell', cell)
@@ -1153,6 +1243,9 @@ class FragmentDB(PT):
       return
     if restraints:
       helper_functions.check_sadi_consistence(atlines, restraints, self.frag_cell, fragname)
+    for duplicate in db.find_near_duplicates(coords):
+      print('Warning: Fragment "{}" looks like "{}" ({:.0%} similar geometry).'.format(
+        fragname, duplicate[1], duplicate[2]))
     frag_id = db.store_fragment(fragname, coords, resiclass, restraints, reference, picture=pic_data)
     if not frag_id:
       print('Something went wrong during fragment storage.')
@@ -1331,8 +1424,8 @@ class FragmentDB(PT):
       return False
     restr = self.prepare_restraints()
     residue = self.prepare_residue_class()
-    db = FragmentTable(self.dbfile, self.userdbfile)
-    reference = db.get_reference(self.fragId)
+    bundle = self.get_bundle()
+    reference = bundle.reference if bundle else 'no reference found'
     cell = 'FRAG 17 1 1 1 90 90 90'
     fragtext.append('<font face="courier" size="11pt"> ')
     fragtext.append('REM Name: {}'.format(name))
@@ -1430,12 +1523,15 @@ OV.registerFunction(fdb.exportfrag, False, "FragmentDB")
 OV.registerFunction(fdb.init_plugin, False, "FragmentDB")
 OV.registerFunction(fdb.get_fvar_occ, False, "FragmentDB")
 OV.registerFunction(fdb.search_fragments, False, "FragmentDB")
+OV.registerFunction(fdb.search_by_shape, False, "FragmentDB")
+OV.registerFunction(fdb.search_substructure, False, "FragmentDB")
 OV.registerFunction(fdb.show_reference, False, "FragmentDB")
 OV.registerFunction(fdb.make_selctions_picture, False, "FragmentDB")
 OV.registerFunction(fdb.set_frag_atoms, False, "FragmentDB")
 OV.registerFunction(fdb.open_edit_fragment_window, False, "FragmentDB")
 OV.registerFunction(fdb.list_all_fragments, False, "FragmentDB")
 OV.registerFunction(fdb.get_fragments, False, "FragmentDB")
+OV.registerFunction(fdb.turn_page, False, "FragmentDB")
 OV.registerFunction(fdb.fit_db_fragment, False, "FragmentDB")
 OV.registerFunction(fdb.get_resi_class, False, "FragmentDB")
 OV.registerFunction(fdb.find_free_residue_num, False, "FragmentDB")
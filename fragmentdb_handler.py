@@ -6,34 +6,499 @@ Created on 09.10.2014
 """
 from __future__ import print_function
 
+import atexit
+import heapq
+import os
+import shutil
 import sys
-
-from FragmentDB.helper_functions import dice_coefficient2, SHX_CARDS, make_sortkey
+import tempfile
+from collections import OrderedDict
+from contextlib import contextmanager
+from itertools import groupby
+from operator import itemgetter
+
+try:
+  from urllib.request import pathname2url
+except ImportError:
+  from urllib import pathname2url
+
+from FragmentDB.helper_functions import dice_coefficient2, SHX_CARDS, get_atomic_number, formula_to_dict
+from FragmentDB.schema import USER_NAME_SUFFIX, fragment_keys, name_bigrams, upgrade, schema_version,\
+  has_fulltext, composition, pack_coordinates, unpack_coordinates, revision, formula_key, \
+  geometry_fingerprint, pack_fingerprint, unpack_fingerprint, fingerprint_similarity, SCHEMA_VERSION
+from FragmentDB.shape import rank_by_shape
+from FragmentDB.graph import bond_graph, pack_bonds, unpack_bonds, graph_features, parse_smiles,\
+  match_substructure, SUBSTRUCTURES
+from FragmentDB.dfix import generate_restraints
+
+try:
+  import numpy as np
+except ImportError:
+  # get_coordinates() returns lists without numpy:
+  np = None
 
 __metaclass__ = type  # use new-style classes
 import sqlite3
 from sqlite3 import OperationalError
 
-__all__ = ['DatabaseRequest', 'FragmentTable', 'Restraints']
+__all__ = ['QUERIES', 'ConnectionPool', 'connection_pool', 'DatabaseRequest', 'FragmentBundle',
+           'AtomRecord', 'Restraint', 'RestraintProgram', 'Fragment', 'FragmentCache', 'fragment_cache',
+           'FragmentTable', 'Restraints']
+
+# Number of prepared statements sqlite3 keeps per connection:
+STATEMENT_CACHE_SIZE = 128
+# Bytes of the read-only main database that are memory-mapped:
+MMAP_SIZE = 64 * 1024 * 1024
+# Page cache of the main database in KiB:
+PAGE_CACHE_SIZE = 8 * 1024
+# Fragments with a geometry fingerprint similarity of at least this value
+# are reported as duplicates:
+DUPLICATE_SIMILARITY = 0.9
+# Default number of fragments per page of get_fragment_page():
+FRAGMENT_PAGE_SIZE = 100
+# Limits of the in-process fragment cache:
+FRAGMENT_CACHE_ENTRIES = 256
+FRAGMENT_CACHE_BYTES = 16 * 1024 * 1024
+
+# Fragments of the user database are addressed with their Id plus this offset:
+USER_ID_OFFSET = 1000000
+
+# Temporary views that present the main and the user database as one. The
+# user rows come with ids offset by USER_ID_OFFSET and a userdb flag of 1.
+# Lookups by id stay indexed, because the user database has indexes on the
+# offset id expressions (USER_ID_INDEXES). The last item is an optional
+# ORDER BY clause of the view.
+UNIFIED_VIEWS = (
+  ('AllFragments',
+   '''SELECT Id, class, Name, Reference, comment, picture, SortKey, SortNum, SearchKey, AtomCount,
+             ElementCount, 0 AS userdb
+      FROM main.Fragment''',
+   '''SELECT Id + {offset:d}, class, Name, Reference, comment, picture, SortKey, SortNum, SearchKey,
+             AtomCount, ElementCount, 1
+      FROM userdb.Fragment''', ''),
+  ('AllAtoms',
+   '''SELECT Id, FragmentId, Name, element, x, y, z, 0 AS userdb FROM main.Atoms''',
+   '''SELECT Id + {offset:d}, FragmentId + {offset:d}, Name, element, x, y, z, 1 FROM userdb.Atoms''', ''),
+  ('AllRestraints',
+   '''SELECT Id, FragmentId, ShelxName, Atoms, 0 AS userdb FROM main.Restraints''',
+   '''SELECT Id + {offset:d}, FragmentId + {offset:d}, ShelxName, Atoms, 1 FROM userdb.Restraints''', ''),
+  ('AllCoordinates',
+   '''SELECT FragmentId, Labels, XYZ FROM main.Coordinates''',
+   '''SELECT FragmentId + {offset:d}, Labels, XYZ FROM userdb.Coordinates''', ''),
+  ('AllBonds',
+   '''SELECT FragmentId, Bonds FROM main.Bonds''',
+   '''SELECT FragmentId + {offset:d}, Bonds FROM userdb.Bonds''', ''),
+  ('AllFingerprints',
+   '''SELECT FragmentId, Formula, Histogram FROM main.Fingerprint''',
+   '''SELECT FragmentId + {offset:d}, Formula, Histogram FROM userdb.Fingerprint''', ''),
+  # names in the order of the fragment list. Both parts are read along their
+  # sort key indexes and merged, no sorting is necessary. StoredName is the
+  # name without the suffix of user fragments:
+  ('FragmentList',
+   '''SELECT Id, Name, SearchKey, SortNum, SortKey, Name AS StoredName FROM main.Fragment''',
+   '''SELECT Id + {offset:d}, Name || '{suffix}', SearchKey, SortNum, SortKey, Name FROM userdb.Fragment''',
+   '''ORDER BY SortKey, SortNum, Id'''),
+  # fragments that share bigrams with the search string in temp.SearchBigrams
+  # and the number of shared bigrams. CROSS JOIN keeps the short list of
+  # search bigrams as outer loop:
+  ('NameBigramHits',
+   '''SELECT f.Id AS Id, f.Name AS Name, f.SortNum AS SortNum, f.SortKey AS SortKey,
+             f.BigramCount AS BigramCount, h.Common AS Common
+      FROM (SELECT b.FragmentId AS FragmentId, SUM(MIN(b.Count, q.Count)) AS Common
+            FROM temp.SearchBigrams AS q CROSS JOIN main.NameBigrams AS b ON b.Bigram = q.Bigram
+            GROUP BY b.FragmentId) AS h
+        CROSS JOIN main.Fragment AS f ON f.Id = h.FragmentId''',
+   '''SELECT f.Id + {offset:d}, f.Name || '{suffix}', f.SortNum, f.SortKey, f.BigramCount, h.Common
+      FROM (SELECT b.FragmentId AS FragmentId, SUM(MIN(b.Count, q.Count)) AS Common
+            FROM temp.SearchBigrams AS q CROSS JOIN userdb.NameBigrams AS b ON b.Bigram = q.Bigram
+            GROUP BY b.FragmentId) AS h
+        CROSS JOIN userdb.Fragment AS f ON f.Id = h.FragmentId''', ''),
+  # fragments with all elements of temp.CompositionQuery in the given count
+  # range and the number of elements that matched:
+  ('CompositionHits',
+   '''SELECT f.Id AS Id, f.Name AS Name, f.SortNum AS SortNum, f.SortKey AS SortKey,
+             f.AtomCount AS AtomCount, f.ElementCount AS ElementCount, h.Matched AS Matched
+      FROM (SELECT c.FragmentId AS FragmentId, COUNT(*) AS Matched
+            FROM temp.CompositionQuery AS q CROSS JOIN main.Composition AS c
+              ON c.Element = q.Element AND c.Count BETWEEN q.MinCount AND q.MaxCount
+            GROUP BY c.FragmentId) AS h
+        CROSS JOIN main.Fragment AS f ON f.Id = h.FragmentId''',
+   '''SELECT f.Id + {offset:d}, f.Name || '{suffix}', f.SortNum, f.SortKey, f.AtomCount, f.ElementCount,
+             h.Matched
+      FROM (SELECT c.FragmentId AS FragmentId, COUNT(*) AS Matched
+            FROM temp.CompositionQuery AS q CROSS JOIN userdb.Composition AS c
+              ON c.Element = q.Element AND c.Count BETWEEN q.MinCount AND q.MaxCount
+            GROUP BY c.FragmentId) AS h
+        CROSS JOIN userdb.Fragment AS f ON f.Id = h.FragmentId''', ''),
+  # fragments with features of temp.FeatureQuery and the number of features
+  # they have:
+  ('GraphFeatureHits',
+   '''SELECT f.Id AS Id, f.Name AS Name, f.SortNum AS SortNum, f.SortKey AS SortKey, h.Matched AS Matched
+      FROM (SELECT g.FragmentId AS FragmentId, COUNT(*) AS Matched
+            FROM temp.FeatureQuery AS q CROSS JOIN main.GraphFeatures AS g ON g.Feature = q.Feature
+            GROUP BY g.FragmentId) AS h
+        CROSS JOIN main.Fragment AS f ON f.Id = h.FragmentId''',
+   '''SELECT f.Id + {offset:d}, f.Name || '{suffix}', f.SortNum, f.SortKey, h.Matched
+      FROM (SELECT g.FragmentId AS FragmentId, COUNT(*) AS Matched
+            FROM temp.FeatureQuery AS q CROSS JOIN userdb.GraphFeatures AS g ON g.Feature = q.Feature
+            GROUP BY g.FragmentId) AS h
+        CROSS JOIN userdb.Fragment AS f ON f.Id = h.FragmentId''', ''),
+)
+
+# Full text search in both databases with the FTS5 query in temp.TextQuery.
+# Only available if sqlite comes with FTS5:
+TEXT_SEARCH_VIEW = (
+  'FragmentTextHits',
+  '''SELECT rowid AS Id, Name, bm25(FragmentText) AS Rank FROM main.FragmentText
+      WHERE FragmentText MATCH (SELECT Query FROM temp.TextQuery)''',
+  '''SELECT rowid + {offset:d}, Name || '{suffix}', bm25(FragmentText) FROM userdb.FragmentText
+      WHERE FragmentText MATCH (SELECT Query FROM temp.TextQuery)''', '')
+
+# Columns of the text search for the fields argument of search_text():
+TEXT_FIELDS = {'name': 'Name', 'reference': 'Reference', 'comment': 'comment'}
+
+USER_ID_INDEXES = (
+  '''CREATE INDEX IF NOT EXISTS userdb.Fragment_UnifiedId ON Fragment(Id + {offset:d})''',
+  '''CREATE INDEX IF NOT EXISTS userdb.Atoms_UnifiedFK ON Atoms(FragmentId + {offset:d})''',
+  '''CREATE INDEX IF NOT EXISTS userdb.Restraint_UnifiedFK ON Restraints(FragmentId + {offset:d})''',
+  '''CREATE INDEX IF NOT EXISTS userdb.Fragment_UnifiedSortKey ON Fragment(SortKey, SortNum, Id + {offset:d})''',
+  '''CREATE INDEX IF NOT EXISTS userdb.Coordinates_UnifiedId ON Coordinates(FragmentId + {offset:d})''',
+  '''CREATE INDEX IF NOT EXISTS userdb.Fingerprint_UnifiedId ON Fingerprint(FragmentId + {offset:d})''',
+  '''CREATE INDEX IF NOT EXISTS userdb.Bonds_UnifiedId ON Bonds(FragmentId + {offset:d})''',
+)
+
+# Catalogue of the parameterized statements used by the handler. They are
+# executed by name through DatabaseRequest.db_request(). Since the SQL text of
+# a statement never changes, sqlite3 prepares it only once per connection and
+# takes it from the statement cache afterwards. Fragment ids are always the
+# unified ids of the views above.
+QUERIES = {
+  # counts and listings:
+  'count_fragments'     : '''SELECT COUNT(*) FROM AllFragments''',
+  'all_ids'             : '''SELECT Id FROM AllFragments ORDER BY Id''',
+  'all_names'           : '''SELECT Id, Name FROM FragmentList''',
+  'fragment_page'       : '''SELECT Id, Name FROM FragmentList
+                             WHERE (?1 IS NULL OR StoredName LIKE '%' || ?1 || '%') LIMIT ?2 OFFSET ?3''',
+  'all_search_keys'     : '''SELECT Id, Name, SearchKey, SortNum FROM FragmentList''',
+  # all fragments with their atoms and restraints, ordered by fragment id:
+  'all_fragment_names'  : '''SELECT Id, CASE userdb WHEN 1 THEN Name || '{}' ELSE Name END FROM AllFragments
+                             ORDER BY Id'''.format(USER_NAME_SUFFIX),
+  'all_atoms'           : '''SELECT FragmentId, Name, x, y, z FROM AllAtoms ORDER BY FragmentId, Id''',
+  'all_restraints'      : '''SELECT FragmentId, ShelxName, Atoms FROM AllRestraints ORDER BY FragmentId, Id''',
+  # full text search and its fallback without FTS5:
+  'has_text_search'     : '''SELECT 1 FROM temp.sqlite_master WHERE name = 'FragmentTextHits' ''',
+  'set_text_query'      : '''REPLACE INTO temp.TextQuery (rowid, Query) VALUES(1, ?)''',
+  'text_hits'           : '''SELECT Id, Name FROM FragmentTextHits ORDER BY Rank LIMIT ?''',
+  'text_like'           : '''SELECT Id, CASE userdb WHEN 1 THEN Name || '{}' ELSE Name END FROM AllFragments
+                             WHERE (?1 AND Name LIKE ?4) OR (?2 AND Reference LIKE ?4)
+                               OR (?3 AND comment LIKE ?4)
+                             ORDER BY SortKey, SortNum, Id LIMIT ?5'''.format(USER_NAME_SUFFIX),
+  # composition and atom count queries:
+  'clear_composition_query' : '''DELETE FROM temp.CompositionQuery''',
+  'insert_composition_query': '''INSERT INTO temp.CompositionQuery (Element, MinCount, MaxCount)
+                                 VALUES(?, ?, ?)''',
+  'composition_hits'    : '''SELECT Id, Name FROM CompositionHits
+                             WHERE Matched = ?1 AND (NOT ?2 OR ElementCount = ?1)
+                               AND AtomCount BETWEEN ?3 AND ?4
+                             ORDER BY SortKey, SortNum, Id LIMIT ?5''',
+  'atom_count_range'    : '''SELECT Id, CASE userdb WHEN 1 THEN Name || '{}' ELSE Name END FROM AllFragments
+                             WHERE AtomCount BETWEEN ?1 AND ?2
+                             ORDER BY SortKey, SortNum, Id LIMIT ?3'''.format(USER_NAME_SUFFIX),
+  # duplicate search with the geometry fingerprints:
+  'formula_fingerprints': '''SELECT p.FragmentId, CASE f.userdb WHEN 1 THEN f.Name || '{}' ELSE f.Name END,
+                                    p.Histogram
+                             FROM AllFingerprints AS p JOIN AllFragments AS f ON f.Id = p.FragmentId
+                             WHERE p.Formula = ?'''.format(USER_NAME_SUFFIX),
+  'all_fingerprints'    : '''SELECT p.FragmentId, CASE f.userdb WHEN 1 THEN f.Name || '{}' ELSE f.Name END,
+                                    p.Formula, p.Histogram
+                             FROM AllFingerprints AS p JOIN AllFragments AS f ON f.Id = p.FragmentId
+                             ORDER BY p.Formula, p.FragmentId'''.format(USER_NAME_SUFFIX),
+  'shape_candidates'    : '''SELECT f.Id, CASE f.userdb WHEN 1 THEN f.Name || '{}' ELSE f.Name END,
+                                    c.Labels, c.XYZ, p.Histogram
+                             FROM AllFragments AS f
+                               JOIN AllCoordinates AS c ON c.FragmentId = f.Id
+                               JOIN AllFingerprints AS p ON p.FragmentId = f.Id
+                             WHERE f.AtomCount BETWEEN ? AND ?'''.format(USER_NAME_SUFFIX),
+  # substructure search with the graph feature index:
+  'clear_feature_query' : '''DELETE FROM temp.FeatureQuery''',
+  'insert_feature_query': '''INSERT INTO temp.FeatureQuery (Feature) VALUES(?)''',
+  'feature_graphs'      : '''SELECT h.Id, h.Name, c.Labels, b.Bonds, c.XYZ FROM GraphFeatureHits AS h
+                               JOIN AllCoordinates AS c ON c.FragmentId = h.Id
+                               JOIN AllBonds AS b ON b.FragmentId = h.Id
+                             WHERE h.Matched = ? ORDER BY h.SortKey, h.SortNum, h.Id''',
+  'all_graphs'          : '''SELECT f.Id, f.Name, c.Labels, b.Bonds, c.XYZ FROM FragmentList AS f
+                               JOIN AllCoordinates AS c ON c.FragmentId = f.Id
+                               JOIN AllBonds AS b ON b.FragmentId = f.Id''',
+  'fragment_bonds'      : '''SELECT Bonds FROM AllBonds WHERE FragmentId = ?''',
+  # fuzzy name search with the bigram index:
+  'clear_search_bigrams': '''DELETE FROM temp.SearchBigrams''',
+  'insert_search_bigram': '''INSERT INTO temp.SearchBigrams (Bigram, Count) VALUES(?, ?)''',
+  'bigram_hits'         : '''SELECT Id, Name, SortNum, SortKey, BigramCount, Common FROM NameBigramHits
+                             ORDER BY 2.0 * Common / (? + BigramCount) DESC''',
+  'first_by_number'     : '''SELECT Id, Name, SortNum, SortKey FROM FragmentList
+                             ORDER BY SortNum, SortKey, Id LIMIT ?''',
+  # name and class lookups, user fragments have priority:
+  'has_name'            : '''SELECT userdb FROM AllFragments WHERE Name LIKE '%' || ? || '%'
+                             ORDER BY userdb DESC LIMIT 1''',
+  'has_exact_name'      : '''SELECT userdb FROM AllFragments WHERE Name = ? ORDER BY userdb DESC LIMIT 1''',
+  'has_exact_class'     : '''SELECT userdb FROM AllFragments WHERE class = ? LIMIT 1''',
+  # accessors by fragment id:
+  'fragment_id'         : '''SELECT Id FROM AllFragments WHERE Id = ?''',
+  'fragment_atoms'      : '''SELECT Name, element, x, y, z FROM AllAtoms WHERE FragmentId = ? ORDER BY Id''',
+  'fragment_name'       : '''SELECT Name FROM AllFragments WHERE Id = ?''',
+  'fragment_picture'    : '''SELECT picture FROM AllFragments WHERE Id = ?''',
+  'fragment_coordinates': '''SELECT Labels, XYZ FROM AllCoordinates WHERE FragmentId = ?''',
+  'fragment_class'      : '''SELECT class FROM AllFragments WHERE Id = ?''',
+  'fragment_reference'  : '''SELECT Reference FROM AllFragments WHERE Id = ?''',
+  'fragment_restraints' : '''SELECT ShelxName, Atoms FROM AllRestraints WHERE FragmentId = ? ORDER BY Id''',
+  # everything except the picture in one round trip. The first column tells
+  # the row type: 0 = fragment, 1 = atom, 2 = restraint
+  'fragment_bundle'     : '''SELECT 0, Id, Name, class, Reference, NULL, NULL FROM AllFragments WHERE Id = ?1
+                             UNION ALL
+                             SELECT 1, Id, Name, element, x, y, z FROM AllAtoms WHERE FragmentId = ?1
+                             UNION ALL
+                             SELECT 2, Id, ShelxName, Atoms, NULL, NULL, NULL FROM AllRestraints
+                               WHERE FragmentId = ?1
+                             ORDER BY 1, 2''',
+  # modifications of the user database:
+  'delete_user_fragment': '''DELETE FROM userdb.Fragment WHERE Id + {:d} = ?'''.format(USER_ID_OFFSET),
+  'insert_user_fragment': '''INSERT INTO userdb.Fragment (Name, class, Reference, comment, picture,
+                                                      SortKey, SortNum, SearchKey, BigramCount,
+                                                      AtomCount, ElementCount)
+                             VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+  'insert_user_bigram'  : '''INSERT INTO userdb.NameBigrams (FragmentId, Bigram, Count)
+                             VALUES(?, ?, ?)''',
+  'insert_user_composition': '''INSERT INTO userdb.Composition (FragmentId, Element, Count)
+                                VALUES(?, ?, ?)''',
+  'insert_user_coordinates': '''INSERT INTO userdb.Coordinates (FragmentId, Labels, XYZ)
+                                VALUES(?, ?, ?)''',
+  'insert_user_fingerprint': '''INSERT INTO userdb.Fingerprint (FragmentId, Formula, Histogram)
+                                VALUES(?, ?, ?)''',
+  'insert_user_bonds'   : '''INSERT INTO userdb.Bonds (FragmentId, Bonds) VALUES(?, ?)''',
+  'insert_user_feature' : '''INSERT INTO userdb.GraphFeatures (FragmentId, Feature) VALUES(?, ?)''',
+  'insert_user_atom'    : '''INSERT INTO userdb.Atoms (FragmentId, Name, element, x, y, z)
+                             VALUES(?, ?, ?, ?, ?, ?)''',
+  'insert_user_restraint': '''INSERT INTO userdb.Restraints (FragmentId, ShelxName, Atoms)
+                             VALUES(?, ?, ?)''',
+}
+
+
+class ConnectionPool():
+  """
+  Process-wide registry of open database connections. Connections are keyed
+  by the pair (main database path, user database path), so every
+  FragmentTable or Restraints instance on the same files borrows the same
+  connection instead of opening and attaching a new one.
+
+  >>> pool = ConnectionPool()
+  >>> con = pool.acquire(':memory:')
+  >>> con is pool.acquire(':memory:')
+  True
+  >>> len(pool)
+  1
+  >>> pool.close(':memory:')
+  >>> len(pool)
+  0
+  """
+
+  def __init__(self, statement_cache_size=STATEMENT_CACHE_SIZE, read_only=True):
+    self.statement_cache_size = statement_cache_size
+    self.read_only = read_only
+    self._connections = {}
+    self._close_hooks = []
+    # nesting depth of DatabaseRequest.transaction() blocks per connection:
+    self.depths = {}
+    # temporary copies of outdated main databases without Connection.backup():
+    self._temp_files = {}
+
+  @staticmethod
+  def make_key(dbfile, userdb_path=''):
+    """
+    returns the registry key for a pair of database files.
+    """
+    if dbfile != ':memory:':
+      dbfile = os.path.abspath(dbfile)
+    if userdb_path and userdb_path != ':memory:':
+      userdb_path = os.path.abspath(userdb_path)
+    return dbfile, userdb_path or ''
+
+  def _connect(self, dbfile, userdb_path):
+    """
+    opens a new connection and attaches the user database to it.
+    The connection runs in autocommit mode, writes that belong together are
+    grouped with DatabaseRequest.transaction().
+
+    The shipped main database is never written by the handler. In read_only
+    mode it is opened as immutable file without journal and locks and its
+    pages are memory-mapped. Only the attached user database is writable.
+    The main database file must therefore not change while it is open.
+
+    Both databases are brought to the current layout with schema.upgrade().
+    An outdated main database is copied into memory for this in read_only
+    mode. The user database is upgraded in place.
+
+    Python 2 lacks the uri argument and Connection.backup(). There the main
+    database is opened as plain file and an outdated one is copied to a
+    temporary file that is removed in close().
+    """
+    if self.read_only and dbfile != ':memory:':
+      uri = 'file:{}?mode=ro&immutable=1'.format(pathname2url(dbfile))
+      try:
+        con = sqlite3.connect(uri, uri=True, check_same_thread=False, isolation_level=None,
+                              cached_statements=self.statement_cache_size)
+      except TypeError:
+        # Python 2 has no uri argument, the file is opened normally but
+        # still never written:
+        con = sqlite3.connect(dbfile, check_same_thread=False, isolation_level=None,
+                              cached_statements=self.statement_cache_size)
+      if schema_version(con) < SCHEMA_VERSION:
+        con = self._copy_to_memory(con, dbfile)
+      else:
+        con.execute('PRAGMA mmap_size = {:d}'.format(MMAP_SIZE))
+        con.execute('PRAGMA cache_size = {:d}'.format(-PAGE_CACHE_SIZE))
+    else:
+      con = sqlite3.connect(dbfile, check_same_thread=False, isolation_level=None,
+                            cached_statements=self.statement_cache_size)
+    upgrade(con, 'main')
+    if userdb_path:
+      con.execute('ATTACH DATABASE ? AS userdb', (userdb_path,))
+      upgrade(con, 'userdb')
+    con.execute("PRAGMA foreign_keys = ON")
+    self._create_views(con, bool(userdb_path))
+    return con
+
+  def _copy_to_memory(self, con, dbfile):
+    """
+    returns an in-memory copy of the database file dbfile of connection con
+    and closes con.
+    """
+    if not hasattr(con, 'backup'):
+      # Connection.backup() is new in Python 3.7 and iterdump() can not
+      # restore the full text tables, so a file copy has to do:
+      con.close()
+      handle, path = tempfile.mkstemp(suffix='.sqlite')
+      os.close(handle)
+      shutil.copyfile(dbfile, path)
+      copycon = sqlite3.connect(path, check_same_thread=False, isolation_level=None,
+                                cached_statements=self.statement_cache_size)
+      self._temp_files[copycon] = path
+      return copycon
+    memcon = sqlite3.connect(':memory:', check_same_thread=False, isolation_level=None,
+                             cached_statements=self.statement_cache_size)
+    con.backup(memcon)
+    con.close()
+    return memcon
+
+  @staticmethod
+  def _create_views(con, with_userdb):
+    """
+    creates the UNIFIED_VIEWS for a new connection. Without user database
+    the views only show the main database.
+    """
+    # bigrams of the current name search and the current full text query:
+    con.execute('CREATE TEMP TABLE IF NOT EXISTS SearchBigrams '
+                '(Bigram TEXT NOT NULL PRIMARY KEY, Count INTEGER NOT NULL)')
+    con.execute('CREATE TEMP TABLE IF NOT EXISTS TextQuery (Query TEXT)')
+    con.execute('CREATE TEMP TABLE IF NOT EXISTS CompositionQuery '
+                '(Element INTEGER NOT NULL PRIMARY KEY, MinCount INTEGER, MaxCount INTEGER)')
+    con.execute('CREATE TEMP TABLE IF NOT EXISTS FeatureQuery (Feature TEXT NOT NULL PRIMARY KEY)')
+    views = list(UNIFIED_VIEWS)
+    schemas = ['main', 'userdb'] if with_userdb else ['main']
+    if all(has_fulltext(con, schema) for schema in schemas):
+      views.append(TEXT_SEARCH_VIEW)
+    if with_userdb:
+      try:
+        for index in USER_ID_INDEXES:
+          con.execute(index.format(offset=USER_ID_OFFSET))
+      except OperationalError as e:
+        # still works without the indexes, only slower:
+        print(e)
+    for name, main_select, user_select, order in views:
+      select = main_select
+      if with_userdb:
+        user_select = user_select.format(offset=USER_ID_OFFSET, suffix=USER_NAME_SUFFIX)
+        select = ' UNION ALL '.join([main_select, user_select])
+      con.execute('CREATE TEMP VIEW IF NOT EXISTS {} AS {} {}'.format(name, select, order))
+
+  def acquire(self, dbfile, userdb_path=''):
+    """
+    returns the shared connection for dbfile and userdb_path. The connection
+    is opened on first use and stays open until close() or close_all().
+    :param dbfile: main database file
+    :type dbfile: str
+    :param userdb_path: user database file that gets attached as "userdb"
+    :type userdb_path: str
+    """
+    key = self.make_key(dbfile, userdb_path)
+    con = self._connections.get(key)
+    if con is None:
+      con = self._connect(*key)
+      self._connections[key] = con
+    return con
+
+  def close(self, dbfile, userdb_path=''):
+    """
+    commits and closes the connection of dbfile and userdb_path if it is open.
+    The registered close hooks are called with the registry key afterwards.
+    """
+    key = self.make_key(dbfile, userdb_path)
+    con = self._connections.pop(key, None)
+    self.depths.pop(key, None)
+    if con is None:
+      return
+    try:
+      con.commit()
+    finally:
+      con.close()
+      path = self._temp_files.pop(con, None)
+      if path:
+        os.remove(path)
+    for hook in self._close_hooks:
+      hook(key)
+
+  def close_all(self):
+    """
+    closes every open connection. Runs automatically at interpreter exit.
+    """
+    for key in list(self._connections):
+      self.close(*key)
+
+  def register_close_hook(self, hook):
+    """
+    registers a callable hook(key) that runs after a connection was closed.
+    """
+    if hook not in self._close_hooks:
+      self._close_hooks.append(hook)
+
+  def __contains__(self, key):
+    return self.make_key(*key) in self._connections
+
+  def __len__(self):
+    return len(self._connections)
+
+
+connection_pool = ConnectionPool()
+atexit.register(connection_pool.close_all)
 
 
 class DatabaseRequest():
-  def __init__(self, dbfile, userdb_path=False):
+  def __init__(self, dbfile, userdb_path=False, pool=None):
     """
-    creates a connection and the cursor to the SQLite3 database file "dbfile".
+    borrows the connection to the SQLite3 database file "dbfile" from the
+    connection pool and creates a cursor for it.
     :param dbfile: database file
     :type dbfile: str
+    :param pool: connection pool to borrow from, defaults to connection_pool
+    :type pool: ConnectionPool
     """
-    # open the database
-    self.con = sqlite3.connect(dbfile, check_same_thread=False)
-    if userdb_path:
-      self.con.execute('ATTACH "{}" AS userdb'.format(userdb_path))
-    self.con.execute("PRAGMA foreign_keys = ON")
+    self.pool = pool or connection_pool
+    self.key = self.pool.make_key(dbfile, userdb_path)
+    self.userdb = bool(userdb_path)
+    self.con = self.pool.acquire(dbfile, userdb_path)
     # self.con.text_factory = str
     # self.con.text_factory = sqlite3.OptimizedUnicode
-    with self.con:
-      # set the database cursor
-      self.cur = self.con.cursor()
+    # set the database cursor
+    self.cur = self.con.cursor()
 
   def db_request(self, request, *args):
     """
@@ -41,8 +506,9 @@ class DatabaseRequest():
     to insert parameters via "?" into the database request.
     A push request will return the last row-Id.
     A pull request will return the requested rows
-    :param request: sqlite database request like:
+    :param request: name of a statement in QUERIES or a sqlite database request
     """
+    request = QUERIES.get(request, request)
     try:
       if isinstance(args[0], (list, tuple)):
         args = args[0]
@@ -62,10 +528,507 @@ class DatabaseRequest():
     else:
       return rows
 
-  def __del__(self):
-    # commit is very slow:
-    self.con.commit()
-    self.con.close()
+  def db_iter(self, request, *args):
+    """
+    Performs a pull request like db_request(), but returns an iterator over
+    the rows. The rows are read from the database while iterating, so a
+    caller can stop early. Returns an empty iterator on errors.
+    :param request: name of a statement in QUERIES or a sqlite database request
+    """
+    request = QUERIES.get(request, request)
+    try:
+      return self.con.execute(request, args)
+    except OperationalError as e:
+      print(e)
+      print(request, args)
+      return iter([])
+
+  def db_fetchone(self, request, *args):
+    """
+    Performs a pull request like db_request() and returns only the first
+    row, or None if nothing was found.
+    :param request: name of a statement in QUERIES or a sqlite database request
+    """
+    rows = self.db_request(request, *args)
+    if isinstance(rows, list):
+      return rows[0]
+    return None
+
+  def revision(self):
+    """
+    returns the revision of the user database. It increases with every
+    change, also by other connections or processes. The read-only main
+    database has no changing revision.
+    :rtype: int
+    """
+    if not self.userdb:
+      return 0
+    return revision(self.con, 'userdb')
+
+  def db_request_many(self, request, rows):
+    """
+    Executes "request" once for every parameter sequence in rows with
+    executemany(). In contrast to db_request(), errors are raised, so that an
+    enclosing transaction() is rolled back.
+    :param request: name of a statement in QUERIES or a sqlite database request
+    :param rows: list of parameter tuples
+    :type rows: list
+    :rtype: int
+    """
+    request = QUERIES.get(request, request)
+    self.cur.executemany(request, rows)
+    return self.cur.rowcount
+
+  @contextmanager
+  def transaction(self):
+    """
+    Context manager that groups all requests of its block into one atomic
+    write. The changes are committed at the end of the block and rolled back
+    if the block raises. Nested blocks are realized as savepoints, so an inner
+    block can fail without discarding the outer one. The nesting depth is
+    counted per connection in the pool, so requests that share a connection
+    also share the transaction.
+
+    >>> db = DatabaseRequest(':memory:')
+    >>> _ = db.db_request('CREATE TABLE t (a INTEGER)')
+    >>> with db.transaction():
+    ...   db.db_request_many('INSERT INTO t VALUES(?)', [(1,), (2,)])
+    2
+    >>> try:
+    ...   with db.transaction():
+    ...     _ = db.db_request('INSERT INTO t VALUES(3)')
+    ...     raise ValueError('failed')
+    ... except ValueError:
+    ...   pass
+    >>> db.db_request('SELECT COUNT(*) FROM t')
+    [(2,)]
+    """
+    depths = self.pool.depths
+    depth = depths.get(self.key, 0)
+    if depth:
+      self.con.execute('SAVEPOINT fragmentdb')
+    else:
+      self.con.execute('BEGIN IMMEDIATE')
+    depths[self.key] = depth + 1
+    try:
+      yield self
+    except:
+      if depth:
+        self.con.execute('ROLLBACK TO fragmentdb')
+        self.con.execute('RELEASE fragmentdb')
+      else:
+        self.con.execute('ROLLBACK')
+      raise
+    finally:
+      depths[self.key] = depth
+    if depth:
+      self.con.execute('RELEASE fragmentdb')
+    else:
+      self.con.execute('COMMIT')
+
+
+class FragmentBundle():
+  """
+  All information about a single fragment as returned by
+  FragmentTable.get_fragment_bundle(). The picture is only read from the
+  database when it is accessed.
+  """
+
+  def __init__(self, fragment_id, name, resiclass, reference, atoms, restraints, table):
+    self.fragment_id = fragment_id
+    self.name = name
+    self.resiclass = resiclass or ''
+    self.reference = reference
+    # [(name, element, x, y, z), ...]
+    self.atoms = atoms
+    # [(ShelxName, atoms), ...]
+    self.restraints = restraints
+    self._table = table
+    self._program = None
+    self._generated = None
+
+  @property
+  def picture(self):
+    """
+    the picture of the fragment or None
+    """
+    return self._table.get_picture(self.fragment_id)
+
+  def restraint_program(self):
+    """
+    the restraints compiled against the atoms as RestraintProgram. It is
+    compiled only once per bundle.
+    """
+    if self._program is None:
+      self._program = RestraintProgram.compile([row[0] for row in self.atoms],
+                                               [Restraint.from_row(row) for row in self.restraints])
+    return self._program
+
+  def generated_restraints(self):
+    """
+    DFIX, DANG and FLAT restraints from the geometry of the atoms as
+    (ShelxName, Atoms) rows. They are generated only once per bundle.
+    """
+    if self._generated is None:
+      atoms = [AtomRecord.from_row(row) for row in self.atoms]
+      numbers = [atom.element or get_atomic_number(atom.name) for atom in atoms]
+      self._generated = generate_restraints([atom.name for atom in atoms], numbers,
+                                            [atom.xyz for atom in atoms])
+    return self._generated
+
+  def nbytes(self):
+    """
+    returns the approximate memory consumption of the atoms, restraints
+    and texts in bytes.
+    """
+    size = sys.getsizeof(self.name) + sys.getsizeof(self.reference) + sys.getsizeof(self.resiclass)
+    for row in self.atoms + self.restraints:
+      size += sys.getsizeof(row) + sum(sys.getsizeof(item) for item in row)
+    return size
+
+  def __repr__(self):
+    return 'FragmentBundle({}, {!r}, {} atoms, {} restraints)'.format(
+      self.fragment_id, self.name, len(self.atoms), len(self.restraints))
+
+
+class AtomRecord():
+  """
+  An atom of a fragment with atomic number and cartesian coordinates.
+
+  >>> atom = AtomRecord.from_row(('CL1', '17', 1.7008, 0.0, 0.4333))
+  >>> atom
+  AtomRecord('CL1', 17, 1.7008, 0.0, 0.4333)
+  >>> atom.xyz
+  (1.7008, 0.0, 0.4333)
+  """
+  __slots__ = ('name', 'element', 'x', 'y', 'z')
+
+  def __init__(self, name, element, x, y, z):
+    self.name = name
+    self.element = element
+    self.x = x
+    self.y = y
+    self.z = z
+
+  @classmethod
+  def from_row(cls, row):
+    """
+    makes an AtomRecord from a (name, element, x, y, z) row of the database.
+    Elements that are no atomic number become 0.
+    """
+    name, element, x, y, z = row
+    try:
+      element = int(element)
+    except(ValueError, TypeError):
+      element = 0
+    return cls(name, element, x, y, z)
+
+  @property
+  def xyz(self):
+    return self.x, self.y, self.z
+
+  def __repr__(self):
+    return 'AtomRecord({!r}, {}, {}, {}, {})'.format(str(self.name), self.element, self.x, self.y, self.z)
+
+
+class Restraint():
+  """
+  A restraint of a fragment with its atoms and values already split into
+  tokens.
+
+  >>> restr = Restraint.from_row(('SADI', '0.02 C1 F1 C2 F2'))
+  >>> restr.values, restr.atoms
+  ((0.02,), ('C1', 'F1', 'C2', 'F2'))
+  >>> Restraint.from_row(('FLAT', 'C1 > F2')).has_range
+  True
+  """
+  __slots__ = ('card', 'tokens')
+
+  def __init__(self, card, tokens):
+    self.card = card
+    # the atoms text split at white space:
+    self.tokens = tuple(tokens)
+
+  @classmethod
+  def from_row(cls, row):
+    """
+    makes a Restraint from a (ShelxName, Atoms) row of the database.
+    """
+    card, atoms = row
+    return cls(card, (atoms or '').split())
+
+  @property
+  def values(self):
+    """
+    the numbers in front of the atoms, like the distance of DFIX
+    """
+    return tuple(float(i) for i in self.tokens[:self._first_atom()])
+
+  @property
+  def atoms(self):
+    """
+    the atom names including range signs like '>'
+    """
+    return self.tokens[self._first_atom():]
+
+  @property
+  def has_range(self):
+    return '>' in self.tokens or '<' in self.tokens
+
+  @property
+  def text(self):
+    """
+    the tokens as in the Atoms column of the database
+    """
+    return ' '.join(self.tokens)
+
+  def _first_atom(self):
+    for num, token in enumerate(self.tokens):
+      if not token[0].isdigit() and token[0] not in '.-+':
+        return num
+    return len(self.tokens)
+
+  def __repr__(self):
+    return 'Restraint({!r}, {!r})'.format(str(self.card), self.text)
+
+
+class Fragment():
+  """
+  A fragment with AtomRecord atoms and Restraint restraints as returned by
+  FragmentTable.get_fragment_record().
+  """
+  __slots__ = ('fragment_id', 'name', 'resiclass', 'reference', 'atoms', 'restraints')
+
+  def __init__(self, fragment_id, name, resiclass, reference, atoms, restraints):
+    self.fragment_id = fragment_id
+    self.name = name
+    self.resiclass = resiclass or ''
+    self.reference = reference
+    self.atoms = tuple(atoms)
+    self.restraints = tuple(restraints)
+
+  @classmethod
+  def from_bundle(cls, bundle):
+    """
+    makes a Fragment from the database rows of a FragmentBundle.
+    """
+    return cls(bundle.fragment_id, bundle.name, bundle.resiclass, bundle.reference,
+               [AtomRecord.from_row(row) for row in bundle.atoms],
+               [Restraint.from_row(row) for row in bundle.restraints])
+
+  def atom_names(self):
+    return [atom.name for atom in self.atoms]
+
+  def __repr__(self):
+    return 'Fragment({}, {!r}, {} atoms, {} restraints)'.format(
+      self.fragment_id, self.name, len(self.atoms), len(self.restraints))
+
+
+class RestraintProgram():
+  """
+  The restraints of a fragment with the atom names replaced by the positions
+  of the atoms in the atom list and the ranges like 'C1 > C5' expanded.
+  The names are looked up once in a dict, so a fit only has to substitute
+  the ids of the fitted atoms for the positions.
+
+  >>> restraints = [Restraint('SADI', ['0.02', 'C1', 'C2', 'C3', 'C4']), Restraint('SIMU', ['C1', '>', 'C4']),
+  ...               Restraint('FLAT', ['c4', '<', 'C1'])]
+  >>> program = RestraintProgram.compile(['C1', 'C2', 'C3', 'C4'], restraints)
+  >>> program.lines
+  [('SADI', ('0.02', 0, 1, 2, 3)), ('SIMU', (0, 1, 2, 3)), ('FLAT', (3, 2, 1, 0))]
+  >>> program.apply(['11', '12', '13', '14'])
+  [('SADI', '0.02 #c11 #c12 #c13 #c14'), ('SIMU', '#c11 #c12 #c13 #c14'), ('FLAT', '#c14 #c13 #c12 #c11')]
+  >>> program = RestraintProgram.compile(['C1', 'C2'], [Restraint('DFIX', ['1.5', 'C1', 'C2']),
+  ...                                                   Restraint('DFIX', ['1.5', 'C1', 'C9'])])
+  >>> len(program.lines), program.unknown_line
+  (1, 2)
+  >>> program.apply(['11']), program.unknown_line_for(1)
+  ([], 1)
+  """
+  __slots__ = ('lines', 'unknown_line')
+
+  def __init__(self, lines, unknown_line=None):
+    # [(card, items), ...] where items are atom positions or other tokens:
+    self.lines = lines
+    # number of the first restraint line with an unknown atom, starting at 1:
+    self.unknown_line = unknown_line
+
+  @classmethod
+  def compile(cls, atom_names, restraints):
+    """
+    compiles the Restraint restraints against the atom names. The lines after
+    a line with an unknown atom are not compiled.
+    :param atom_names: names of the atoms in the order of the fragment
+    :type atom_names: list
+    :param restraints: list of Restraint
+    :rtype: RestraintProgram
+    """
+    positions = {}
+    for num, name in enumerate(atom_names):
+      positions.setdefault(name.upper(), num)
+    lines = []
+    for num, restraint in enumerate(restraints, 1):
+      items = []
+      try:
+        tokens = iter([token.upper() for token in restraint.tokens])
+        for token in tokens:
+          if token in ('>', '<'):
+            # the atoms between the last one and the next one:
+            start, end = items[-1], positions[next(tokens)]
+            step = 1 if token == '>' else -1
+            items.extend(range(start + step, end, step))
+            items.append(end)
+          elif token[0].isalpha():
+            items.append(positions[token])
+          else:
+            items.append(token)
+      except(KeyError, IndexError, TypeError, StopIteration):
+        return cls(lines, num)
+      lines.append((restraint.card, tuple(items)))
+    return cls(lines)
+
+  def _missing_atom_index(self, count):
+    """
+    returns the index of the first line with an atom beyond the first count
+    atoms or None.
+    """
+    for num, (_, items) in enumerate(self.lines):
+      if any(isinstance(item, int) and item >= count for item in items):
+        return num
+    return None
+
+  def unknown_line_for(self, count):
+    """
+    returns the number of the first restraint line that apply() can not
+    translate for count atoms, starting at 1, or None. Like an unknown atom
+    name, an atom beyond the fitted ones stops the restraints.
+    :param count: number of fitted atoms
+    :type count: int
+    """
+    index = self._missing_atom_index(count)
+    if index is None:
+      return self.unknown_line
+    return index + 1
+
+  def apply(self, atomids):
+    """
+    returns the restraint lines for the atoms with the Olex2 ids atomids in
+    the order of the compiled atom names. The lines from the first one with
+    an atom that has no id are left out, see unknown_line_for().
+    :param atomids: Olex2 atom ids
+    :type atomids: list
+    :rtype: list of (card, atoms) tuples
+    """
+    atoms = ['#c{}'.format(atomid) for atomid in atomids]
+    lines = self.lines
+    index = self._missing_atom_index(len(atoms))
+    if index is not None:
+      lines = lines[:index]
+    return [(card, ' '.join(atoms[item] if isinstance(item, int) else item for item in items))
+            for card, items in lines]
+
+  def __repr__(self):
+    return 'RestraintProgram({} lines)'.format(len(self.lines))
+
+
+class FragmentCache():
+  """
+  Least recently used cache of FragmentBundles, keyed by the database pair
+  and the unified fragment id. It is bounded by the number of entries and by
+  the approximate size of the cached atoms and restraints. Entries of a
+  database are dropped when FragmentTable.refresh() finds a new revision,
+  e.g. after changes from another process.
+
+  >>> cache = FragmentCache(max_entries=2)
+  >>> cache.put(('a', ''), 1, FragmentBundle(1, 'A', '', '', [], [], None))
+  >>> cache.get(('a', ''), 1).name
+  'A'
+  >>> cache.get(('a', ''), 2) is None
+  True
+  >>> cache.stats()['hits'], cache.stats()['misses']
+  (1, 1)
+  """
+
+  def __init__(self, max_entries=FRAGMENT_CACHE_ENTRIES, max_bytes=FRAGMENT_CACHE_BYTES):
+    self.max_entries = max_entries
+    self.max_bytes = max_bytes
+    self._entries = OrderedDict()
+    self._revisions = {}
+    self.nbytes = 0
+    self.hits = 0
+    self.misses = 0
+
+  def get(self, dbkey, fragment_id):
+    """
+    returns the cached bundle or None.
+    """
+    key = (dbkey, fragment_id)
+    try:
+      bundle, size = self._entries.pop(key)
+    except KeyError:
+      self.misses += 1
+      return None
+    # most recently used entries are at the end:
+    self._entries[key] = (bundle, size)
+    self.hits += 1
+    return bundle
+
+  def put(self, dbkey, fragment_id, bundle):
+    """
+    adds a bundle and evicts the least recently used ones if the limits
+    are exceeded.
+    """
+    self.invalidate(dbkey, fragment_id)
+    size = bundle.nbytes()
+    if size > self.max_bytes:
+      return
+    self._entries[(dbkey, fragment_id)] = (bundle, size)
+    self.nbytes += size
+    while len(self._entries) > self.max_entries or self.nbytes > self.max_bytes:
+      _, (_, oldsize) = self._entries.popitem(last=False)
+      self.nbytes -= oldsize
+
+  def invalidate(self, dbkey, fragment_id=None):
+    """
+    removes fragment_id of database dbkey, or all of its fragments if
+    fragment_id is None.
+    """
+    if fragment_id is not None:
+      keys = [(dbkey, fragment_id)]
+    else:
+      keys = [key for key in self._entries if key[0] == dbkey]
+    for key in keys:
+      entry = self._entries.pop(key, None)
+      if entry:
+        self.nbytes -= entry[1]
+
+  def check_revision(self, dbkey, revision):
+    """
+    drops all entries of dbkey if revision differs from the one of the
+    last check. Without an earlier check, the age of the entries is unknown.
+    """
+    if self._revisions.get(dbkey) != revision:
+      self.invalidate(dbkey)
+    self._revisions[dbkey] = revision
+
+  def clear(self):
+    self._entries.clear()
+    self._revisions.clear()
+    self.nbytes = 0
+
+  def stats(self):
+    """
+    returns the hit and miss counters as well as the current size.
+    :rtype: dict
+    """
+    return {'hits'   : self.hits,
+            'misses' : self.misses,
+            'entries': len(self._entries),
+            'bytes'  : self.nbytes}
+
+
+fragment_cache = FragmentCache()
+connection_pool.register_close_hook(fragment_cache.invalidate)
 
 
 class FragmentTable():
@@ -151,15 +1114,7 @@ class FragmentTable():
 
     :rtype: int
     """
-    rows = 0
-    num = 0
-    for table_name in ['Fragment', 'userdb.Fragment']:
-      req = 'SELECT COUNT(*) FROM {}'.format(table_name)
-      try:
-        rows = self.database.db_request(req)[0][0]
-      except TypeError:
-        pass
-      num = num + rows
+    num = self.database.db_fetchone('count_fragments')[0]
     if num:
       return num
     else:
@@ -242,20 +1197,14 @@ class FragmentTable():
     # that list:
     if fragment_id < 0:
       fragment_id = self.get_all_rowids()[fragment_id]
-    # req = '''DELETE FROM Fragment WHERE rowid = ?'''
-    req_usr = '''DELETE FROM userdb.Fragment WHERE rowid = ?'''
     try:
       fragment_id = int(fragment_id)
     except(ValueError, TypeError):
       print('Wrong type. Expected integer.')
-    # actually delete the item:
-    if fragment_id < 1000000:
-      # print('can not delete fragment of main database.')
-      return False
-      # deleted = self.database.db_request(req, fragment_id)
-    else:
-      fragment_id = fragment_id - 1000000
-      deleted = self.database.db_request(req_usr, fragment_id)
+    # actually delete the item. Only the user database is modified, ids of
+    # the main database match no row:
+    deleted = self.database.db_request('delete_user_fragment', fragment_id)
+    fragment_cache.invalidate(self.database.key, fragment_id)
     return deleted
 
   def __iter__(self):
@@ -273,11 +1222,94 @@ class FragmentTable():
     [1000004, u'Acetate anion, C2H3O2-  *user*']
     [47, u'Acetone, C3H6O']
     """
-    all_fragments = self.get_all_fragment_names()
-    if all_fragments:
-      return iter(all_fragments)
-    else:
-      return False
+    return self.iter_fragments()
+
+  def iter_fragments(self, offset=0, limit=-1, name_filter=None):
+    """
+    iterates over [Id, Name] of the fragments in the order of the fragment
+    list. The rows are read from the database while iterating, so only the
+    current row is held in memory.
+
+    >>> dbfile = 'tests/tst1.sqlite'
+    >>> db = FragmentTable(dbfile, 'tests/tst-usr.sqlite')
+    >>> list(db.iter_fragments(offset=1, limit=2))
+    [[1000004, u'Acetate anion, C2H3O2-  *user*'], [47, u'Acetone, C3H6O']]
+    >>> list(db.iter_fragments(name_filter='hexafluorophos'))
+    [[8, u'Hexafluorophosphate, PF6']]
+
+    :param offset: number of fragments to skip
+    :type offset: int
+    :param limit: maximum number of fragments, -1 for all
+    :type limit: int
+    :param name_filter: only fragments with this text in their name, the
+                        suffix of user fragments is not part of the name
+    :type name_filter: str
+    """
+    for row in self.database.db_iter('fragment_page', name_filter or None, limit, offset):
+      yield list(row)
+
+  def iter_fragment_contents(self):
+    """
+    iterates over all fragments of both databases in the order of their ids
+    and yields [Id, Name, atoms, restraints] with the atoms as (Name, x, y, z)
+    and the restraints as (ShelxName, Atoms). Fragments, atoms and restraints
+    are read in three ordered streams that are merged while iterating, so
+    only the current fragment is held in memory.
+
+    >>> dbfile = 'tests/tst1.sqlite'
+    >>> db = FragmentTable(dbfile)
+    >>> fragid, name, atoms, restraints = next(db.iter_fragment_contents())
+    >>> len(atoms[0]), len(restraints[0])
+    (4, 2)
+    >>> sum(1 for _ in db.iter_fragment_contents()) == len(db)
+    True
+    """
+    atoms = groupby(self.database.db_iter('all_atoms'), itemgetter(0))
+    restraints = groupby(self.database.db_iter('all_restraints'), itemgetter(0))
+    next_atoms = next(atoms, None)
+    next_restraints = next(restraints, None)
+    for fragid, name in self.database.db_iter('all_fragment_names'):
+      frag_atoms, next_atoms = self._take_group(fragid, next_atoms, atoms)
+      frag_restraints, next_restraints = self._take_group(fragid, next_restraints, restraints)
+      yield [fragid, name, frag_atoms, frag_restraints]
+
+  @staticmethod
+  def _take_group(fragid, group, groups):
+    """
+    returns the rows of the group of fragid without the fragment id and the
+    next group after it from groups. Groups of fragments that are not in the
+    fragment table are skipped.
+    """
+    rows = []
+    while group is not None and group[0] <= fragid:
+      if group[0] == fragid:
+        rows = [tuple(row[1:]) for row in group[1]]
+      group = next(groups, None)
+    return rows, group
+
+  def get_fragment_page(self, page, page_size=FRAGMENT_PAGE_SIZE, name_filter=None):
+    """
+    returns page number "page" (starting at 0) of the fragment list as list of
+    [Id, Name]. The number of pages is len(self) divided by page_size.
+
+    :param page: number of the page
+    :type page: int
+    :param page_size: fragments per page
+    :type page_size: int
+    :param name_filter: only fragments with this text in their name
+    :type name_filter: str
+    :rtype: list
+    """
+    return list(self.iter_fragments(page * page_size, page_size, name_filter))
+
+  def transaction(self):
+    """
+    Groups several modifications into one atomic write:
+    with db.transaction():
+      db.store_fragment(...)
+      db.store_fragment(...)
+    """
+    return self.database.transaction()
 
   def has_name(self, name):
     """
@@ -290,15 +1322,11 @@ class FragmentTable():
     >>> db.has_name('Benzil')
     False
     """
-    req = '''SELECT Name FROM Fragment WHERE Name like "%{}%" '''.format(name)
-    req_usr = '''SELECT Name FROM userdb.Fragment WHERE Name like "%{}%" '''.format(name)
     # user modifications have highest priority:
-    if self.database.db_request(req_usr):
-      return 'userdb'
-    elif self.database.db_request(req):
-      return True
-    else:
+    row = self.database.db_fetchone('has_name', name)
+    if not row:
       return False
+    return 'userdb' if row[0] else True
 
   def has_exact_name(self, name):
     """
@@ -312,16 +1340,14 @@ class FragmentTable():
 
     >>> db.has_exact_name('Benzene')
     False
+    >>> db.has_exact_name("2,2'-Bipyridine, C10H8N2, bipy")
+    'userdb'
     """
-    req = '''SELECT Name FROM Fragment WHERE Fragment.Name = "{}" '''.format(name)
-    req_usr = '''SELECT Name FROM userdb.Fragment WHERE Fragment.Name = "{}" '''.format(name)
     # user modifications have highest priority:
-    if self.database.db_request(req_usr):
-      return 'userdb'
-    elif self.database.db_request(req):
-      return True
-    else:
+    row = self.database.db_fetchone('has_exact_name', name)
+    if not row:
       return False
+    return 'userdb' if row[0] else True
 
   def has_exact_resi_class(self, resi_class):
     """
@@ -334,12 +1360,7 @@ class FragmentTable():
     >>> db.has_exact_resi_class('Benzene')
     False
     """
-    req = '''SELECT class FROM Fragment WHERE Fragment.class = "{}" '''.format(resi_class)
-    req_usr = '''SELECT class FROM userdb.Fragment WHERE Fragment.class = "{}" '''.format(resi_class)
-    # user modifications have highest priority:
-    if self.database.db_request(req_usr):
-      return True
-    elif self.database.db_request(req):
+    if self.database.db_fetchone('has_exact_class', resi_class):
       return True
     else:
       return False
@@ -363,13 +1384,7 @@ class FragmentTable():
     except TypeError:
       print('Wrong type for database index. Only numbers allowed.')
       return False
-    req = '''SELECT Id FROM Fragment WHERE Fragment.Id = ?'''
-    req_usr = '''SELECT Id FROM userdb.Fragment WHERE Id = ?'''
-    if fragment_id < 1000000:
-      rows = self.database.db_request(req, fragment_id)
-    else:
-      fragment_id = fragment_id - 1000000
-      rows = self.database.db_request(req_usr, fragment_id)
+    rows = self.database.db_fetchone('fragment_id', fragment_id)
     if rows:
       return True
     else:
@@ -385,41 +1400,19 @@ class FragmentTable():
     >>> db.get_all_rowids()
     [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16, 17, 18, 19, 20, 21, 22, 23, 24, 25, 26, 27, 28, 29, 30, 31, 32, 33, 34, 35, 36, 37, 38, 39, 40, 41, 42, 43, 44, 45, 46, 47, 48, 49, 50, 51, 52, 53, 54, 55, 56, 57, 58, 59, 60, 61, 62, 63, 64, 65, 1000001, 1000002, 1000003, 1000004, 1000005, 1000006]
     """
-    req = '''SELECT Id FROM Fragment ORDER BY Id'''
-    req_usr = '''SELECT Id FROM userdb.Fragment ORDER BY Id'''
-    rows = [i[0] for i in self.database.db_request(req)]
+    rows = self.database.db_request('all_ids')
     if not rows:
       return False
-    if self.userdb:
-      rows_usr = self.database.db_request(req_usr)
-      if rows_usr:
-        rows_usr = [i[0] + 1000000 for i in rows_usr]
-        rows = rows + rows_usr
-    return rows
+    return [i[0] for i in rows]
 
   def get_all_fragment_names(self):
     """
     returns all fragment names in the database, sorted by name
     """
-    req = '''SELECT Id, name FROM Fragment'''
-    req_usr = '''SELECT Id, name FROM userdb.Fragment'''
-    rows = [list(i) for i in self.database.db_request(req)]
-    if self.userdb:
-      rows_usr = self.database.db_request(req_usr)
-      if rows_usr:
-        rows_usr = [[i[0] + 1000000, i[1] + '  *user*'] for i in rows_usr]
-        rows.extend(rows_usr)
-    for num, i in enumerate(rows):
-      # searchkey also adds sum formula etc to sortkey:
-      key = make_sortkey(i[1], searchkey=False)
-      rows[num].append(key)
-    if rows:
-      rows.sort(key=lambda x: (x[2][0], x[2][1]))
-      for i in rows:
-        del i[-1]
-      return rows
-    else:
+    rows = self.database.db_request('all_names')
+    if not rows:
       return False
+    return [list(i) for i in rows]
 
   def fragid_toint(self, fragment_id):
     try:
@@ -434,19 +1427,10 @@ class FragmentTable():
     :type fragment_id: int
     :rtype: tuple
     """
-    fragment_id = self.fragid_toint(fragment_id)
-    req_atoms = ("""SELECT Atoms.name, Atoms.element, Atoms.x, Atoms.y, Atoms.z
-                       FROM Fragment, Atoms ON Fragment.Id=Atoms.FragmentId WHERE
-                       Fragment.Id = ?""")
-    req_atoms_usr = '''SELECT userdb.Atoms.name, userdb.Atoms.element, userdb.Atoms.x, 
-            userdb.Atoms.y, userdb.Atoms.z FROM userdb.Fragment, userdb.Atoms ON 
-            userdb.Fragment.Id=userdb.Atoms.FragmentId WHERE Fragment.Id = ?'''
-    if fragment_id < 1000000:
-      atomrows = self.database.db_request(req_atoms, fragment_id)
-    else:
-      fragment_id = fragment_id - 1000000
-      atomrows = self.database.db_request(req_atoms_usr, fragment_id)
-    return atomrows
+    bundle = self._cached_bundle(fragment_id)
+    if not bundle:
+      return False
+    return list(bundle.atoms)
 
   def get_fragment_name(self, fragment_id):
     """
@@ -459,14 +1443,46 @@ class FragmentTable():
     :param fragment_id: id of the fragment in the database
     :type fragment_id: int
     """
+    bundle = self._cached_bundle(fragment_id)
+    if not bundle:
+      raise IndexError('Database fragment not found.')
+    return bundle.name
+
+  def get_coordinates(self, fragment_id, with_labels=False):
+    """
+    returns the cartesian coordinates of the atoms of a fragment, read as one
+    packed BLOB. With numpy, it is a read-only N x 3 float64 array on the
+    BLOB without a copy, otherwise a list of (x, y, z) tuples.
+    The atoms have the same order as in _get_fragment().
+
+    >>> dbfile = 'tests/tst1.sqlite'
+    >>> db = FragmentTable(dbfile)
+    >>> labels, xyz = db.get_coordinates(8, with_labels=True)
+    >>> labels[0], tuple(xyz[0])
+    (u'P1', (0.0, 0.0, -0.0001))
+    >>> db.get_coordinates(999) is None
+    True
+
+    :param fragment_id: id of the fragment in the database
+    :type fragment_id: int
+    :param with_labels: also return the atom names as list
+    :type with_labels: bool
+    :returns: coordinates or (atom names, coordinates), None if the
+              fragment was not found.
+    """
     fragment_id = self.fragid_toint(fragment_id)
-    if fragment_id < 1000000:
-      req_name = '''SELECT Fragment.Name FROM Fragment WHERE Fragment.Id = ? '''
+    row = self.database.db_fetchone('fragment_coordinates', fragment_id)
+    if not row:
+      return None
+    labels, blob = row
+    blob = blob or b''
+    if np is not None:
+      xyz = np.frombuffer(blob, dtype='<f8').reshape(-1, 3)
     else:
-      fragment_id = fragment_id - 1000000
-      req_name = '''SELECT userdb.Fragment.Name FROM userdb.Fragment WHERE Fragment.Id = ? '''
-    name = self.database.db_request(req_name, fragment_id)[0]
-    return name[0]
+      xyz = unpack_coordinates(blob)
+    if with_labels:
+      return (labels or '').split(), xyz
+    return xyz
 
   def get_picture(self, fragment_id):
     """
@@ -480,13 +1496,8 @@ class FragmentTable():
     PNG
     """
     fragment_id = self.fragid_toint(fragment_id)
-    if fragment_id < 1000000:
-      req_picture = '''SELECT picture FROM Fragment WHERE Id = ? '''
-    else:
-      fragment_id = fragment_id - 1000000
-      req_picture = '''SELECT picture FROM userdb.Fragment WHERE Id = ? '''
     try:
-      picture = self.database.db_request(req_picture, fragment_id)[0][0]
+      picture = self.database.db_request('fragment_picture', fragment_id)[0][0]
     except TypeError:
       return None
     return picture
@@ -503,23 +1514,18 @@ class FragmentTable():
     :param fragment_id: id of the fragment in the database
     :type fragment_id: int
     """
-    fragment_id = self.fragid_toint(fragment_id)
-    if fragment_id < 1000000:
-      req_class = '''SELECT class FROM Fragment WHERE Id = ?'''
-    else:
-      fragment_id = fragment_id - 1000000
-      req_class = '''SELECT class FROM userdb.Fragment WHERE Id = ?'''
-    classname = self.database.db_request(req_class, fragment_id)
-    try:
-      classname = classname[0][0]
-    except(IndexError, TypeError):
+    bundle = self._cached_bundle(fragment_id)
+    if not bundle:
       print('Could not find residue class.')
       return ''
-    return str(classname)
+    return str(bundle.resiclass)
 
-  def get_restraints(self, fragment_id):
+  def get_restraints(self, fragment_id, generate=False):
     """
     returns the restraints for Fragment(Id) from the database.
+    With generate, a fragment without restraints gets DFIX, DANG and FLAT
+    restraints from its geometry instead. They are kept in the fragment
+    cache.
 
     >>> dbfile = 'tests/tst1.sqlite'
     >>> db = FragmentTable(dbfile)
@@ -528,15 +1534,15 @@ class FragmentTable():
 
     :param fragment_Id: id of the fragment in the database
     :type fragment_Id: int
+    :param generate: generate restraints if there are none in the database
+    :type generate: bool
     """
-    fragment_id = self.fragid_toint(fragment_id)
-    if fragment_id < 1000000:
-      req_restr = '''SELECT Restraints.ShelxName, Restraints.Atoms FROM Restraints WHERE FragmentId = ?'''
-    else:
-      fragment_id = fragment_id - 1000000
-      req_restr = '''SELECT Restraints.ShelxName, Restraints.Atoms FROM userdb.Restraints WHERE FragmentId = ?'''
-    restraintrows = self.database.db_request(req_restr, fragment_id)
-    return restraintrows
+    bundle = self._cached_bundle(fragment_id)
+    if not bundle:
+      return False
+    if generate and not bundle.restraints:
+      return list(bundle.generated_restraints())
+    return list(bundle.restraints)
 
   def get_reference(self, fragment_id):
     """
@@ -552,18 +1558,135 @@ class FragmentTable():
     :param fragment_Id: id of the fragment in the database
     :type fragment_Id: int
     """
-    fragment_id = self.fragid_toint(fragment_id)
-    if fragment_id < 1000000:
-      req_ref = '''SELECT Reference FROM Fragment WHERE Fragment.Id = ? '''
-    else:
-      fragment_id = fragment_id - 1000000
-      req_ref = '''SELECT Reference FROM userdb.Fragment WHERE Fragment.Id = ? '''
-    rows = self.database.db_request(req_ref, fragment_id)
-    try:
-      ref = rows[0][0]
-      return ref
-    except(TypeError):
+    bundle = self._cached_bundle(fragment_id)
+    if not bundle:
       return 'no reference found'
+    return bundle.reference
+
+  def get_fragment_bundle(self, fragment_id):
+    """
+    returns name, residue class, reference, atoms and restraints of a
+    fragment as FragmentBundle, read in a single database request.
+    Returns None if the fragment does not exist.
+
+    >>> dbfile = 'tests/tst1.sqlite'
+    >>> db = FragmentTable(dbfile, 'tests/tst-usr.sqlite')
+    >>> bundle = db.get_fragment_bundle(8)
+    >>> bundle.name
+    u'Hexafluorophosphate, PF6'
+    >>> bundle.atoms[0]
+    (u'P1', u'15', 0.0, 0.0, -0.0001)
+    >>> db.get_fragment_bundle(999) is None
+    True
+
+    :param fragment_id: id of the fragment in the database
+    :type fragment_id: int
+    :rtype: FragmentBundle
+    """
+    bundle = self._cached_bundle(fragment_id)
+    if not bundle:
+      return None
+    return FragmentBundle(bundle.fragment_id, bundle.name, bundle.resiclass, bundle.reference,
+                          list(bundle.atoms), list(bundle.restraints), self)
+
+  def get_fragment_record(self, fragment_id):
+    """
+    returns the fragment as Fragment with AtomRecord atoms and Restraint
+    restraints, or None if the fragment does not exist.
+
+    >>> dbfile = 'tests/tst1.sqlite'
+    >>> db = FragmentTable(dbfile)
+    >>> frag = db.get_fragment_record(8)
+    >>> frag.atoms[0]
+    AtomRecord('P1', 15, 0.0, 0.0, -0.0001)
+
+    :param fragment_id: id of the fragment in the database
+    :type fragment_id: int
+    :rtype: Fragment
+    """
+    bundle = self._cached_bundle(fragment_id)
+    if not bundle:
+      return None
+    return Fragment.from_bundle(bundle)
+
+  def get_restraint_program(self, fragment_id):
+    """
+    returns the restraints of a fragment as RestraintProgram, or None if the
+    fragment does not exist. The program is kept in the fragment cache
+    together with the fragment.
+
+    >>> dbfile = 'tests/tst1.sqlite'
+    >>> db = FragmentTable(dbfile)
+    >>> db.get_restraint_program(5) is db.get_restraint_program(5)
+    True
+
+    :param fragment_id: id of the fragment in the database
+    :type fragment_id: int
+    :rtype: RestraintProgram
+    """
+    bundle = self._cached_bundle(fragment_id)
+    if not bundle:
+      return None
+    return bundle.restraint_program()
+
+  def _cached_bundle(self, fragment_id):
+    """
+    returns the FragmentBundle of fragment_id from the fragment cache and
+    reads it from the database on a cache miss. The returned bundle is shared
+    and must not be modified.
+    """
+    fragment_id = self.fragid_toint(fragment_id)
+    bundle = fragment_cache.get(self.database.key, fragment_id)
+    if bundle:
+      return bundle
+    rows = self.database.db_request('fragment_bundle', fragment_id)
+    if not isinstance(rows, list) or rows[0][0] != 0:
+      return None
+    _, _, name, resiclass, reference = rows[0][:5]
+    atoms = [tuple(row[2:]) for row in rows if row[0] == 1]
+    restraints = [tuple(row[2:4]) for row in rows if row[0] == 2]
+    bundle = FragmentBundle(fragment_id, name, resiclass, reference, atoms, restraints, self)
+    fragment_cache.put(self.database.key, fragment_id, bundle)
+    return bundle
+
+  def revision(self):
+    """
+    returns the revision of the user database. Anything derived from the
+    fragments, like the fragment list, is still valid as long as the
+    revision stays the same.
+
+    >>> dbfile = 'tests/tst1.sqlite'
+    >>> db = FragmentTable(dbfile, 'tests/tst-usr.sqlite')
+    >>> rev = db.revision()
+    >>> db.revision() == rev
+    True
+    >>> FragmentTable(dbfile).revision()
+    0
+
+    :rtype: int
+    """
+    return self.database.revision()
+
+  def refresh(self):
+    """
+    drops the cached fragments of the databases if the user database was
+    changed by another connection or process since the last refresh. Changes
+    through this handler update the cache immediately. A cache hit does not
+    look at the database, so the plugin calls this once at the start of an
+    action instead.
+    :rtype: int
+    :returns: the current revision
+    """
+    revision = self.revision()
+    fragment_cache.check_revision(self.database.key, revision)
+    return revision
+
+  def cache_stats(self):
+    """
+    returns hits, misses, entries and bytes of the fragment cache.
+    :rtype: dict
+    """
+    return fragment_cache.stats()
 
   def find_fragment_by_name(self, name, selection=5):
     """
@@ -587,24 +1710,292 @@ class FragmentTable():
 
   def _search_name(self, search_string, selection=5):
     """
-    searches the names in the database for a given name
+    searches the names in the database for a given name. Only fragments that
+    share bigrams with search_string are scored, their dice coefficient is the
+    same as dice_coefficient2() of search_string and the search key. Ties are
+    resolved in the order of the fragment list.
     :param search_string: search for this string
     :type search_string: str
     :param selection: return this amount of results
     :type selection: int
     """
+    search = search_string.lower()
+    if len(search) < 2:
+      return self._scan_names(search_string, selection)
+    self.database.db_request('clear_search_bigrams')
+    self.database.db_request_many('insert_search_bigram', name_bigrams(search).items())
+    nbigrams = len(search) - 1
+    hits = []
+    # the hits come with increasing coefficient, all hits up to the
+    # coefficient of the last selected one are needed to resolve ties:
+    for fragid, name, numbers, sortkey, nkey, common in self.database.db_iter('bigram_hits', nbigrams):
+      coefficient = round(1 - float(2 * common) / float(nbigrams + nkey), 6)
+      if len(hits) >= selection and coefficient > hits[selection - 1][0]:
+        break
+      hits.append((coefficient, numbers, sortkey, fragid, name))
+    if len(hits) < selection:
+      # fill up with fragments without any common bigram:
+      found = set(hit[3] for hit in hits)
+      rows = self.database.db_request('first_by_number', selection + len(hits))
+      if isinstance(rows, list):
+        hits.extend((1.0, numbers, sortkey, fragid, name)
+                    for fragid, name, numbers, sortkey in rows if fragid not in found)
+    best = heapq.nsmallest(selection, hits)
+    return [[fragid, name, [coefficient, numbers]] for coefficient, numbers, sortkey, fragid, name in best]
+
+  def _scan_names(self, search_string, selection=5):
+    """
+    compares search_string with the search key of every fragment.
+    """
     search_results = []
-    for i in self:
-      key = make_sortkey(i[1], searchkey=True)
-      coefficient = dice_coefficient2(search_string, key[0] + key[1])
-      i.append([coefficient, key[1]])
-      search_results.append(i)
+    rows = self.database.db_request('all_search_keys')
+    if not isinstance(rows, list):
+      return []
+    for fragid, name, searchkey, numbers in rows:
+      coefficient = dice_coefficient2(search_string, searchkey)
+      search_results.append([fragid, name, [coefficient, numbers]])
     # select the best n results:
     selected_results = sorted(search_results, key=lambda coeff: (coeff[-1][0], coeff[-1][1]), reverse=False)[:selection]
     return selected_results
 
+  def search_text(self, query, fields=('name', 'reference', 'comment'), limit=20):
+    """
+    full text search in the names, references and comments of the fragments.
+    query is an FTS5 query, e.g. 'benz*' for a prefix or 'PF6 OR SbF6'. The
+    hits are ranked with bm25. Without FTS5 in sqlite or if query is no valid
+    FTS5 query, the fields are searched for query as substring instead.
+
+    >>> dbfile = 'tests/tst1.sqlite'
+    >>> db = FragmentTable(dbfile)
+    >>> db.search_text('LIBXUR', fields=['reference'])
+    [[4, u'Acetate anion, C2H3O2-']]
+    >>> db.search_text('pf6', fields=['name'])
+    [[8, u'Hexafluorophosphate, PF6']]
+
+    :param query: what to search for
+    :type query: str
+    :param fields: any of 'name', 'reference' and 'comment'
+    :type fields: list
+    :param limit: return at most this number of hits
+    :type limit: int
+    :rtype: list of [Id, Name]
+    """
+    try:
+      columns = [TEXT_FIELDS[field.lower()] for field in fields]
+    except KeyError as e:
+      raise ValueError('Unknown search field {}.'.format(e))
+    query = query.strip()
+    if not query or not columns:
+      return []
+    rows = None
+    if self.database.db_fetchone('has_text_search'):
+      self.database.db_request('set_text_query', '{{{}}} : ({})'.format(' '.join(columns), query))
+      try:
+        rows = self.database.con.execute(QUERIES['text_hits'], (limit,)).fetchall()
+      except OperationalError:
+        # no valid FTS5 query, e.g. an unbalanced quote, search for the text instead:
+        pass
+    if rows is None:
+      pattern = '%' + query.replace('*', '') + '%'
+      flags = [column in columns for column in ('Name', 'Reference', 'comment')]
+      rows = self.database.db_request('text_like', *(flags + [pattern, limit]))
+    if not isinstance(rows, list):
+      return []
+    return [list(i) for i in rows]
+
+  def find_by_composition(self, formula='', exact=True, min_atoms=0, max_atoms=None, limit=-1):
+    """
+    finds fragments by their element composition and number of atoms.
+    Elements in formula with a number must occur exactly that often, elements
+    without number at least once. With exact=True, the fragments must not
+    contain other elements. Without formula, only the number of atoms counts.
+
+    >>> dbfile = 'tests/tst1.sqlite'
+    >>> db = FragmentTable(dbfile)
+    >>> db.find_by_composition('PF6')
+    [[8, u'Hexafluorophosphate, PF6']]
+    >>> db.find_by_composition('P F', exact=False, max_atoms=10)
+    [[8, u'Hexafluorophosphate, PF6']]
+
+    :param formula: sum formula like 'C6F5' or element symbols like 'P F'
+    :type formula: str
+    :param exact: no other elements than the ones in formula
+    :type exact: bool
+    :param min_atoms: minimum number of atoms
+    :type min_atoms: int
+    :param max_atoms: maximum number of atoms, None for no limit
+    :type max_atoms: int
+    :param limit: return at most this number of fragments, -1 for all
+    :type limit: int
+    :rtype: list of [Id, Name]
+    """
+    elements = formula_to_dict(formula)
+    if max_atoms is None:
+      max_atoms = sys.maxsize
+    if elements:
+      self.database.db_request('clear_composition_query')
+      self.database.db_request_many('insert_composition_query',
+                                    [(number, count or 1, count or sys.maxsize)
+                                     for number, count in elements.items()])
+      rows = self.database.db_request('composition_hits', len(elements), exact, min_atoms,
+                                      max_atoms, limit)
+    else:
+      rows = self.database.db_request('atom_count_range', min_atoms, max_atoms, limit)
+    if not isinstance(rows, list):
+      return []
+    return [list(i) for i in rows]
+
+  def find_near_duplicates(self, atoms, min_similarity=DUPLICATE_SIMILARITY):
+    """
+    finds the fragments that have the same atoms as atoms in a similar
+    geometry. Only the fragments with the same sum formula are compared,
+    they are found by the formula index.
+
+    >>> dbfile = 'tests/tst1.sqlite'
+    >>> db = FragmentTable(dbfile)
+    >>> atoms = [[i[0]] + list(i[2:]) for i in db[8]]
+    >>> [i[:2] for i in db.find_near_duplicates(atoms)]
+    [[8, u'Hexafluorophosphate, PF6']]
+
+    :param atoms: atoms like in store_fragment() with cartesian coordinates
+    :type atoms: list
+    :param min_similarity: minimum similarity of the fingerprints
+    :type min_similarity: float
+    :rtype: list of [Id, Name, similarity], the most similar first
+    """
+    atoms = self._split_atoms(atoms)
+    if not atoms:
+      return []
+    numbers = [get_atomic_number(line[0]) for line in atoms]
+    histogram = geometry_fingerprint(numbers, unpack_coordinates(pack_coordinates(atoms)))
+    found = []
+    for fragid, name, blob in self.database.db_iter('formula_fingerprints', formula_key(numbers)):
+      similarity = fingerprint_similarity(histogram, unpack_fingerprint(blob))
+      if similarity >= min_similarity:
+        found.append([fragid, name, similarity])
+    found.sort(key=lambda x: (-x[2], x[0]))
+    return found
+
+  def find_duplicates(self, min_similarity=DUPLICATE_SIMILARITY):
+    """
+    lists all pairs of fragments in both databases with the same sum formula
+    and a similar geometry, e.g. the same molecule stored twice under a
+    different name.
+
+    :param min_similarity: minimum similarity of the fingerprints
+    :type min_similarity: float
+    :rtype: list of [Id1, Name1, Id2, Name2, similarity]
+    """
+    duplicates = []
+    group = []
+    formula = None
+    for fragid, name, fragformula, blob in self.database.db_iter('all_fingerprints'):
+      if fragformula != formula:
+        group = []
+        formula = fragformula
+      histogram = unpack_fingerprint(blob)
+      for otherid, othername, otherhistogram in group:
+        similarity = fingerprint_similarity(otherhistogram, histogram)
+        if similarity >= min_similarity:
+          duplicates.append([otherid, othername, fragid, name, similarity])
+      group.append((fragid, name, histogram))
+    return duplicates
+
+  def find_fragment_by_shape(self, coords, k=5, names=None, atom_tolerance=2):
+    """
+    finds the k fragments that fit best onto the atoms at coords. Only
+    fragments with about the same number of atoms and the most similar
+    distance histograms are superimposed onto coords. They are ranked by
+    the RMSD of the superposition.
+
+    >>> dbfile = 'tests/tst1.sqlite'
+    >>> db = FragmentTable(dbfile)
+    >>> coords = [i[2:] for i in db[8]]
+    >>> db.find_fragment_by_shape(coords, k=1)[0][:2]
+    [8, u'Hexafluorophosphate, PF6']
+
+    :param coords: cartesian coordinates of the atoms
+    :type coords: list of (x, y, z)
+    :param k: number of results
+    :type k: int
+    :param names: atom names to compare also the elements, e.g. q-peaks match any element
+    :type names: list
+    :param atom_tolerance: the fragments may have this number of atoms more or less
+    :type atom_tolerance: int
+    :rtype: list of [Id, Name, rmsd], the best match first
+    """
+    coords = [tuple(float(value) for value in xyz) for xyz in coords]
+    if len(coords) < 3:
+      print('At least three atoms are needed for a shape search.')
+      return []
+    numbers = [get_atomic_number(name) for name in names] if names else None
+    candidates = []
+    for fragid, name, labels, xyz, blob in self.database.db_iter(
+        'shape_candidates', len(coords) - atom_tolerance, len(coords) + atom_tolerance):
+      labels = labels.split()
+      candidates.append((fragid, name, unpack_coordinates(xyz),
+                         [get_atomic_number(label) for label in labels], unpack_fingerprint(blob)))
+    return rank_by_shape(coords, candidates, k, numbers)
+
+  def get_bonds(self, fragment_id):
+    """
+    returns the bonds of a fragment as pairs of atom names.
+
+    >>> dbfile = 'tests/tst1.sqlite'
+    >>> db = FragmentTable(dbfile)
+    >>> db.get_bonds(8)[:2]
+    [(u'P1', u'F1'), (u'P1', u'F2')]
+
+    :rtype: list of (str, str)
+    """
+    fragment_id = self.fragid_toint(fragment_id)
+    row = self.database.db_fetchone('fragment_bonds', fragment_id)
+    labels = self.get_coordinates(fragment_id, with_labels=True)
+    if not row or not labels:
+      return []
+    labels = labels[0]
+    return [(labels[i], labels[j]) for i, j in unpack_bonds(row[0])]
+
+  def find_substructure(self, substructure, limit=-1):
+    """
+    finds the fragments that contain a substructure, e.g. all fragments with
+    a CF3 group or an aryl ring. Only the fragments that have all bonds and
+    paths of three atoms of the substructure in the feature index are matched
+    atom by atom. Aromatic atoms (lowercase) must lie in a plane and an
+    aromatic ring of the substructure is not found in fused rings.
+
+    >>> dbfile = 'tests/tst1.sqlite'
+    >>> db = FragmentTable(dbfile)
+    >>> db.find_substructure('PF6')
+    [[8, u'Hexafluorophosphate, PF6']]
+
+    :param substructure: name from SUBSTRUCTURES or a simple SMILES like 'C(F)(F)F'
+    :type substructure: str
+    :param limit: return at most this number of fragments, -1 for all
+    :type limit: int
+    :rtype: list of [Id, Name]
+    """
+    query_numbers, query_bonds, query_flat = parse_smiles(SUBSTRUCTURES.get(substructure, substructure))
+    features = graph_features(query_numbers, query_bonds)
+    if features:
+      self.database.db_request('clear_feature_query')
+      self.database.db_request_many('insert_feature_query', [(feature,) for feature in features])
+      rows = self.database.db_iter('feature_graphs', len(features))
+    else:
+      rows = self.database.db_iter('all_graphs')
+    found = []
+    for fragid, name, labels, blob, xyz in rows:
+      numbers = [get_atomic_number(label) for label in labels.split()]
+      coordinates = unpack_coordinates(xyz) if any(query_flat) else None
+      if match_substructure(query_numbers, query_bonds, numbers, unpack_bonds(blob),
+                            query_flat, coordinates) is not None:
+        found.append([fragid, name])
+        if len(found) == limit:
+          break
+    return found
+
   def store_fragment(self, fragment_name=None, atoms=None, resiclass=None, restraints=None,
-                     reference=None, comment=None, picture=None):
+                     reference=None, comment=None, picture=None, allow_duplicates=True):
     """
     Store a complete new fragment into the database. Minimal requirement is a
     fragment name (Full chemical name) and a list of atoms. Restraints,
@@ -622,39 +2013,94 @@ class FragmentTable():
     :type comment: string
     :param picture: a picture of the molecule
     :type picture: binary
+    :param allow_duplicates: False stores nothing if find_near_duplicates() finds
+                             the fragment already
+    :type allow_duplicates: bool
     :rtype int: FragmentId -> last_rowid
     """
     # first stores the meta-information in the Fragment table:
     # The FragmentId is the last_rowid from sqlite
     if not fragment_name or fragment_name == '':
       return None
-    fragmentid = self._fill_fragment_table(fragment_name, resiclass,
-                                           reference, comment, picture)
-    if not fragmentid:
-      raise Exception('No Id obtained during fragment storage.')
-    # then stores atoms with the previously obtained FragmentId
-    self._fill_atom_table(fragmentid, atoms)
-    # in case of supplied restraints store them also:
-    if restraints:
-      self._fill_restraint_table(fragmentid, restraints)
+    if not allow_duplicates:
+      duplicates = self.find_near_duplicates(atoms)
+      if duplicates:
+        print('Fragment "{}" is already in the database as "{}".'.format(fragment_name, duplicates[0][1]))
+        return None
+    atoms = self._split_atoms(atoms)
+    # the atom counts are part of the fragment row, a later update of the row
+    # would count as second change of the revision:
+    atom_count = len(atoms or [])
+    element_count = len(composition([get_atomic_number(line[0]) for line in atoms or []]))
+    # all or nothing, a failure leaves no orphan rows behind:
+    with self.database.transaction():
+      fragmentid = self._fill_fragment_table(fragment_name, resiclass, reference, comment, picture,
+                                             atom_count, element_count)
+      if not fragmentid:
+        raise Exception('No Id obtained during fragment storage.')
+      # then stores atoms with the previously obtained FragmentId
+      self._fill_atom_table(fragmentid, atoms)
+      # in case of supplied restraints store them also:
+      if restraints:
+        self._fill_restraint_table(fragmentid, restraints)
+    # ids of deleted user fragments are reused:
+    fragment_cache.invalidate(self.database.key, fragmentid)
     return fragmentid
 
+  def store_fragments(self, fragments):
+    """
+    Stores a batch of fragments in one transaction. Either all fragments
+    end up in the database or none of them.
+
+    :param fragments: list of dictionaries with the keyword arguments of
+                      store_fragment(), e.g. {'fragment_name': 'Benzene', 'atoms': [...]}
+    :type fragments: list of dict
+    :rtype list: FragmentIds of the stored fragments
+    """
+    with self.database.transaction():
+      return [self.store_fragment(**frag) for frag in fragments]
+
   def _fill_fragment_table(self, fragment_name, resiclass=None,
-                           reference=None, comment=None, picture=None):
+                           reference=None, comment=None, picture=None, atom_count=0, element_count=0):
     """
     Fills a fragment into the database.
     :param fragment_name: Nam eof the Fragment
     :type fragment_name: str
     :param comment: any comment about the fragment
     :type comment: str
+    :param atom_count: number of atoms of the fragment
+    :type atom_count: int
+    :param element_count: number of different elements of the fragment
+    :type element_count: int
     :rtype list: last_rowid
     """
     if picture:
       picture = sqlite3.Binary(picture)
-    table = (fragment_name, resiclass, reference, comment, picture)
-    req = '''INSERT INTO userdb.Fragment (name, class, reference, comment, picture)  VALUES(?, ?, ?, ?, ?)'''
-    fragid = self.database.db_request(req, table)
-    return fragid + 1000000
+    keys = fragment_keys(fragment_name, userdb=True)
+    bigrams = name_bigrams(keys[2])
+    table = (fragment_name, resiclass, reference, comment, picture) + keys + \
+            (sum(bigrams.values()), atom_count, element_count)
+    fragid = self.database.db_request('insert_user_fragment', table)
+    if not fragid:
+      return False
+    self.database.db_request_many('insert_user_bigram',
+                                  [(fragid, bigram, count) for bigram, count in bigrams.items()])
+    return fragid + USER_ID_OFFSET
+
+  @staticmethod
+  def _split_atoms(atom_table):
+    """
+    returns the atoms of atom_table as lists, atoms given as strings are
+    split at the spaces.
+    """
+    if not atom_table:
+      return atom_table
+    if not isinstance(atom_table[0], (list, tuple)):
+      if isinstance(atom_table[0], str):
+        atom_table = [i.split() for i in atom_table]
+      else:
+        raise Exception('wrong data type "{}" for atom list.'.format(type(atom_table[0])))
+    return atom_table
 
   def _fill_atom_table(self, fragment_id, atom_table):
     """
@@ -670,24 +2116,30 @@ class FragmentTable():
     # test wether atom_table is a list or list of list, because we want no string
     # in a list here.
     fragment_id = int(fragment_id)
-    if fragment_id > 1000000:
-      fragment_id = fragment_id - 1000000
+    if fragment_id > USER_ID_OFFSET:
+      fragment_id = fragment_id - USER_ID_OFFSET
     if not atom_table or not fragment_id:
       print('No atoms supplied! Doing nothing')
       return
-    if not isinstance(atom_table[0], (list, tuple)):
-      if isinstance(atom_table[0], str):
-        atom_table = [i.split() for i in atom_table]
-      else:
-        raise Exception('wrong data type "{}" for atom list.'.format(type(atom_table[0])))
-    for line in atom_table:
-      Name = line[0]
-      element = 999  # line[1]
-      x = line[1]
-      y = line[2]
-      z = line[3]
-      req = '''INSERT INTO userdb.atoms (FragmentId, Name, element, x, y, z) VALUES(?, ?, ?, ?, ?, ?)'''
-      self.database.db_request(req, (fragment_id, Name, element, x, y, z))
+    atom_table = self._split_atoms(atom_table)
+    # the element is derived from the atom name, 999 if it is unknown:
+    numbers = [get_atomic_number(line[0]) for line in atom_table]
+    rows = [(fragment_id, line[0], str(number or 999), line[1], line[2], line[3])
+            for line, number in zip(atom_table, numbers)]
+    self.database.db_request_many('insert_user_atom', rows)
+    counts = composition(numbers)
+    self.database.db_request_many('insert_user_composition',
+                                  [(fragment_id, number, count) for number, count in counts.items()])
+    labels = ' '.join(str(line[0]) for line in atom_table)
+    xyz = pack_coordinates([line[1:4] for line in atom_table])
+    self.database.db_request_many('insert_user_coordinates', [(fragment_id, labels, sqlite3.Binary(xyz))])
+    histogram = geometry_fingerprint(numbers, unpack_coordinates(xyz))
+    self.database.db_request_many('insert_user_fingerprint', [(fragment_id, formula_key(numbers),
+                                                            sqlite3.Binary(pack_fingerprint(histogram)))])
+    bonds = bond_graph(numbers, unpack_coordinates(xyz))
+    self.database.db_request_many('insert_user_bonds', [(fragment_id, sqlite3.Binary(pack_bonds(bonds)))])
+    self.database.db_request_many('insert_user_feature',
+                                  [(fragment_id, feature) for feature in graph_features(numbers, bonds)])
 
   def _fill_restraint_table(self, fragment_id, restraints_list):
     """
@@ -703,8 +2155,8 @@ class FragmentTable():
     """
     # test if restraint_list is a list of strings. we dont want list of list here.
     fragment_id = int(fragment_id)
-    if fragment_id > 1000000:
-      fragment_id = fragment_id - 1000000
+    if fragment_id > USER_ID_OFFSET:
+      fragment_id = fragment_id - USER_ID_OFFSET
     try:
       restraints_list[0]  # is there even one restraint?
     except KeyError:
@@ -718,14 +2170,9 @@ class FragmentTable():
     else:
       raise Exception('wrong data type "{}" for restraint list.'.format(
         type(restraints_list[0])))
-    for line in restraints_list:
-      restr_table = []
-      if line[:4] in SHX_CARDS:
-        restr_table.append(str(fragment_id))
-        restr_table.append(line[:4])
-        restr_table.append(line[5:])
-        req = '''INSERT INTO userdb.Restraints (FragmentId, ShelxName, atoms) VALUES(?, ?, ?)'''
-        self.database.db_request(req, restr_table)
+    rows = [(str(fragment_id), line[:4], line[5:]) for line in restraints_list
+            if line[:4] in SHX_CARDS]
+    self.database.db_request_many('insert_user_restraint', rows)
 
 
 class Restraints():
@@ -754,12 +2201,7 @@ class Restraints():
 
     """
     fragment_id = self.fragid_toint(fragment_id)
-    if fragment_id < 1000000:
-      req_restr = '''SELECT Restraints.ShelxName, Restraints.Atoms FROM Restraints WHERE FragmentId = ?'''
-    else:
-      fragment_id = fragment_id - 1000000
-      req_restr = '''SELECT Restraints.ShelxName, Restraints.Atoms FROM userdb.Restraints WHERE FragmentId = ?'''
-    restraintrows = self.database.db_request(req_restr, fragment_id)
+    restraintrows = self.database.db_request('fragment_restraints', fragment_id)
     return restraintrows
 
 
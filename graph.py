@@ -0,0 +1,490 @@
+'''
+Created on 18.10.2026
+
+Bond graphs of the fragments and the search for substructures in them.
+The bonds are derived once from the covalent radii when a fragment is
+stored. A substructure query first selects the fragments that contain all
+paths of up to three atoms of the query from an index and then matches the
+query atom by atom against the remaining graphs. With numpy, the distances of
+a block of atoms to their neighbours are calculated in one array operation.
+
+here are only functions that are completely independent of olex
+'''
+from __future__ import print_function
+
+import math
+import re
+import struct
+
+from FragmentDB.helper_functions import ELEMENTS
+
+try:
+  import numpy as np
+except ImportError:
+  np = None
+
+__metaclass__ = type  # use new-style classes
+
+# Covalent radii in Angstrom by atomic number (B. Cordero et al., Dalton
+# Trans. 2008, 2832-2838). Elements after Cm use DEFAULT_RADIUS:
+COVALENT_RADII = (
+  0.31, 0.28, 1.28, 0.96, 0.84, 0.76, 0.71, 0.66, 0.57, 0.58, 1.66, 1.41, 1.21, 1.11, 1.07,
+  1.05, 1.02, 1.06, 2.03, 1.76, 1.70, 1.60, 1.53, 1.39, 1.39, 1.32, 1.26, 1.24, 1.32, 1.22,
+  1.22, 1.20, 1.19, 1.20, 1.20, 1.16, 2.20, 1.95, 1.90, 1.75, 1.64, 1.54, 1.47, 1.46, 1.42,
+  1.39, 1.45, 1.44, 1.42, 1.39, 1.39, 1.38, 1.39, 1.40, 2.44, 2.15, 2.07, 2.04, 2.03, 2.01,
+  1.99, 1.98, 1.98, 1.96, 1.94, 1.92, 1.92, 1.89, 1.90, 1.87, 1.87, 1.75, 1.70, 1.62, 1.51,
+  1.44, 1.41, 1.36, 1.36, 1.32, 1.45, 1.46, 1.48, 1.40, 1.50, 1.50, 2.60, 2.21, 2.15, 2.06,
+  2.00, 1.96, 1.90, 1.87, 1.80, 1.69)
+# Radius of elements without table entry and of atoms of unknown element:
+DEFAULT_RADIUS = 0.75
+# Two atoms are bonded if they are closer than the sum of their radii plus:
+BOND_TOLERANCE = 0.4
+# Largest RMS distance in Angstrom of aromatic atoms from their common plane:
+FLAT_TOLERANCE = 0.1
+# Number of atoms whose distances to their neighbours are calculated at once:
+BOND_BLOCK = 128
+
+# Substructures for find_substructure() by name:
+SUBSTRUCTURES = {
+  'CF3'      : 'C(F)(F)F',
+  'CCl3'     : 'C(Cl)(Cl)Cl',
+  'aryl'     : 'c1ccccc1',
+  'pyridyl'  : 'n1ccccc1',
+  'carboxyl' : 'C(O)O',
+  'tBu'      : 'C(C)(C)C',
+  'SO3'      : 'S(O)(O)O',
+  'PF6'      : 'P(F)(F)(F)(F)(F)F',
+}
+
+_SMILES_TOKEN = re.compile(r'\[([A-Za-z][a-z]?)[^\]]*\]|(Cl|Br|[BCNOPSFI]|[bcnops]|\*)|(\d)|([()])|([-=#:.])')
+
+
+def covalent_radius(number):
+  """
+  returns the covalent radius of the element with atomic number number.
+
+  >>> covalent_radius(6)
+  0.76
+  >>> covalent_radius(0)
+  0.75
+  """
+  if 0 < number <= len(COVALENT_RADII):
+    return COVALENT_RADII[number - 1]
+  return DEFAULT_RADIUS
+
+
+def bond_graph(numbers, coordinates, tolerance=BOND_TOLERANCE):
+  """
+  returns the bonds between the atoms as sorted list of index pairs. Two
+  atoms are bonded if their distance is less than the sum of their covalent
+  radii plus tolerance. Atoms without coordinates have no bonds.
+  With numpy, the distances of BOND_BLOCK atoms to all atoms within the
+  longest possible bond along x are compared in one step. Otherwise only
+  atoms in the same or in neighbouring cells of a grid are compared, the grid
+  spacing is the longest possible bond.
+
+  >>> bond_graph([6, 6, 9, 1], [(0, 0, 0), (1.52, 0, 0), (2.0, 1.2, 0), (5, 5, 5)])
+  [(0, 1), (1, 2)]
+
+  :param numbers: atomic numbers of the atoms
+  :type numbers: list
+  :param coordinates: cartesian (x, y, z) of the atoms
+  :type coordinates: list
+  :rtype: list of (int, int)
+  """
+  if np is not None:
+    return _bond_graph_blocks(numbers, coordinates, tolerance)
+  radii = [covalent_radius(number) for number in numbers]
+  atoms = [i for i, xyz in enumerate(coordinates)
+           if not any(value is None or math.isnan(value) for value in xyz)]
+  if not atoms:
+    return []
+  spacing = 2 * max(radii[i] for i in atoms) + tolerance
+  cells = {}
+  for i in atoms:
+    key = tuple(int(math.floor(value / spacing)) for value in coordinates[i])
+    cells.setdefault(key, []).append(i)
+  bonds = []
+  for (cx, cy, cz), members in cells.items():
+    for dx in (-1, 0, 1):
+      for dy in (-1, 0, 1):
+        for dz in (-1, 0, 1):
+          others = cells.get((cx + dx, cy + dy, cz + dz))
+          if not others:
+            continue
+          for i in members:
+            xi, yi, zi = coordinates[i]
+            for j in others:
+              if j <= i:
+                continue
+              xj, yj, zj = coordinates[j]
+              limit = radii[i] + radii[j] + tolerance
+              if (xi - xj) ** 2 + (yi - yj) ** 2 + (zi - zj) ** 2 < limit * limit:
+                bonds.append((i, j))
+  bonds.sort()
+  return bonds
+
+
+def _bond_graph_blocks(numbers, coordinates, tolerance):
+  xyz = np.asarray(coordinates, dtype=float).reshape(-1, 3)
+  radii = np.array([covalent_radius(number) for number in numbers], dtype=float)
+  atoms = np.flatnonzero(~np.isnan(xyz).any(axis=1))
+  if not len(atoms):
+    return []
+  spacing = 2 * radii[atoms].max() + tolerance
+  # sorted along x, a block of atoms only needs to be compared with the
+  # atoms in the slab that is one bond length wider:
+  atoms = atoms[np.argsort(xyz[atoms, 0], kind='mergesort')]
+  xsorted = xyz[atoms, 0]
+  bonds = []
+  for start in range(0, len(atoms), BOND_BLOCK):
+    block = atoms[start:start + BOND_BLOCK]
+    end = np.searchsorted(xsorted, xsorted[start + len(block) - 1] + spacing, side='right')
+    others = atoms[start:end]
+    delta = xyz[block, np.newaxis, :] - xyz[np.newaxis, others, :]
+    limit = radii[block, np.newaxis] + radii[np.newaxis, others] + tolerance
+    hits = np.einsum('ijk,ijk->ij', delta, delta) < limit * limit
+    # every pair only once:
+    hits &= np.arange(len(block))[:, np.newaxis] < np.arange(len(others))[np.newaxis, :]
+    first, second = np.nonzero(hits)
+    first, second = block[first], others[second]
+    bonds.extend(zip(np.minimum(first, second).tolist(), np.maximum(first, second).tolist()))
+  bonds.sort()
+  return bonds
+
+
+def pack_bonds(bonds):
+  """
+  packs the index pairs of bond_graph() into little-endian uint16 bytes.
+
+  >>> unpack_bonds(pack_bonds([(0, 1), (1, 2)]))
+  [(0, 1), (1, 2)]
+  """
+  values = [index for bond in bonds for index in bond]
+  return struct.pack('<{:d}H'.format(len(values)), *values)
+
+
+def unpack_bonds(blob):
+  """
+  returns the bonds from pack_bonds().
+  """
+  values = struct.unpack('<{:d}H'.format(len(blob) // 2), blob)
+  return [(values[i], values[i + 1]) for i in range(0, len(values), 2)]
+
+
+def neighbours(size, bonds):
+  """
+  returns the set of bonded atoms for every atom of a graph.
+
+  >>> neighbours(3, [(0, 1), (1, 2)])
+  [{1}, {0, 2}, {1}]
+  """
+  adjacency = [set() for _ in range(size)]
+  for i, j in bonds:
+    adjacency[i].add(j)
+    adjacency[j].add(i)
+  return adjacency
+
+
+def ring_bond_counts(size, bonds):
+  """
+  returns for every atom the number of its bonds that are part of a ring.
+  These are all bonds except the bridges of the graph, which are found in
+  one depth-first search.
+
+  >>> ring_bond_counts(6, [(0, 1), (1, 2), (0, 2), (2, 3), (3, 4), (3, 5)])
+  [2, 2, 2, 0, 0, 0]
+  """
+  adjacency = neighbours(size, bonds)
+  order = [None] * size
+  low = [0] * size
+  bridges = set()
+  counter = 0
+  for root in range(size):
+    if order[root] is not None:
+      continue
+    order[root] = low[root] = counter
+    counter += 1
+    stack = [(root, None, iter(adjacency[root]))]
+    while stack:
+      atom, parent, others = stack[-1]
+      for other in others:
+        if other == parent:
+          continue
+        if order[other] is None:
+          order[other] = low[other] = counter
+          counter += 1
+          stack.append((other, atom, iter(adjacency[other])))
+          break
+        low[atom] = min(low[atom], order[other])
+      else:
+        stack.pop()
+        if parent is not None:
+          low[parent] = min(low[parent], low[atom])
+          if low[atom] > order[parent]:
+            bridges.add((min(atom, parent), max(atom, parent)))
+  counts = [0] * size
+  for i, j in bonds:
+    if (min(i, j), max(i, j)) not in bridges:
+      counts[i] += 1
+      counts[j] += 1
+  return counts
+
+
+def _symbol(number):
+  if 0 < number <= len(ELEMENTS):
+    return ELEMENTS[number - 1]
+  return '*'
+
+
+def graph_features(numbers, bonds):
+  """
+  returns the canonical names of all bonds and all paths of three atoms in
+  the graph, like 'C-F' and 'F-C-F'. Every feature of a substructure is also
+  a feature of each fragment that contains it, this makes them an index for
+  the substructure search. Atoms of unknown element are left out.
+
+  >>> sorted(graph_features([6, 9, 9, 9], [(0, 1), (0, 2), (0, 3)]))
+  ['C-F', 'F-C-F']
+
+  :rtype: set
+  """
+  adjacency = neighbours(len(numbers), bonds)
+  features = set()
+  for i, j in bonds:
+    if numbers[i] and numbers[j]:
+      features.add('-'.join(sorted((_symbol(numbers[i]), _symbol(numbers[j])))))
+  for center, bonded in enumerate(adjacency):
+    if not numbers[center]:
+      continue
+    ends = sorted(_symbol(numbers[i]) for i in bonded if numbers[i])
+    for a in range(len(ends)):
+      for b in range(a + 1, len(ends)):
+        features.add('-'.join((ends[a], _symbol(numbers[center]), ends[b])))
+  return features
+
+
+def plane_deviation(coordinates):
+  """
+  returns the RMS distance of the points from their best plane. It is the
+  square root of the smallest eigenvalue of their covariance matrix.
+
+  >>> round(plane_deviation([(0, 0, 0), (1, 0, 0), (0, 1, 0), (1, 1, 0)]), 6)
+  0.0
+  >>> round(plane_deviation([(0, 0, 0), (1, 0, 0), (0, 1, 0), (0, 0, 1)]), 3)
+  0.25
+  """
+  n = float(len(coordinates))
+  center = [sum(xyz[i] for xyz in coordinates) / n for i in range(3)]
+  c = [[sum((xyz[i] - center[i]) * (xyz[j] - center[j]) for xyz in coordinates) / n
+        for j in range(3)] for i in range(3)]
+  p1 = c[0][1] ** 2 + c[0][2] ** 2 + c[1][2] ** 2
+  if p1 == 0:
+    return math.sqrt(max(min(c[0][0], c[1][1], c[2][2]), 0.0))
+  # eigenvalues of a symmetric 3x3 matrix in closed form:
+  q = (c[0][0] + c[1][1] + c[2][2]) / 3.0
+  p = math.sqrt(((c[0][0] - q) ** 2 + (c[1][1] - q) ** 2 + (c[2][2] - q) ** 2 + 2 * p1) / 6.0)
+  b = [[(c[i][j] - (q if i == j else 0.0)) / p for j in range(3)] for i in range(3)]
+  r = (b[0][0] * (b[1][1] * b[2][2] - b[1][2] * b[2][1]) -
+       b[0][1] * (b[1][0] * b[2][2] - b[1][2] * b[2][0]) +
+       b[0][2] * (b[1][0] * b[2][1] - b[1][1] * b[2][0])) / 2.0
+  phi = math.acos(max(-1.0, min(1.0, r))) / 3.0
+  smallest = q + 2 * p * math.cos(phi + 2 * math.pi / 3)
+  return math.sqrt(max(smallest, 0.0))
+
+
+def parse_smiles(smiles):
+  """
+  reads a substructure in a simple SMILES notation: element symbols of the
+  organic subset or in brackets, '*' for any atom, branches in parentheses
+  and ring closure digits. Atoms with lowercase (aromatic) symbols must lie
+  in a plane, bond orders and hydrogen atoms are ignored.
+
+  >>> parse_smiles('C(F)(F)F')
+  ([6, 9, 9, 9], [(0, 1), (0, 2), (0, 3)], [False, False, False, False])
+  >>> parse_smiles('c1ccccc1')[1]
+  [(0, 1), (0, 5), (1, 2), (2, 3), (3, 4), (4, 5)]
+  >>> parse_smiles('C(F')
+  Traceback (most recent call last):
+  ...
+  ValueError: Invalid substructure "C(F".
+
+  :rtype: tuple
+  :returns: (atomic numbers, bonds, aromatic flags)
+  """
+  numbers = []
+  aromatic = []
+  bonds = set()
+  branches = []
+  rings = {}
+  previous = None
+  position = 0
+  smiles = smiles.strip()
+  while position < len(smiles):
+    match = _SMILES_TOKEN.match(smiles, position)
+    if not match:
+      raise ValueError('Invalid substructure "{}".'.format(smiles))
+    position = match.end()
+    bracket, organic, digit, paren, _ = match.groups()
+    if bracket or organic:
+      symbol = (bracket or organic).capitalize()
+      if symbol == '*':
+        numbers.append(0)
+      elif symbol in ELEMENTS:
+        numbers.append(ELEMENTS.index(symbol) + 1)
+      else:
+        raise ValueError('Unknown element "{}" in substructure.'.format(symbol))
+      aromatic.append(bool(organic) and organic.islower())
+      atom = len(numbers) - 1
+      if previous is not None:
+        bonds.add((previous, atom))
+      previous = atom
+    elif digit:
+      if previous is None:
+        raise ValueError('Invalid substructure "{}".'.format(smiles))
+      if digit in rings:
+        bonds.add(tuple(sorted((rings.pop(digit), previous))))
+      else:
+        rings[digit] = previous
+    elif paren == '(':
+      if previous is None:
+        raise ValueError('Invalid substructure "{}".'.format(smiles))
+      branches.append(previous)
+    elif paren == ')':
+      if not branches:
+        raise ValueError('Invalid substructure "{}".'.format(smiles))
+      previous = branches.pop()
+  if branches or rings or not numbers:
+    raise ValueError('Invalid substructure "{}".'.format(smiles))
+  return numbers, sorted(bonds), aromatic
+
+
+def _match_order(adjacency, numbers):
+  """
+  returns the atoms of a query graph in an order where every atom after
+  the first of a connected part is bonded to an earlier one, and its parent.
+  """
+  order = []
+  parents = {}
+  seen = set()
+  # start with the atoms with most bonds and a known element:
+  for start in sorted(range(len(numbers)), key=lambda i: (not numbers[i], -len(adjacency[i]), i)):
+    if start in seen:
+      continue
+    seen.add(start)
+    parents[start] = None
+    queue = [start]
+    while queue:
+      atom = queue.pop(0)
+      order.append(atom)
+      for other in sorted(adjacency[atom]):
+        if other not in seen:
+          seen.add(other)
+          parents[other] = atom
+          queue.append(other)
+  return order, parents
+
+
+def _flat_groups(adjacency, flat):
+  """
+  returns the connected groups of the flat atoms of a query.
+  """
+  groups = []
+  seen = set()
+  for start in range(len(flat)):
+    if not flat[start] or start in seen:
+      continue
+    group = [start]
+    seen.add(start)
+    for atom in group:
+      for other in adjacency[atom]:
+        if flat[other] and other not in seen:
+          seen.add(other)
+          group.append(other)
+    groups.append(group)
+  return groups
+
+
+def match_substructure(query_numbers, query_bonds, numbers, bonds, query_flat=None, coordinates=None):
+  """
+  returns the first assignment of the query atoms to atoms of the graph
+  that keeps all bonds of the query, or None. Atoms of the query with
+  element 0 match any atom. Flat query atoms in a ring must have as many
+  ring bonds in the graph as in the query, so a single aromatic ring does
+  not match fused rings. With coordinates, the atoms assigned to each
+  connected group of flat query atoms must lie in a plane.
+
+  >>> match_substructure([6, 9, 9, 9], [(0, 1), (0, 2), (0, 3)],
+  ...                    [6, 6, 9, 9, 9], [(0, 1), (1, 2), (1, 3), (1, 4)])
+  [1, 2, 3, 4]
+  >>> match_substructure([6, 9], [(0, 1)], [6, 6], [(0, 1)]) is None
+  True
+
+  An aryl ring is neither found in naphthalene nor in the fullerene C60:
+
+  >>> aryl = parse_smiles(SUBSTRUCTURES['aryl'])
+  >>> match_substructure(aryl[0], aryl[1], *parse_smiles('Cc1ccccc1')[:2], query_flat=aryl[2])
+  [1, 2, 3, 4, 5, 6]
+  >>> match_substructure(aryl[0], aryl[1], *parse_smiles('c1ccc2ccccc2c1')[:2], query_flat=aryl[2]) is None
+  True
+  >>> phi = (1 + 5 ** 0.5) / 2
+  >>> c60 = set()
+  >>> for point in [(0, 1, 3 * phi), (1, 2 + phi, 2 * phi), (phi, 2, phi ** 3)]:
+  ...   for signs in [(a, b, c) for a in (1, -1) for b in (1, -1) for c in (1, -1)]:
+  ...     for shift in range(3):
+  ...       c60.add(tuple(round(0.71 * signs[k] * point[(k + shift) % 3], 4) for k in range(3)))
+  >>> c60 = sorted(c60)
+  >>> bonds = bond_graph([6] * 60, c60)
+  >>> len(c60), len(bonds)
+  (60, 90)
+  >>> match_substructure(aryl[0], aryl[1], [6] * 60, bonds, aryl[2], c60) is None
+  True
+
+  :param query_flat: True for the atoms of the query that must be flat
+  :type query_flat: list
+  :param coordinates: cartesian coordinates of the atoms of the graph
+  :type coordinates: list
+
+  :rtype: list
+  :returns: atom of the graph for each query atom
+  """
+  query_adjacency = neighbours(len(query_numbers), query_bonds)
+  adjacency = neighbours(len(numbers), bonds)
+  query_rings = ring_bond_counts(len(query_numbers), query_bonds) if query_flat else []
+  rings = ring_bond_counts(len(numbers), bonds) if any(query_rings) else []
+  order, parents = _match_order(query_adjacency, query_numbers)
+  groups = _flat_groups(query_adjacency, query_flat) if query_flat and coordinates else []
+  mapping = {}
+  used = set()
+
+  def fits(qatom, atom):
+    if atom in used:
+      return False
+    if query_numbers[qatom] and query_numbers[qatom] != numbers[atom]:
+      return False
+    if len(adjacency[atom]) < len(query_adjacency[qatom]):
+      return False
+    if query_flat and query_flat[qatom] and query_rings[qatom] and rings[atom] != query_rings[qatom]:
+      return False
+    return all(mapping[other] in adjacency[atom] for other in query_adjacency[qatom] if other in mapping)
+
+  def extend(depth):
+    if depth == len(order):
+      return all(plane_deviation([coordinates[mapping[i]] for i in group]) < FLAT_TOLERANCE
+                 for group in groups if len(group) > 3)
+    qatom = order[depth]
+    parent = parents[qatom]
+    candidates = adjacency[mapping[parent]] if parent is not None else range(len(numbers))
+    for atom in sorted(candidates):
+      if fits(qatom, atom):
+        mapping[qatom] = atom
+        used.add(atom)
+        if extend(depth + 1):
+          return True
+        del mapping[qatom]
+        used.discard(atom)
+    return False
+
+  if not extend(0):
+    return None
+  return [mapping[i] for i in range(len(query_numbers))]
@@ -7,11 +7,19 @@ here are only functions that are completely independent of olex
 '''
 from __future__ import print_function
 
+import re
 import string
+import itertools
 from collections import Counter
-from copy import deepcopy
 from math import radians, cos, sqrt, sin
 
+from FragmentDB.stats import mean, median, std_dev, describe, nalimov_test
+
+try:
+  import numpy as np
+except ImportError:
+  np = None
+
 # import ast
 
 SHX_CARDS = ('TITL', 'CELL', 'ZERR', 'LATT', 'SYMM', 'SFAC', 'UNIT', 'LIST',
@@ -37,6 +45,16 @@ IMPL_RESTRAINT_CARDS = ('SAME', 'SADI', 'DFIX', 'BUMP', 'DANG', 'FLAT', 'TRIA',
 ABS_RESTR_CARDS = ('DFIX', 'DANG', 'BUMP', 'TRIA', 'CHIV')
 REL_RESTR_CARDS = ('SAME', 'SADI', 'SIMU', 'RIGU', 'ISOR', 'NCSY', 'FLAT', 'DELU')
 
+# element symbols in the order of their atomic number:
+ELEMENTS = ('H', 'He', 'Li', 'Be', 'B', 'C', 'N', 'O', 'F', 'Ne', 'Na', 'Mg', 'Al',
+            'Si', 'P', 'S', 'Cl', 'Ar', 'K', 'Ca', 'Sc', 'Ti', 'V', 'Cr', 'Mn', 'Fe',
+            'Co', 'Ni', 'Cu', 'Zn', 'Ga', 'Ge', 'As', 'Se', 'Br', 'Kr', 'Rb', 'Sr', 'Y',
+            'Zr', 'Nb', 'Mo', 'Tc', 'Ru', 'Rh', 'Pd', 'Ag', 'Cd', 'In', 'Sn', 'Sb', 'Te',
+            'I', 'Xe', 'Cs', 'Ba', 'La', 'Ce', 'Pr', 'Nd', 'Pm', 'Sm', 'Eu', 'Gd', 'Tb',
+            'Dy', 'Ho', 'Er', 'Tm', 'Yb', 'Lu', 'Hf', 'Ta', 'W', 'Re', 'Os', 'Ir', 'Pt',
+            'Au', 'Hg', 'Tl', 'Pb', 'Bi', 'Po', 'At', 'Rn', 'Fr', 'Ra', 'Ac', 'Th', 'Pa',
+            'U', 'Np', 'Pu', 'Am', 'Cm', 'Bk', 'Cf', 'Es', 'Fm', 'Md', 'No', 'Lr')
+
 
 def make_sortkey(full_name, searchkey=False):
   """
@@ -96,20 +114,237 @@ def atomic_distance(p1, p2, cell):
   >>> atomic_distance(coord1, coord2, cell)
   1.5729229943265979
   """
-  cell = [float(y) for y in cell]
-  a, b, c = cell[:3]
-  al = radians(cell[3])
-  be = radians(cell[4])
-  ga = radians(cell[5])
-  x1, y1, z1 = p1
-  x2, y2, z2 = p2
-  dx = (x1 - x2)
-  dy = (y1 - y2)
-  dz = (z1 - z2)
-  dsq = (a * dx) ** 2 + (b * dy) ** 2 + \
-        (c * dz) ** 2 + 2 * b * c * cos(al) * dy * dz + \
-        2 * dx * dz * a * c * cos(be) + 2 * dx * dy * a * b * cos(ga)
-  return (sqrt(dsq))
+  return cell_geometry(cell).distance(p1, p2)
+
+
+class CellGeometry():
+  """
+  Geometry of a unit cell. The metric tensor and the orthogonalization
+  matrix are calculated once per cell, the distance functions only multiply
+  with them. The batched functions work on numpy arrays if numpy is
+  available and on lists otherwise.
+
+  >>> geometry = CellGeometry((10.5086, 20.9035, 20.5072, 90, 94.13, 90))
+  >>> coord1 = (-0.186843,   0.282708,   0.526803)
+  >>> coord2 = (-0.155278,   0.264593,   0.600644)
+  >>> geometry.distance(coord1, coord2)
+  1.5729229943265979
+  >>> [round(float(d), 4) for d in geometry.distances([coord1, coord2], coord1)]
+  [0.0, 1.5729]
+  >>> [[round(float(d), 4) for d in row] for row in geometry.pairwise_distances([coord1], [coord1, coord2])]
+  [[0.0, 1.5729]]
+  >>> geometry.to_cartesian(coord1)
+  (-2.741505423999065, 5.909586678000002, 10.775200700893734)
+  >>> [round(float(x), 6) for x in geometry.to_fractional(geometry.to_cartesian(coord1))]
+  [-0.186843, 0.282708, 0.526803]
+  """
+
+  def __init__(self, cell):
+    """
+    :param cell: a, b, c, alpha, beta, gamma
+    :type cell: list
+    """
+    self.cell = tuple(float(y) for y in cell)
+    a, b, c = self.cell[:3]
+    al, be, ga = [radians(y) for y in self.cell[3:]]
+    self.metric = ((a * a, a * b * cos(ga), a * c * cos(be)),
+                   (a * b * cos(ga), b * b, b * c * cos(al)),
+                   (a * c * cos(be), b * c * cos(al), c * c))
+    cosastar = (cos(be) * cos(ga) - cos(al)) / (sin(be) * sin(ga))
+    sinastar = sqrt(1 - cosastar ** 2)
+    self.orthogonalization = ((a, b * cos(ga), c * cos(be)),
+                              (0.0, b * sin(ga), -c * sin(be) * cosastar),
+                              (0.0, 0.0, c * sin(be) * sinastar))
+    self.volume = a * b * c * sqrt(1 - cos(al) ** 2 - cos(be) ** 2 - cos(ga) ** 2 +
+                                   2 * cos(al) * cos(be) * cos(ga))
+    # lengths of a*, b* and c*, the reciprocals of the distances between the
+    # lattice planes:
+    self.reciprocal_lengths = (b * c * sin(al) / self.volume,
+                               a * c * sin(be) / self.volume,
+                               a * b * sin(ga) / self.volume)
+    self.orthogonal = all(abs(angle - 90.0) < 1e-6 for angle in self.cell[3:])
+    # the inverse of the upper triangular orthogonalization matrix:
+    m = self.orthogonalization
+    self.deorthogonalization = ((1 / m[0][0], -m[0][1] / (m[0][0] * m[1][1]),
+                                 (m[0][1] * m[1][2] - m[0][2] * m[1][1]) / (m[0][0] * m[1][1] * m[2][2])),
+                                (0.0, 1 / m[1][1], -m[1][2] / (m[1][1] * m[2][2])),
+                                (0.0, 0.0, 1 / m[2][2]))
+    if np is not None:
+      self._metric = np.array(self.metric)
+      self._orthogonalization = np.array(self.orthogonalization)
+      self._deorthogonalization = np.array(self.deorthogonalization)
+
+  def distance(self, p1, p2):
+    """
+    returns the distance between the fractional coordinates p1 and p2.
+    """
+    g = self.metric
+    dx = p1[0] - p2[0]
+    dy = p1[1] - p2[1]
+    dz = p1[2] - p2[2]
+    dsq = (self.cell[0] * dx) ** 2 + (self.cell[1] * dy) ** 2 + (self.cell[2] * dz) ** 2 + \
+          2 * g[1][2] * dy * dz + 2 * g[0][2] * dx * dz + 2 * g[0][1] * dx * dy
+    return sqrt(dsq)
+
+  def distances(self, points, origin):
+    """
+    returns the distances of all fractional coordinates in points to origin.
+    """
+    if np is not None:
+      delta = np.asarray(points, dtype=float).reshape(-1, 3) - np.asarray(origin, dtype=float)
+      return np.sqrt(np.einsum('ij,jk,ik->i', delta, self._metric, delta))
+    return [self.distance(point, origin) for point in points]
+
+  def pairwise_distances(self, points1, points2):
+    """
+    returns the matrix of the distances between all fractional coordinates in
+    points1 (rows) and points2 (columns).
+    """
+    if np is not None:
+      delta = (np.asarray(points1, dtype=float).reshape(-1, 1, 3) -
+               np.asarray(points2, dtype=float).reshape(1, -1, 3))
+      return np.sqrt(np.einsum('ijk,kl,ijl->ij', delta, self._metric, delta))
+    return [[self.distance(p1, p2) for p2 in points2] for p1 in points1]
+
+  def to_cartesian(self, frac_coord):
+    """
+    converts fractional coordinates to cartesian coordinates like
+    frac_to_cart().
+    """
+    m = self.orthogonalization
+    x, y, z = frac_coord
+    return (m[0][0] * x + m[0][1] * y + m[0][2] * z,
+            0 + m[1][1] * y + m[1][2] * z,
+            0 + 0 + m[2][2] * z)
+
+  def to_fractional(self, cart_coord):
+    """
+    converts cartesian coordinates to fractional coordinates.
+    """
+    m = self.deorthogonalization
+    x, y, z = cart_coord
+    return (m[0][0] * x + m[0][1] * y + m[0][2] * z,
+            m[1][1] * y + m[1][2] * z,
+            m[2][2] * z)
+
+  def to_cartesian_many(self, frac_coords):
+    """
+    converts a list or an array of fractional coordinates to cartesian
+    coordinates in one step.
+    """
+    if np is not None:
+      return np.asarray(frac_coords, dtype=float).reshape(-1, 3).dot(self._orthogonalization.T)
+    return [self.to_cartesian(coord) for coord in frac_coords]
+
+  def to_fractional_many(self, cart_coords):
+    """
+    converts a list or an array of cartesian coordinates to fractional
+    coordinates in one step.
+    """
+    if np is not None:
+      return np.asarray(cart_coords, dtype=float).reshape(-1, 3).dot(self._deorthogonalization.T)
+    return [self.to_fractional(coord) for coord in cart_coords]
+
+
+# CellGeometry objects of the recently used cells:
+_cell_geometries = {}
+
+
+def cell_geometry(cell):
+  """
+  returns the CellGeometry of cell. It is only calculated again for a new
+  cell.
+  """
+  key = tuple(float(y) for y in cell)
+  geometry = _cell_geometries.get(key)
+  if geometry is None:
+    if len(_cell_geometries) > 32:
+      _cell_geometries.clear()
+    geometry = _cell_geometries[key] = CellGeometry(key)
+  return geometry
+
+
+class PeriodicCellList():
+  """
+  Spatial index of atoms in a crystal for the search of neighbours within a
+  radius. The fractional coordinates are sorted into a grid of bins that are
+  at least radius wide, so only the atoms in the 27 bins around a query
+  point are compared. The grid wraps around at the cell edges, atoms are
+  also found through lattice translations.
+
+  >>> index = PeriodicCellList([(0.95, 0.5, 0.5), (0.5, 0.5, 0.5)], (10, 10, 10, 90, 90, 90), 1.2)
+  >>> index.query((0.02, 0.5, 0.5))
+  [0]
+  >>> sorted(index.query_many([(0.02, 0.5, 0.5), (0.55, 0.5, 0.5)]))
+  [0, 1]
+  """
+
+  def __init__(self, points, cell, radius):
+    """
+    :param points: fractional coordinates of the atoms
+    :type points: list
+    :param cell: a, b, c, alpha, beta, gamma
+    :type cell: list
+    :param radius: largest search radius in Angstrom
+    :type radius: float
+    """
+    self.geometry = cell_geometry(cell)
+    self.radius = float(radius)
+    self.points = [tuple(float(value) for value in point) for point in points]
+    # bins along each axis, at least radius wide perpendicular to the axis:
+    self.shape = tuple(max(1, int(1.0 / (self.radius * length)))
+                       for length in self.geometry.reciprocal_lengths)
+    self.bins = {}
+    for num, point in enumerate(self.points):
+      self.bins.setdefault(self._bin(point), []).append(num)
+
+  def _bin(self, point):
+    return tuple(int((value % 1.0) * size) % size for value, size in zip(point, self.shape))
+
+  def _shortest(self, delta):
+    """
+    returns the shortest length of the fractional vector delta under lattice
+    translations.
+    """
+    delta = [value - round(value) for value in delta]
+    shortest = self.geometry.distance(delta, (0, 0, 0))
+    if shortest >= self.radius and not self.geometry.orthogonal:
+      # in oblique cells, a neighbouring translation can be shorter:
+      for shift in itertools.product((-1, 0, 1), repeat=3):
+        if any(shift):
+          shifted = [value + move for value, move in zip(delta, shift)]
+          shortest = min(shortest, self.geometry.distance(shifted, (0, 0, 0)))
+    return shortest
+
+  def query(self, point, radius=None):
+    """
+    returns the indices of the atoms closer than radius to point, radius must
+    not be larger than the radius of the index.
+
+    :param point: fractional coordinates
+    :rtype: list
+    """
+    radius = self.radius if radius is None else min(float(radius), self.radius)
+    center = self._bin(point)
+    axes = [sorted(set((c + d) % size for d in (-1, 0, 1))) for c, size in zip(center, self.shape)]
+    found = []
+    for key in itertools.product(*axes):
+      for num in self.bins.get(key, ()):
+        other = self.points[num]
+        delta = (point[0] - other[0], point[1] - other[1], point[2] - other[2])
+        if self._shortest(delta) < radius:
+          found.append(num)
+    return sorted(found)
+
+  def query_many(self, points, radius=None):
+    """
+    returns the indices of the atoms closer than radius to any of points.
+    :rtype: set
+    """
+    found = set()
+    for point in points:
+      found.update(self.query(point, radius))
+    return found
 
 
 def dice_coefficient2(a, b, case_insens=True):
@@ -173,6 +408,41 @@ def dice_coefficient2(a, b, case_insens=True):
   return round(score, 6)
 
 
+# kinds of RestraintFinding of sadi_findings() that make a SADI restraint
+# line unusable:
+SADI_ERRORS = ('unknown_atom', 'outlier', 'deviation')
+
+
+class RestraintFinding():
+  """
+  A problem in the atoms or restraints of a fragment as found by
+  restraint_findings() or sadi_findings(). line is the number of the
+  restraint line starting at 1, or 0 for problems of the atoms list.
+  """
+  __slots__ = ('kind', 'line', 'pairs', 'distances', 'message')
+
+  def __init__(self, kind, line, message, pairs=(), distances=()):
+    self.kind = kind
+    self.line = line
+    self.message = message
+    # the atom pairs and their distances the finding is about:
+    self.pairs = tuple(pairs)
+    self.distances = tuple(distances)
+
+  def __str__(self):
+    return self.message
+
+  def as_dict(self):
+    """
+    returns the finding as dict for a JSON report.
+    """
+    return {'kind': self.kind, 'line': self.line, 'message': self.message,
+            'pairs': [list(pair) for pair in self.pairs], 'distances': list(self.distances)}
+
+  def __repr__(self):
+    return 'RestraintFinding({!r}, {}, {!r})'.format(self.kind, self.line, self.pairs)
+
+
 def check_restraints_consistency(restraints, atoms, fragment_name):
   """
   - Checks if the Atomnames in the restraints of the dbhead are also in
@@ -189,46 +459,66 @@ def check_restraints_consistency(restraints, atoms, fragment_name):
   if not restraints:
     print('No restraints found!')
     return True
-  status = True
-  atoms = [i[0].upper() for i in atoms]
+  findings = restraint_findings(restraints, atoms, fragment_name)
+  for finding in findings:
+    print('\n' + finding.message)
+    if finding.kind == 'invalid_card':
+      print(' '.join(restraints[finding.line - 1]).upper())
+    elif finding.kind == 'unknown_atom':
+      print('Please remove non-existent atoms from the restraint list!')
+  if findings:
+    print('Check database entry.\n')
+  return not findings
+
+
+def restraint_findings(restraints, atoms, fragment_name=''):
+  """
+  returns the duplicate atoms of a fragment, the invalid restraint cards and
+  the atoms in restraints that are not in the atoms list as RestraintFinding
+  with the kinds 'duplicate_atom', 'invalid_card' and 'unknown_atom'.
+  :param restraints: list of restraint lines like [['SADI', 'C1', 'C2'], ...]
+  :type restraints: list
+  :param atoms: list of atoms in the fragment
+  :type atoms: list
+  :param fragment_name: fragment name
+  :type fragment_name: string
+  :rtype: list of RestraintFinding
+
+  >>> atoms = [['C1', 0, 0, 0], ['C2', 1, 0, 0], ['c2', 0, 1, 0]]
+  >>> restraint_findings([['DFIX', '1.5', 'C1', 'C3'], ['FOO', 'C1'], []], atoms)
+  [RestraintFinding('duplicate_atom', 0, ()), RestraintFinding('invalid_card', 2, ()), RestraintFinding('unknown_atom', 1, ())]
+  """
+  findings = []
+  names = [i[0].upper() for i in atoms]
   # check for duplicates:
-  if len(set(atoms)) != len(atoms):
-    c1 = Counter(atoms)
-    c2 = Counter(set(atoms))
-    diff = c1 - c2
-    duplicates = list(diff.elements())
-    for i in duplicates:
-      print('\nDuplicate atom "{}" found!\n'.format(duplicates.pop()))
-      status = 'False'
+  for name, count in sorted(Counter(names).items()):
+    if count > 1:
+      findings.append(RestraintFinding('duplicate_atom', 0, 'Duplicate atom "{}" found!'.format(name)))
   # check if restraint cards are valid
-  restraint_atoms_list = set([])
-  for line in restraints:
+  restraint_atoms = {}
+  for num, line in enumerate(restraints, 1):
     if not line:
       continue
     line = [i.upper() for i in line]
     # only the first 4 characters, because SADI_TOL would be bad:
     if line[0][:4] not in SHX_CARDS:
-      status = False
-      print('\nInvalid line in restraints list of "{}" found!'.format(fragment_name))
-      print(' '.join(line))
-    if line[0][:4].upper() in RESTRAINT_CARDS:
+      message = 'Invalid line in restraints list of "{}" found!'.format(fragment_name)
+      findings.append(RestraintFinding('invalid_card', num, message))
+    if line[0][:4] in RESTRAINT_CARDS:
       for i in line[1:]:
         if i in ('>', '<'):
           continue
         try:
           float(i)
         except(ValueError):
-          restraint_atoms_list.add(i)
-  # check if restrained atoms are in th eatom list:
-  for atom in restraint_atoms_list:
-    atom = atom.upper()
-    if not atom in atoms:
-      status = False
-      print('\nUnknown atom "{}" in restraints of "{}".'.format(atom, fragment_name))
-      print('Please remove non-existent atoms from the restraint list!')
-  if not status:
-    print('Check database entry.\n')
-  return status
+          restraint_atoms.setdefault(i, num)
+  # check if restrained atoms are in the atom list:
+  names = set(names)
+  for atom, num in sorted(restraint_atoms.items(), key=lambda item: (item[1], item[0])):
+    if atom not in names:
+      message = 'Unknown atom "{}" in restraints of "{}".'.format(atom, fragment_name)
+      findings.append(RestraintFinding('unknown_atom', num, message))
+  return findings
 
 
 def pairwise(iterable):
@@ -243,170 +533,98 @@ def pairwise(iterable):
   return list(zip(a, a))
 
 
-def mean(values):
-  """
-  returns mean value of a list of numbers
-
-  >>> mean([1, 2, 3, 4, 1, 2, 3, 4])
-  2.5
-  >>> round(mean([1, 2, 3, 4, 1, 2, 3, 4.1, 1000000]), 4)
-  111113.3444
-  """
-  return sum(values) / float(len(values))
-
-
-def median(nums):
-  """
-  calculates the median of a list of numbers
-  >>> median([1, 2, 3, 4, 1, 2, 3, 4, 1, 2, 3, 4])
-  2.5
-  >>> median([1, 2, 3, 4, 1, 2, 3, 4, 1, 2, 3, 4.1, 1000000])
-  3
-  >>> median([])
-  Traceback (most recent call last):
-  ...
-  ValueError: Need a non-empty iterable
-  """
-  ls = sorted(nums)
-  n = len(ls)
-  if n == 0:
-    raise ValueError("Need a non-empty iterable")
-  # for uneven list length:
-  elif n % 2 == 1:
-    # // is floordiv:
-    return ls[n // 2]
-  else:
-    return sum(ls[int(n / 2 - 1):int(n / 2 + 1)]) / 2.0
-
-
-def std_dev(data):
-  """
-  returns standard deviation of values rounded to pl decimal places
-  S = sqrt( (sum(x-xm)^2) / n-1 )
-  xm = sum(x)/n
-  :param values: list with integer or float values
-  :type values: list
-  :param pl: round to n places
-  :type pl: integer
-
-  >>> round(std_dev([1.234, 1.222, 1.345, 1.451, 1.000, 1.234, 1.321, 1.222]), 8)
-  0.1303522
-  """
-  if len(data) == 0:
-    return 0
-  K = data[0]
-  n = 0
-  Sum = 0
-  Sum_sqr = 0
-  for x in data:
-    n = n + 1
-    Sum += x - K
-    Sum_sqr += (x - K) * (x - K)
-  variance = (Sum_sqr - (Sum * Sum) / n) / (n - 1)
-  # use n instead of (n-1) if want to compute the exact variance of the given data
-  # use (n-1) if data are samples of a larger population
-  return sqrt(variance)
-
-
-def check_sadi_consistence(atoms, restr, cell, fragment):
+def sadi_findings(atoms, restr, cell, fragment=''):
   """
   check if same distance restraints make sense. Each length of an atom
   pair is tested agains the standard deviation of all distances.
   For a large standard deviation, the list is tested for outliers.
+  The median and standard deviation are calculated once per restraint line.
   :param atoms: atoms list of the fragment ['C1', x, y, z]
-  :param restraints: restraints list
+  :param restr: restraints list
+  :param cell: unit cell of the atom coordinates
   :param fragment: frag name
-  :param factor: factor for confidence interval
+  :rtype: list of RestraintFinding
+
+  >>> atoms = [['C1', 0, 0, 0], ['F1', 0.133, 0, 0], ['F2', 0, 0.134, 0], ['F3', 0, 0, 0.133], ['F4', 0, 0, -0.2]]
+  >>> restr = [['SADI', 'C1', 'F1', 'C1', 'F2', 'C1', 'F3', 'C1', 'F4'], ['DFIX', '1.3', 'C1', 'F1']]
+  >>> findings = sadi_findings(atoms, restr, (10, 10, 10, 90, 90, 90), 'CF4')
+  >>> findings
+  [RestraintFinding('outlier', 1, (('C1', 'F4'),))]
+  >>> print(findings[0])
+  Suspicious deviation in atom pair "C1 F4" (2.000 A, median: 1.335) of SADI line 1.
+  >>> sadi_findings(atoms, [['SADI', 'C1', 'F1', 'C1', 'F2', 'C1', 'F2', 'C1', 'X9']], (10, 10, 10, 90, 90, 90))
+  [RestraintFinding('duplicate_pair', 1, (('C1', 'F2'),)), RestraintFinding('unknown_atom', 1, (('C1', 'X9'),))]
   """
-  restraints = deepcopy(restr)
-  atnames = [i[0].upper() for i in atoms]
-  for num, line in enumerate(restraints):
-    prefixes = []
+  findings = []
+  index = {}
+  for num, atom in enumerate(atoms):
+    index.setdefault(atom[0].upper(), num)
+  geometry = cell_geometry(cell)
+  for num, line in enumerate(restr, 1):
+    if not line or line[0].upper() != 'SADI':
+      continue
+    line = line[1:]
     dev = 0.02
+    if line and not str(line[0][0]).isalpha():
+      dev = line[0]
+      line = line[1:]  # the standard deviation
     if not line:
       continue
-    if line[0].upper() == 'SADI':
-      prefixes.append(line[0])
-      del line[0]
+    if len(line) % 2 == 1:  # test for uneven atoms count
+      message = 'Inconsistent SADI restraint line {} of "{}". Not all atoms form a pair.'.format(num, fragment)
+      findings.append(RestraintFinding('odd_atoms', num, message))
+    pairs = pairwise(line)
+    if len(pairs) <= 2:
+      continue
+    known = set()
+    distances = []
+    for pair in pairs:
+      if pair in known or tuple(reversed(pair)) in known:
+        message = 'Duplicate atom pair "{}" in SADI restraint line {} of "{}".'.format(' '.join(pair), num, fragment)
+        findings.append(RestraintFinding('duplicate_pair', num, message, [pair]))
+      known.add(pair)
       try:
-        if not str(line[0][0]).isalpha():
-          prefixes.append(line[0])
-          dev = line[0]
-          del line[0]  # delete standard deviation
-      except(IndexError):
-        return
-      if len(line) % 2 == 1:  # test for uneven atoms count
-        print('Inconsistent SADI restraint line {} of "{}". Not all atoms form a pair.'.format(num, fragment))
-      pairs = pairwise(line)
-      distances = []
-      pairlist = []
-      if len(pairs) <= 2:
-        return True
-      for i in pairs:
-        if i in pairlist or tuple(reversed(i)) in pairlist:
-          print('Duplicate atom pair "{}" in SADI restraint line {} of "{}".'.format(" ".join(i), num, fragment))
-        pairlist.append(i)
-        try:
-          a = atoms[atnames.index(i[0])][1:4]
-          b = atoms[atnames.index(i[1])][1:4]
-        except(ValueError):
-          return False
-        dist = atomic_distance(a, b, cell)
-        distances.append(dist)
-      stdev = std_dev(distances)
+        a = atoms[index[pair[0].upper()]][1:4]
+        b = atoms[index[pair[1].upper()]][1:4]
+      except(KeyError):
+        message = 'Unknown atom in pair "{}" of SADI line {} of "{}".'.format(' '.join(pair), num, fragment)
+        findings.append(RestraintFinding('unknown_atom', num, message, [pair]))
+        break
+      distances.append(geometry.distance([float(i) for i in a], [float(i) for i in b]))
+    else:
+      center, stdev = describe(distances)
       # only do outlier test if standard deviation is suspiciously large:
-      if stdev > 0.065:
-        outliers = nalimov_test(distances)
-        if outliers:
-          print("\n{}:".format(fragment))
-          for x in outliers:
-            pair = ' '.join(pairlist[x])
-            print('Suspicious deviation in atom pair "{}" ({:4.3f} A, '
-                  'median: {:4.3f}) of SADI line {}.'.format(pair, distances[x], median(distances), num + 1))
-            print(' '.join(restr[num])[:60], '...')
-          return False
-      if stdev > 2.5 * float(dev):
-        print("\nFragment {}:".format(fragment))
-        print(
-          'Suspicious restraints in SADI line {} with high standard deviation {:4.3f} (median length: {:4.3f} A).'.format(
-            num + 1, stdev, median(distances)))
-        print(' '.join(prefixes + line))
-        return False
-  return True
-
-
-def nalimov_test(data):
-  """
-  returns a index list of outliers base on the Nalimov test for data.
-  Modified implementation of:
-  "R. Kaiser, G. Gottschalk, Elementare Tests zur Beurteilung von Messdaten
-  Bibliographisches Institut, Mannheim 1972."
-
-  >>> data = [1.120, 1.234, 1.224, 1.469, 1.145, 1.222, 1.123, 1.223, 1.2654, 1.221, 1.215]
-  >>> nalimov_test(data)
-  [3]
-  >>> round(std_dev(data), 5)
-  0.09444
-  """
-  # q-values for degrees of freedom:
-  f = {1: 1.409, 2: 1.645, 3: 1.757, 4: 1.814, 5: 1.848, 6: 1.870, 7: 1.885, 8: 1.895,
-       9: 1.903, 10: 1.910, 11: 1.916, 12: 1.920, 13: 1.923, 14: 1.926, 15: 1.928,
-       16: 1.931, 17: 1.933, 18: 1.935, 19: 1.936, 20: 1.937, 30: 1.945}
-  fact = sqrt(float(len(data)) / (len(data) - 1))
-  fval = len(data) - 2
-  if fval < 2:
-    return []
-  outliers = []
-  if fval in f:
-    # less strict than the original:
-    q_crit = f[fval]
-  else:
-    q_crit = 1.95
-  for num, i in enumerate(data):
-    q = abs(((i - median(data)) / std_dev(data)) * fact)
-    if q > q_crit:
-      outliers.append(num)
-  return outliers
+      outliers = nalimov_test(distances, center, stdev) if stdev > 0.065 else []
+      for x in outliers:
+        message = 'Suspicious deviation in atom pair "{}" ({:4.3f} A, median: {:4.3f}) of SADI line {}.'.format(
+          ' '.join(pairs[x]), distances[x], center, num)
+        findings.append(RestraintFinding('outlier', num, message, [pairs[x]], [distances[x]]))
+      if not outliers and stdev > 2.5 * float(dev):
+        message = 'Suspicious restraints in SADI line {} with high standard deviation {:4.3f} ' \
+                  '(median length: {:4.3f} A).'.format(num, stdev, center)
+        findings.append(RestraintFinding('deviation', num, message, pairs, distances))
+  return findings
+
+
+def check_sadi_consistence(atoms, restr, cell, fragment):
+  """
+  prints the findings of sadi_findings() for the restraints of a fragment.
+  :param atoms: atoms list of the fragment ['C1', x, y, z]
+  :param restr: restraints list
+  :param cell: unit cell of the atom coordinates
+  :param fragment: frag name
+  :rtype: bool
+  """
+  findings = sadi_findings(atoms, restr, cell, fragment)
+  if findings:
+    print("\n{}:".format(fragment))
+  shown = set()
+  for finding in findings:
+    print(finding)
+    if finding.kind in ('outlier', 'deviation') and finding.line not in shown:
+      shown.add(finding.line)
+      print(' '.join(restr[finding.line - 1])[:60], '...')
+  return not any(finding.kind in SADI_ERRORS for finding in findings)
 
 
 def invert_atomlist_coordinates(atomst):
@@ -417,16 +635,18 @@ def invert_atomlist_coordinates(atomst):
   >>> invert_atomlist_coordinates(c1)
   [['c1', '1', -1.0, 2.0, -3.0], ['c1', 2, -1.0, 2.0, -3.0]]
   """
-  atoms = []
-  for line in atomst:
-    line = list(line)
-    try:
-      inv_coord = [-float(i) for i in line[2:]]
-    except:
-      print('Unable to invert fragment coordinates.')
-      return False
+  atoms = [list(line) for line in atomst]
+  try:
+    if np is not None:
+      # all coordinates at once:
+      inverted = (-np.asarray([line[2:] for line in atoms], dtype=float)).tolist()
+    else:
+      inverted = [[-float(i) for i in line[2:]] for line in atoms]
+  except:
+    print('Unable to invert fragment coordinates.')
+    return False
+  for line, inv_coord in zip(atoms, inverted):
     line[2:] = inv_coord
-    atoms.append(line)
   return atoms
 
 
@@ -474,6 +694,79 @@ def remove_partsymbol(atom):
   return atom
 
 
+def get_atomic_number(atom):
+  """
+  returns the atomic number of an atom from its name. Like in SHELXL, the
+  name starts with the element symbol. A two letter symbol is preferred
+  over a one letter symbol. Returns 0 if there is no element symbol.
+
+  >>> get_atomic_number('C4A')
+  6
+  >>> get_atomic_number('CL1')
+  17
+  >>> get_atomic_number('Al1')
+  13
+  >>> get_atomic_number('H5B_2')
+  1
+  >>> get_atomic_number('D1')
+  1
+  >>> get_atomic_number('Q12')
+  0
+
+  :param atom: atom name like 'C1' or 'CL2'
+  :type atom: str
+  :rtype: int
+  """
+  letters = ''
+  for char in atom:
+    if not char.isalpha():
+      break
+    letters += char
+  if letters[:2].capitalize() in ELEMENTS:
+    return ELEMENTS.index(letters[:2].capitalize()) + 1
+  if letters[:1].upper() == 'D':
+    # deuterium
+    return 1
+  if letters[:1].upper() in ELEMENTS:
+    return ELEMENTS.index(letters[:1].upper()) + 1
+  return 0
+
+
+def formula_to_dict(formula):
+  """
+  converts a sum formula to a dictionary with the atomic numbers and the
+  number of atoms. An element without number has None as number.
+
+  >>> sorted(formula_to_dict('C6F5').items())
+  [(6, 6), (9, 5)]
+  >>> sorted(formula_to_dict('P F').items())
+  [(9, None), (15, None)]
+  >>> formula_to_dict('C6Xy')
+  Traceback (most recent call last):
+  ...
+  ValueError: Unknown element "Xy" in formula.
+
+  :param formula: sum formula like 'C6H5Cl' or 'C6 H5 Cl1'
+  :type formula: str
+  :rtype: dict
+  """
+  composition = {}
+  rest = formula
+  for symbol, number in re.findall(r'([A-Z][a-z]?)(\d*)', formula):
+    if symbol not in ELEMENTS:
+      raise ValueError('Unknown element "{}" in formula.'.format(symbol))
+    rest = rest.replace(symbol + number, '', 1)
+    atomic_number = ELEMENTS.index(symbol) + 1
+    if number:
+      composition[atomic_number] = composition.get(atomic_number) or 0
+      composition[atomic_number] += int(number)
+    else:
+      composition.setdefault(atomic_number, None)
+  if rest.strip():
+    raise ValueError('Invalid formula "{}".'.format(formula))
+  return composition
+
+
 def flatten(nested):
   """
   flattens a nested list
@@ -507,17 +800,35 @@ def frac_to_cart(frac_coord, cell):
   >>> print(frac_to_cart(coord1, cell))
   (-2.741505423999065, 5.909586678000002, 10.775200700893734)
   """
-  a, b, c, alpha, beta, gamma = cell
-  x, y, z = frac_coord
-  alpha = radians(alpha)
-  beta = radians(beta)
-  gamma = radians(gamma)
-  cosastar = (cos(beta) * cos(gamma) - cos(alpha)) / (sin(beta) * sin(gamma))
-  sinastar = sqrt(1 - cosastar ** 2)
-  Xc = a * x + (b * cos(gamma)) * y + (c * cos(beta)) * z
-  Yc = 0 + (b * sin(gamma)) * y + (-c * sin(beta) * cosastar) * z
-  Zc = 0 + 0 + (c * sin(beta) * sinastar) * z
-  return (Xc, Yc, Zc)
+  return cell_geometry(cell).to_cartesian(frac_coord)
+
+
+def frac_to_cart_many(frac_coords, cell):
+  """
+  Converts a list of fractional coordinates to cartesian coodinates with one
+  orthogonalization matrix for all of them.
+  :param frac_coords: [[float, float, float], ...]
+  :param cell:       [float, float, float, float, float, float]
+  >>> cell = (10.5086, 20.9035, 20.5072, 90, 94.13, 90)
+  >>> coords = frac_to_cart_many([(-0.186843, 0.282708, 0.526803), (0, 0, 1)], cell)
+  >>> [[round(float(x), 6) for x in coord] for coord in coords]
+  [[-2.741505, 5.909587, 10.775201], [-1.476922, 0.0, 20.453947]]
+  """
+  return cell_geometry(cell).to_cartesian_many(frac_coords)
+
+
+def cart_to_frac_many(cart_coords, cell):
+  """
+  Converts a list of cartesian coordinates to fractional coodinates, the
+  reverse of frac_to_cart_many().
+  :param cart_coords: [[float, float, float], ...]
+  :param cell:       [float, float, float, float, float, float]
+  >>> cell = (10.5086, 20.9035, 20.5072, 90, 94.13, 90)
+  >>> coords = cart_to_frac_many([(-2.741505424, 5.909586678, 10.775200701)], cell)
+  >>> [[round(float(x), 6) for x in coord] for coord in coords]
+  [[-0.186843, 0.282708, 0.526803]]
+  """
+  return cell_geometry(cell).to_fractional_many(cart_coords)
 
 
 ############################################################################
@@ -783,6 +1094,17 @@ def initialize_user_db(user_dbpath):
   cur = con.cursor()
   print('initializing FragmentDB user database.')
   con.execute("PRAGMA foreign_keys = ON")
+  cur.execute("DROP TABLE IF EXISTS NameBigrams")
+  cur.execute("DROP TABLE IF EXISTS Composition")
+  cur.execute("DROP TABLE IF EXISTS Coordinates")
+  cur.execute("DROP TABLE IF EXISTS Revision")
+  cur.execute("DROP TABLE IF EXISTS Fingerprint")
+  cur.execute("DROP TABLE IF EXISTS Bonds")
+  cur.execute("DROP TABLE IF EXISTS GraphFeatures")
+  try:
+    cur.execute("DROP TABLE IF EXISTS FragmentText")
+  except:
+    pass
   cur.execute("DROP TABLE IF EXISTS fragment")
   cur.execute("DROP TABLE IF EXISTS atoms")
   cur.execute("DROP TABLE IF EXISTS atom")
@@ -804,6 +1126,9 @@ def initialize_user_db(user_dbpath):
     cur.execute("DROP INDEX AtomId")
   except:
     pass
+  for index in ('Fragment_UnifiedId', 'Atoms_UnifiedFK', 'Restraint_UnifiedFK',
+                'Fragment_UnifiedSortKey', 'Fragment_SortKey'):
+    cur.execute("DROP INDEX IF EXISTS {}".format(index))
   cur.execute('''
               CREATE TABLE Fragment (
                   Id    INTEGER NOT NULL,
@@ -856,6 +1181,18 @@ def initialize_user_db(user_dbpath):
   cur.execute('''
               CREATE INDEX AtomId ON Atoms(Id);
               ''')
+  # indexes for the lookup with offset ids of the handler:
+  cur.execute('''
+              CREATE INDEX Fragment_UnifiedId ON Fragment(Id + 1000000);
+              ''')
+  cur.execute('''
+              CREATE INDEX Atoms_UnifiedFK ON Atoms(FragmentId + 1000000);
+              ''')
+  cur.execute('''
+              CREATE INDEX Restraint_UnifiedFK ON Restraints(FragmentId + 1000000);
+              ''')
+  # the new tables have the initial layout, the handler upgrades them:
+  cur.execute("PRAGMA user_version = 0")
   con.execute("PRAGMA foreign_keys = ON")
   con.commit()
 
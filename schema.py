@@ -0,0 +1,620 @@
+'''
+Created on 18.10.2026
+
+Layout versions of the fragment databases and the upgrades between them.
+The version of a database is kept in its PRAGMA user_version. Databases
+with an older layout are upgraded by upgrade() when they are opened. The
+shipped database is upgraded before a release with
+
+python schema.py fragment-database.sqlite
+
+here are only functions that are completely independent of olex
+'''
+from __future__ import print_function
+
+import os
+import sys
+import math
+import sqlite3
+import struct
+from collections import Counter
+
+if not __package__:
+  # started as script: this directory is the FragmentDB package, its
+  # __init__.py needs Olex2.
+  import types
+  _package = types.ModuleType('FragmentDB')
+  _package.__path__ = [os.path.dirname(os.path.abspath(__file__))]
+  sys.modules.setdefault('FragmentDB', _package)
+
+from FragmentDB.helper_functions import make_sortkey, get_atomic_number, ELEMENTS
+from FragmentDB.graph import bond_graph, pack_bonds, graph_features
+
+__metaclass__ = type  # use new-style classes
+
+# Suffix of the names of user database fragments in the fragment list:
+USER_NAME_SUFFIX = '  *user*'
+# Width in Angstrom of the distance bins of the geometry fingerprints:
+FINGERPRINT_BIN = 0.2
+
+
+def fragment_keys(name, userdb=False):
+  """
+  returns the sort key, the number part of the name and the search key of
+  a fragment name as they are stored in the Fragment table. The search key of
+  a user fragment is made of the name as it appears in the fragment list.
+
+  >>> fragment_keys('1,2-Dichloroethane, C2H4Cl2')
+  ('dichloroethane', '12', 'dichloroethane C2H4Cl212')
+  >>> fragment_keys('Benzene', userdb=True)
+  ('benzene', '', 'benzene  *user*')
+
+  :param name: full name of the fragment
+  :type name: str
+  :param userdb: True for fragments of the user database
+  :type userdb: bool
+  :rtype: tuple
+  """
+  sortkey, numbers = make_sortkey(name, searchkey=False)
+  if userdb:
+    name = name + USER_NAME_SUFFIX
+  searchkey = make_sortkey(name, searchkey=True)
+  return sortkey, numbers, searchkey[0] + searchkey[1]
+
+
+def name_bigrams(searchkey):
+  """
+  returns the bigrams of a search key with their number of occurrences like
+  dice_coefficient2() compares them.
+
+  >>> sorted(name_bigrams('Anan').items())
+  [('an', 2), ('na', 1)]
+
+  :param searchkey: search key of a fragment name
+  :type searchkey: str
+  :rtype: Counter
+  """
+  searchkey = searchkey.lower()
+  return Counter(searchkey[i:i + 2] for i in range(len(searchkey) - 1))
+
+
+def atom_element(name, element):
+  """
+  returns the atomic number of an atom. It is the element column of the
+  Atoms table if it has a valid atomic number, otherwise it is derived from
+  the atom name.
+
+  >>> atom_element('C1', '6')
+  6
+  >>> atom_element('CL1', 999)
+  17
+
+  :rtype: int
+  """
+  try:
+    number = int(element)
+  except(ValueError, TypeError):
+    number = 0
+  if 0 < number <= len(ELEMENTS):
+    return number
+  return get_atomic_number(name or '')
+
+
+def composition(numbers):
+  """
+  returns the number of atoms per element for a list of atomic numbers.
+  Atoms of unknown element (0) are left out.
+
+  >>> sorted(composition([6, 6, 9, 0]).items())
+  [(6, 2), (9, 1)]
+  """
+  counts = Counter(numbers)
+  counts.pop(0, None)
+  return counts
+
+
+def pack_coordinates(atoms):
+  """
+  packs the x, y, z coordinates of atoms into little-endian float64 bytes
+  with three values per atom. Missing coordinates become NaN.
+
+  >>> len(pack_coordinates([('C1', '6', 0.0, 1.0, 2.0)]))
+  24
+
+  :param atoms: atoms like (name, element, x, y, z)
+  :type atoms: list
+  :rtype: bytes
+  """
+  values = [float('nan') if value is None else float(value) for atom in atoms for value in atom[-3:]]
+  return struct.pack('<{:d}d'.format(len(values)), *values)
+
+
+def unpack_coordinates(blob):
+  """
+  returns the coordinates from pack_coordinates() as list of (x, y, z)
+  tuples.
+
+  >>> unpack_coordinates(pack_coordinates([('C1', '6', 0.0, 1.0, 2.0)]))
+  [(0.0, 1.0, 2.0)]
+  """
+  values = struct.unpack('<{:d}d'.format(len(blob) // 8), blob)
+  return [values[i:i + 3] for i in range(0, len(values), 3)]
+
+
+def formula_key(numbers):
+  """
+  returns the composition of a list of atomic numbers as sum formula with
+  the elements in the order of their atomic number. Fragments with the same
+  atoms have the same key.
+
+  >>> formula_key([6, 1, 1, 6, 8, 1, 8, 1])
+  'H4C2O2'
+  """
+  return ''.join('{}{:d}'.format(ELEMENTS[number - 1], count)
+                 for number, count in sorted(composition(numbers).items()))
+
+
+def geometry_fingerprint(numbers, coordinates):
+  """
+  returns the histogram of the distances between all atom pairs by the
+  atomic numbers of the pair. The histogram does not change with rotation
+  or translation of the fragment. Every distance is shared between its two
+  nearest bins, so that small changes of the geometry only cause small
+  changes of the histogram. Atoms without coordinates are left out.
+
+  >>> fp = geometry_fingerprint([6, 8], [(0.0, 0.0, 0.0), (1.23, 0.0, 0.0)])
+  >>> sorted((key, round(weight, 3)) for key, weight in fp.items())
+  [((6, 8, 6), 0.85), ((6, 8, 7), 0.15)]
+
+  :param numbers: atomic numbers of the atoms
+  :type numbers: list
+  :param coordinates: cartesian (x, y, z) of the atoms
+  :type coordinates: list
+  :rtype: dict
+  """
+  atoms = [(number, xyz) for number, xyz in zip(numbers, coordinates)
+           if not any(value is None or math.isnan(value) for value in xyz)]
+  histogram = {}
+  for i, (number1, xyz1) in enumerate(atoms):
+    for number2, xyz2 in atoms[i + 1:]:
+      pair = (number1, number2) if number1 <= number2 else (number2, number1)
+      position = math.sqrt((xyz1[0] - xyz2[0]) ** 2 + (xyz1[1] - xyz2[1]) ** 2 +
+                           (xyz1[2] - xyz2[2]) ** 2) / FINGERPRINT_BIN
+      low = int(position)
+      share = position - low
+      histogram[pair + (low,)] = histogram.get(pair + (low,), 0.0) + 1.0 - share
+      histogram[pair + (low + 1,)] = histogram.get(pair + (low + 1,), 0.0) + share
+  return histogram
+
+
+def pack_fingerprint(histogram):
+  """
+  packs a histogram of geometry_fingerprint() sorted by its keys into bytes.
+
+  >>> fp = {(6, 8, 12): 0.75, (6, 8, 13): 0.25}
+  >>> unpack_fingerprint(pack_fingerprint(fp)) == fp
+  True
+  """
+  entries = sorted(histogram.items())
+  return b''.join(struct.pack('<HHHf', key[0], key[1], key[2], weight) for key, weight in entries)
+
+
+def unpack_fingerprint(blob):
+  """
+  returns the histogram from pack_fingerprint().
+  """
+  histogram = {}
+  for i in range(0, len(blob), 10):
+    number1, number2, distbin, weight = struct.unpack('<HHHf', blob[i:i + 10])
+    histogram[(number1, number2, distbin)] = weight
+  return histogram
+
+
+def fingerprint_similarity(histogram1, histogram2):
+  """
+  returns the similarity of two geometry fingerprints between 0 and 1. It
+  is the sum of the smaller of both weights of each bin divided by the sum
+  of the larger ones. Identical geometries have a similarity of 1.
+
+  >>> fp = geometry_fingerprint([6, 8], [(0.0, 0.0, 0.0), (1.23, 0.0, 0.0)])
+  >>> fingerprint_similarity(fp, fp)
+  1.0
+  >>> round(fingerprint_similarity(fp, geometry_fingerprint([6, 8], [(0, 0, 0), (0, 1.25, 0)])), 3)
+  0.818
+  """
+  smaller = 0.0
+  larger = 0.0
+  for key in set(histogram1) | set(histogram2):
+    weight1 = histogram1.get(key, 0.0)
+    weight2 = histogram2.get(key, 0.0)
+    smaller += min(weight1, weight2)
+    larger += max(weight1, weight2)
+  if not larger:
+    return 1.0 if histogram1 == histogram2 else 0.0
+  return smaller / larger
+
+
+def _upgrade_sortkeys(con, schema):
+  """
+  Layout 1: sort and search keys of the fragment names in indexed columns
+  """
+  con.execute('ALTER TABLE {}.Fragment ADD COLUMN SortKey TEXT'.format(schema))
+  con.execute('ALTER TABLE {}.Fragment ADD COLUMN SortNum TEXT'.format(schema))
+  con.execute('ALTER TABLE {}.Fragment ADD COLUMN SearchKey TEXT'.format(schema))
+  rows = con.execute('SELECT Id, Name FROM {}.Fragment'.format(schema)).fetchall()
+  userdb = schema == 'userdb'
+  con.executemany('UPDATE {}.Fragment SET SortKey = ?, SortNum = ?, SearchKey = ? '
+                  'WHERE Id = ?'.format(schema),
+                  [fragment_keys(name or '', userdb) + (fragid,) for fragid, name in rows])
+  con.execute('CREATE INDEX IF NOT EXISTS {}.Fragment_SortKey '
+              'ON Fragment(SortKey, SortNum, Id)'.format(schema))
+
+
+def _upgrade_bigrams(con, schema):
+  """
+  Layout 2: inverted index of the bigrams in the search keys and the
+  number of bigrams per search key
+  """
+  con.execute('ALTER TABLE {}.Fragment ADD COLUMN BigramCount INTEGER'.format(schema))
+  con.execute('''CREATE TABLE {}.NameBigrams (
+                   Bigram TEXT NOT NULL,
+                   FragmentId INTEGER NOT NULL,
+                   Count INTEGER NOT NULL,
+                 PRIMARY KEY(Bigram, FragmentId),
+                   FOREIGN KEY(FragmentId)
+                     REFERENCES Fragment(Id)
+                     ON DELETE CASCADE
+                     ON UPDATE NO ACTION) WITHOUT ROWID'''.format(schema))
+  con.execute('CREATE INDEX {}.NameBigrams_FK ON NameBigrams(FragmentId)'.format(schema))
+  rows = con.execute('SELECT Id, SearchKey FROM {}.Fragment'.format(schema)).fetchall()
+  bigrams = dict((fragid, name_bigrams(searchkey or '')) for fragid, searchkey in rows)
+  con.executemany('UPDATE {}.Fragment SET BigramCount = ? WHERE Id = ?'.format(schema),
+                  [(sum(counter.values()), fragid) for fragid, counter in bigrams.items()])
+  con.executemany('INSERT INTO {}.NameBigrams (FragmentId, Bigram, Count) '
+                  'VALUES(?, ?, ?)'.format(schema),
+                  [(fragid, bigram, count) for fragid, counter in bigrams.items()
+                   for bigram, count in counter.items()])
+
+
+def _upgrade_fulltext(con, schema):
+  """
+  Layout 3: FTS5 index of name, reference and comment, kept up to date by
+  triggers on the Fragment table. Without FTS5 in sqlite, the index is left
+  out and the handler searches with LIKE.
+  """
+  try:
+    con.execute('''CREATE VIRTUAL TABLE {}.FragmentText USING fts5(
+                     Name, Reference, comment, content='Fragment', content_rowid='Id',
+                     prefix='2 3')'''.format(schema))
+  except sqlite3.OperationalError as e:
+    print('No full text search for fragments: {}'.format(e))
+    return
+  con.execute('''CREATE TRIGGER {}.Fragment_TextInsert AFTER INSERT ON Fragment BEGIN
+                   INSERT INTO FragmentText (rowid, Name, Reference, comment)
+                     VALUES(new.Id, new.Name, new.Reference, new.comment);
+                 END'''.format(schema))
+  con.execute('''CREATE TRIGGER {}.Fragment_TextDelete AFTER DELETE ON Fragment BEGIN
+                   INSERT INTO FragmentText (FragmentText, rowid, Name, Reference, comment)
+                     VALUES('delete', old.Id, old.Name, old.Reference, old.comment);
+                 END'''.format(schema))
+  con.execute('''CREATE TRIGGER {}.Fragment_TextUpdate AFTER UPDATE OF Name, Reference, comment
+                   ON Fragment BEGIN
+                   INSERT INTO FragmentText (FragmentText, rowid, Name, Reference, comment)
+                     VALUES('delete', old.Id, old.Name, old.Reference, old.comment);
+                   INSERT INTO FragmentText (rowid, Name, Reference, comment)
+                     VALUES(new.Id, new.Name, new.Reference, new.comment);
+                 END'''.format(schema))
+  con.execute("INSERT INTO {0}.FragmentText (FragmentText) VALUES('rebuild')".format(schema))
+
+
+def _upgrade_composition(con, schema):
+  """
+  Layout 4: element composition of the fragments. The elements of atoms
+  without valid atomic number are derived from the atom names.
+  """
+  con.execute('ALTER TABLE {}.Fragment ADD COLUMN AtomCount INTEGER NOT NULL DEFAULT 0'.format(schema))
+  con.execute('ALTER TABLE {}.Fragment ADD COLUMN ElementCount INTEGER NOT NULL DEFAULT 0'.format(schema))
+  con.execute('''CREATE TABLE {}.Composition (
+                   Element INTEGER NOT NULL,
+                   Count INTEGER NOT NULL,
+                   FragmentId INTEGER NOT NULL,
+                 PRIMARY KEY(Element, Count, FragmentId),
+                   FOREIGN KEY(FragmentId)
+                     REFERENCES Fragment(Id)
+                     ON DELETE CASCADE
+                     ON UPDATE NO ACTION) WITHOUT ROWID'''.format(schema))
+  con.execute('CREATE INDEX {}.Composition_FK ON Composition(FragmentId)'.format(schema))
+  con.execute('CREATE INDEX {}.Fragment_AtomCount ON Fragment(AtomCount)'.format(schema))
+  compositions = {}
+  fixed = []
+  # atoms left over from deleted fragments are skipped:
+  rows = con.execute('SELECT a.Id, a.FragmentId, a.Name, a.element FROM {0}.Atoms AS a '
+                     'JOIN {0}.Fragment AS f ON f.Id = a.FragmentId'.format(schema)).fetchall()
+  for atomid, fragid, name, element in rows:
+    number = atom_element(name, element)
+    if number and str(number) != str(element):
+      fixed.append((str(number), atomid))
+    compositions.setdefault(fragid, []).append(number)
+  con.executemany('UPDATE {}.Atoms SET element = ? WHERE Id = ?'.format(schema), fixed)
+  for fragid, numbers in compositions.items():
+    counts = composition(numbers)
+    con.execute('UPDATE {}.Fragment SET AtomCount = ?, ElementCount = ? '
+                'WHERE Id = ?'.format(schema), (len(numbers), len(counts), fragid))
+    con.executemany('INSERT INTO {}.Composition (Element, Count, FragmentId) '
+                    'VALUES(?, ?, ?)'.format(schema),
+                    [(number, count, fragid) for number, count in counts.items()])
+
+
+def _upgrade_coordinates(con, schema):
+  """
+  Layout 5: coordinates of each fragment as one packed BLOB with the atom
+  names in the same order, separated by spaces. Atoms and restraints without
+  fragment are deleted, so that the BLOB and the Atoms table always agree.
+  """
+  con.execute('''CREATE TABLE {}.Coordinates (
+                   FragmentId INTEGER NOT NULL,
+                   Labels TEXT,
+                   XYZ BLOB,
+                 PRIMARY KEY(FragmentId),
+                   FOREIGN KEY(FragmentId)
+                     REFERENCES Fragment(Id)
+                     ON DELETE CASCADE
+                     ON UPDATE NO ACTION)'''.format(schema))
+  # atoms and restraints of fragments that were deleted without foreign key
+  # support would be attached to a new fragment with the same id:
+  for table in ('Atoms', 'Restraints'):
+    con.execute('DELETE FROM {0}.{1} WHERE FragmentId NOT IN (SELECT Id FROM {0}.Fragment)'.format(schema, table))
+  atoms = {}
+  rows = con.execute('SELECT a.FragmentId, a.Name, a.x, a.y, a.z FROM {0}.Atoms AS a '
+                     'JOIN {0}.Fragment AS f ON f.Id = a.FragmentId ORDER BY a.Id'.format(schema))
+  for row in rows.fetchall():
+    atoms.setdefault(row[0], []).append(row[1:])
+  con.executemany('INSERT INTO {}.Coordinates (FragmentId, Labels, XYZ) VALUES(?, ?, ?)'.format(schema),
+                  [(fragid, ' '.join(atom[0] for atom in fragatoms),
+                    sqlite3.Binary(pack_coordinates(fragatoms)))
+                   for fragid, fragatoms in atoms.items()])
+
+
+# Tables whose rows carry the revision of their last change in "version".
+# Atoms and restraints are only written together with their fragment, so
+# the triggers on Fragment count every change once and not once per row:
+REVISION_TABLES = ('Fragment',)
+
+
+def _upgrade_revision(con, schema):
+  """
+  Layout 6: a revision counter of the database in the one row table Revision.
+  Triggers increase it with every inserted, changed or deleted fragment and
+  write the new revision into the version column of the fragment. Rows from
+  before this layout keep an empty version.
+  """
+  con.execute('''CREATE TABLE {}.Revision (
+                   Id INTEGER NOT NULL CHECK (Id = 1),
+                   Revision INTEGER NOT NULL,
+                 PRIMARY KEY(Id))'''.format(schema))
+  con.execute('INSERT INTO {}.Revision (Id, Revision) VALUES(1, 1)'.format(schema))
+  for table in REVISION_TABLES:
+    columns = [row[1] for row in con.execute('PRAGMA {}.table_info({})'.format(schema, table))]
+    if 'version' not in columns:
+      con.execute('ALTER TABLE {}.{} ADD COLUMN version TEXT'.format(schema, table))
+    con.execute('''CREATE TRIGGER {0}.{1}_RevisionInsert AFTER INSERT ON {1} BEGIN
+                     UPDATE Revision SET Revision = Revision + 1;
+                     UPDATE {1} SET version = (SELECT Revision FROM Revision) WHERE Id = new.Id;
+                   END'''.format(schema, table))
+    # the version update of the row itself does not count as change:
+    con.execute('''CREATE TRIGGER {0}.{1}_RevisionUpdate AFTER UPDATE ON {1}
+                     WHEN new.version IS old.version BEGIN
+                     UPDATE Revision SET Revision = Revision + 1;
+                     UPDATE {1} SET version = (SELECT Revision FROM Revision) WHERE Id = new.Id;
+                   END'''.format(schema, table))
+    con.execute('''CREATE TRIGGER {0}.{1}_RevisionDelete AFTER DELETE ON {1} BEGIN
+                     UPDATE Revision SET Revision = Revision + 1;
+                   END'''.format(schema, table))
+
+
+def _upgrade_fingerprints(con, schema):
+  """
+  Layout 7: sum formula and geometry fingerprint of every fragment. Only
+  fragments with the same formula can be duplicates, so the index of the
+  formula restricts the comparison of fingerprints to a few candidates.
+  """
+  con.execute('''CREATE TABLE {}.Fingerprint (
+                   FragmentId INTEGER NOT NULL,
+                   Formula TEXT NOT NULL,
+                   Histogram BLOB,
+                 PRIMARY KEY(FragmentId),
+                   FOREIGN KEY(FragmentId)
+                     REFERENCES Fragment(Id)
+                     ON DELETE CASCADE
+                     ON UPDATE NO ACTION)'''.format(schema))
+  con.execute('CREATE INDEX {}.Fingerprint_Formula ON Fingerprint(Formula)'.format(schema))
+  atoms = {}
+  rows = con.execute('SELECT a.FragmentId, a.Name, a.element, a.x, a.y, a.z FROM {0}.Atoms AS a '
+                     'JOIN {0}.Fragment AS f ON f.Id = a.FragmentId ORDER BY a.Id'.format(schema))
+  for row in rows.fetchall():
+    atoms.setdefault(row[0], []).append(row[1:])
+  rows = []
+  for fragid, fragatoms in atoms.items():
+    numbers = [atom_element(atom[0], atom[1]) for atom in fragatoms]
+    coordinates = unpack_coordinates(pack_coordinates(fragatoms))
+    rows.append((fragid, formula_key(numbers),
+                 sqlite3.Binary(pack_fingerprint(geometry_fingerprint(numbers, coordinates)))))
+  con.executemany('INSERT INTO {}.Fingerprint (FragmentId, Formula, Histogram) '
+                  'VALUES(?, ?, ?)'.format(schema), rows)
+
+
+def _upgrade_bonds(con, schema):
+  """
+  Layout 8: bonds of every fragment derived from the covalent radii and the
+  index of their bond and path features for the substructure search.
+  """
+  con.execute('''CREATE TABLE {}.Bonds (
+                   FragmentId INTEGER NOT NULL,
+                   Bonds BLOB,
+                 PRIMARY KEY(FragmentId),
+                   FOREIGN KEY(FragmentId)
+                     REFERENCES Fragment(Id)
+                     ON DELETE CASCADE
+                     ON UPDATE NO ACTION)'''.format(schema))
+  con.execute('''CREATE TABLE {}.GraphFeatures (
+                   Feature TEXT NOT NULL,
+                   FragmentId INTEGER NOT NULL,
+                 PRIMARY KEY(Feature, FragmentId),
+                   FOREIGN KEY(FragmentId)
+                     REFERENCES Fragment(Id)
+                     ON DELETE CASCADE
+                     ON UPDATE NO ACTION) WITHOUT ROWID'''.format(schema))
+  con.execute('CREATE INDEX {}.GraphFeatures_FK ON GraphFeatures(FragmentId)'.format(schema))
+  atoms = {}
+  rows = con.execute('SELECT a.FragmentId, a.Name, a.element, a.x, a.y, a.z FROM {0}.Atoms AS a '
+                     'JOIN {0}.Fragment AS f ON f.Id = a.FragmentId ORDER BY a.Id'.format(schema))
+  for row in rows.fetchall():
+    atoms.setdefault(row[0], []).append(row[1:])
+  for fragid, fragatoms in atoms.items():
+    numbers = [atom_element(atom[0], atom[1]) for atom in fragatoms]
+    bonds = bond_graph(numbers, unpack_coordinates(pack_coordinates(fragatoms)))
+    con.execute('INSERT INTO {}.Bonds (FragmentId, Bonds) VALUES(?, ?)'.format(schema),
+                (fragid, sqlite3.Binary(pack_bonds(bonds))))
+    con.executemany('INSERT INTO {}.GraphFeatures (Feature, FragmentId) VALUES(?, ?)'.format(schema),
+                    [(feature, fragid) for feature in graph_features(numbers, bonds)])
+
+
+# (layout version, upgrade function) in ascending order:
+UPGRADES = (
+  (1, _upgrade_sortkeys),
+  (2, _upgrade_bigrams),
+  (3, _upgrade_fulltext),
+  (4, _upgrade_composition),
+  (5, _upgrade_coordinates),
+  (6, _upgrade_revision),
+  (7, _upgrade_fingerprints),
+  (8, _upgrade_bonds),
+)
+
+SCHEMA_VERSION = UPGRADES[-1][0]
+
+
+def has_table(con, name, schema='main'):
+  """
+  returns True if the database "schema" of connection con has a table name.
+  """
+  row = con.execute("SELECT 1 FROM {}.sqlite_master WHERE type = 'table' "
+                    "AND name = ?".format(schema), (name,)).fetchone()
+  return bool(row)
+
+
+def has_fulltext(con, schema='main'):
+  """
+  returns True if the database "schema" of connection con has a full text
+  index that this sqlite can read. The FTS5 table of a database that was
+  upgraded elsewhere is unusable without FTS5.
+  """
+  try:
+    con.execute('SELECT rowid FROM {}.FragmentText LIMIT 0'.format(schema))
+  except sqlite3.OperationalError:
+    return False
+  return True
+
+
+def schema_version(con, schema='main'):
+  """
+  returns the layout version of the database "schema" of connection con.
+  """
+  return con.execute('PRAGMA {}.user_version'.format(schema)).fetchone()[0]
+
+
+def revision(con, schema='main'):
+  """
+  returns the revision of the database "schema" of connection con. It
+  increases with every stored, changed or deleted fragment.
+  Databases without Revision table are at revision 0.
+  """
+  try:
+    return con.execute('SELECT Revision FROM {}.Revision'.format(schema)).fetchone()[0]
+  except (sqlite3.OperationalError, TypeError):
+    return 0
+
+
+def upgrade(con, schema='main'):
+  """
+  Brings the database "schema" of connection con to SCHEMA_VERSION. Every
+  upgrade step runs in its own transaction together with the new version
+  number. Databases without Fragment table are left alone.
+
+  >>> con = sqlite3.connect(':memory:', isolation_level=None)
+  >>> _ = con.execute('CREATE TABLE Fragment (Id INTEGER NOT NULL, class VARCHAR(4), version TEXT, '
+  ...                 'Name TEXT, Reference TEXT, comment TEXT, picture BLOB, PRIMARY KEY(Id))')
+  >>> _ = con.execute('CREATE TABLE Atoms (Id INTEGER NOT NULL, FragmentId INTEGER NOT NULL, version TEXT, '
+  ...                 'Name VARCHAR(255), element VARCHAR(2), x FLOAT, y FLOAT, z FLOAT, PRIMARY KEY(Id))')
+  >>> _ = con.execute('CREATE TABLE Restraints (Id INTEGER NOT NULL, FragmentId INTEGER NOT NULL, '
+  ...                 'version TEXT, ShelxName CHAR(4), Atoms TEXT, PRIMARY KEY(Id))')
+  >>> _ = con.execute("INSERT INTO Fragment (Name) VALUES('tert-Butyl, C4H9')")
+  >>> _ = con.execute("INSERT INTO Atoms (FragmentId, Name, element, x, y, z) VALUES(1, 'C1', '999', 0, 0, 0)")
+  >>> upgrade(con)
+  True
+  >>> row = con.execute('SELECT SortKey, SortNum, SearchKey, AtomCount FROM Fragment').fetchone()
+  >>> row == ('butyl', '', 'butyl C4H9', 1)
+  True
+  >>> con.execute('SELECT element FROM Atoms').fetchall() == [('6',)]
+  True
+  >>> schema_version(con) == SCHEMA_VERSION
+  True
+  >>> upgrade(con)
+  False
+  >>> rev = revision(con)
+  >>> _ = con.execute("UPDATE Fragment SET comment = 'test'")
+  >>> revision(con) == rev + 1
+  True
+  >>> con.execute('SELECT version FROM Fragment').fetchone()[0] == str(rev + 1)
+  True
+
+  :param con: connection in autocommit mode
+  :type con: sqlite3.Connection
+  :param schema: name of the attached database, e.g. "main" or "userdb"
+  :type schema: str
+  :rtype: bool
+  :returns: True if the database was changed
+  """
+  if not has_table(con, 'Fragment', schema):
+    return False
+  version = schema_version(con, schema)
+  changed = False
+  for number, step in UPGRADES:
+    if number <= version:
+      continue
+    con.execute('BEGIN IMMEDIATE')
+    try:
+      step(con, schema)
+      con.execute('PRAGMA {}.user_version = {:d}'.format(schema, number))
+    except:
+      con.execute('ROLLBACK')
+      raise
+    con.execute('COMMIT')
+    changed = True
+  return changed
+
+
+def upgrade_file(dbfile):
+  """
+  upgrades the database file dbfile in place, e.g. the fragment database
+  before a release. The handler then opens it without an upgraded copy in
+  memory.
+  """
+  if not os.path.isfile(dbfile):
+    print('Database {} not found.'.format(dbfile))
+    return
+  con = sqlite3.connect(dbfile, isolation_level=None)
+  try:
+    if upgrade(con):
+      # the pages that the upgrade left empty are not shipped:
+      con.execute('VACUUM')
+      print('{} upgraded to layout version {:d}.'.format(dbfile, SCHEMA_VERSION))
+    else:
+      print('{} is up to date.'.format(dbfile))
+  finally:
+    con.close()
+
+
+if __name__ == '__main__':
+  for arg in sys.argv[1:]:
+    upgrade_file(arg)
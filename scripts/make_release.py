@@ -2,6 +2,8 @@ from __future__ import print_function
 
 import os
 import shutil
+import subprocess
+import sys
 
 curdir = os.path.dirname(__file__)
 
@@ -10,10 +12,14 @@ basepath = r'D:\downloads\olex2-gui\util\pyUtil\FragmentDB'
 # subprocess.call(args=['C:/tools/Python2.7.15/python.exe', r'-c ../DSR/sql_export.py'], cwd=os.path.split(curdir)[0])
 
 
-shutil.copy('../DSR/fragment-database.sqlite', '/fragment-database.sqlite')
+shutil.copy('../DSR/fragment-database.sqlite', './fragment-database.sqlite')
 print('database copied from DSR git to FragmentDB.')
+# the database is shipped in the current layout, otherwise the handler
+# upgrades a copy in memory at every start:
+subprocess.check_call(args=[sys.executable, 'schema.py', 'fragment-database.sqlite'])
 
-files = ['fragmentdb.pyc', 'fragmentdb_handler.pyc', 'helper_functions.pyc', 'refine_model_tasks.pyc']
+files = ['fragmentdb.pyc', 'fragmentdb_handler.pyc', 'helper_functions.pyc', 'refine_model_tasks.pyc',
+         'schema.pyc', 'shape.pyc', 'graph.pyc', 'stats.pyc', 'validate.pyc', 'dfix.pyc']
 
 for file in files:
   print('copy file:', file)
@@ -0,0 +1,315 @@
+'''
+Created on 18.10.2026
+
+Search for fragments by their three-dimensional shape. The candidates are
+preselected by the number of atoms and by their distance histograms, the
+remaining ones are superimposed onto the query atoms and ranked by the RMSD.
+
+here are only functions that are completely independent of olex
+'''
+from __future__ import print_function
+
+import math
+import itertools
+
+from FragmentDB.schema import geometry_fingerprint, fingerprint_similarity
+
+try:
+  import numpy as np
+except ImportError:
+  np = None
+
+__metaclass__ = type  # use new-style classes
+
+# Refinement cycles of the atom assignment and superposition:
+SHAPE_ITERATIONS = 10
+# Added to the squared distance of atoms of different elements while the
+# atoms are assigned to each other (in A^2):
+ELEMENT_MISMATCH = 1.0
+# Candidates that are superimposed per requested result:
+SHAPE_CANDIDATES = 3
+# Relative difference below which two principal moments count as equal:
+DEGENERATE_MOMENTS = 0.15
+# Added to the RMSD for every atom the fragment has more or less than the
+# query (in A):
+ATOM_COUNT_PENALTY = 0.1
+
+
+def _jacobi(matrix, sweeps=50):
+  """
+  returns eigenvalues and eigenvectors (as columns) of a small symmetric
+  matrix, sorted by ascending eigenvalue.
+
+  >>> values, vectors = _jacobi([[2.0, 1.0], [1.0, 2.0]])
+  >>> [round(i, 6) for i in values]
+  [1.0, 3.0]
+  """
+  size = len(matrix)
+  a = [list(map(float, row)) for row in matrix]
+  v = [[float(i == j) for j in range(size)] for i in range(size)]
+  scale = sum(a[i][j] ** 2 for i in range(size) for j in range(size)) or 1.0
+  for _ in range(sweeps):
+    off = sum(a[i][j] ** 2 for i in range(size) for j in range(i + 1, size))
+    if off < 1e-24 * scale:
+      break
+    for p in range(size - 1):
+      for q in range(p + 1, size):
+        if a[p][q] == 0.0:
+          continue
+        theta = (a[q][q] - a[p][p]) / (2.0 * a[p][q])
+        t = (1.0 if theta >= 0 else -1.0) / (abs(theta) + math.sqrt(theta * theta + 1.0))
+        c = 1.0 / math.sqrt(t * t + 1.0)
+        s = t * c
+        for k in range(size):
+          akp, akq = a[k][p], a[k][q]
+          a[k][p] = c * akp - s * akq
+          a[k][q] = s * akp + c * akq
+        for k in range(size):
+          apk, aqk = a[p][k], a[q][k]
+          a[p][k] = c * apk - s * aqk
+          a[q][k] = s * apk + c * aqk
+        for k in range(size):
+          vkp, vkq = v[k][p], v[k][q]
+          v[k][p] = c * vkp - s * vkq
+          v[k][q] = s * vkp + c * vkq
+  order = sorted(range(size), key=lambda i: a[i][i])
+  return [a[i][i] for i in order], [[v[k][i] for i in order] for k in range(size)]
+
+
+def eigh(matrix):
+  """
+  returns eigenvalues and eigenvectors (as columns) of a symmetric matrix
+  sorted by ascending eigenvalue. Uses numpy if it is available.
+  """
+  if np is not None:
+    values, vectors = np.linalg.eigh(np.array(matrix, dtype=float))
+    return values.tolist(), vectors.tolist()
+  return _jacobi(matrix)
+
+
+def centered(coords):
+  """
+  returns the coordinates moved to their centroid and the centroid.
+
+  >>> centered([(0, 0, 0), (2, 0, 0)])
+  ([(-1.0, 0.0, 0.0), (1.0, 0.0, 0.0)], (1.0, 0.0, 0.0))
+  """
+  n = float(len(coords))
+  center = tuple(sum(xyz[i] for xyz in coords) / n for i in range(3))
+  return [tuple(xyz[i] - center[i] for i in range(3)) for xyz in coords], center
+
+
+def rotate(rotation, coords):
+  """
+  applies the 3x3 rotation matrix to the coordinates.
+  """
+  return [tuple(rotation[i][0] * x + rotation[i][1] * y + rotation[i][2] * z for i in range(3))
+          for x, y, z in coords]
+
+
+def superpose(moving, fixed):
+  """
+  returns the rotation that superimposes the centered coordinates moving
+  onto the centered coordinates fixed with the lowest RMSD and the RMSD
+  (quaternion method of Horn). Both lists need the same length and order.
+
+  >>> square = [(1, 0, 0), (0, 1, 0), (-1, 0, 0), (0, -1, 0)]
+  >>> turned = [(0, 1, 0), (-1, 0, 0), (0, -1, 0), (1, 0, 0)]
+  >>> rmsd, rotation = superpose(turned, square)
+  >>> round(rmsd, 6)
+  0.0
+
+  :rtype: tuple
+  :returns: (rmsd, 3x3 rotation matrix)
+  """
+  s = [[sum(m[i] * f[j] for m, f in zip(moving, fixed)) for j in range(3)] for i in range(3)]
+  sxx, sxy, sxz = s[0]
+  syx, syy, syz = s[1]
+  szx, szy, szz = s[2]
+  n = [[sxx + syy + szz, syz - szy, szx - sxz, sxy - syx],
+       [syz - szy, sxx - syy - szz, sxy + syx, szx + sxz],
+       [szx - sxz, sxy + syx, -sxx + syy - szz, syz + szy],
+       [sxy - syx, szx + sxz, syz + szy, -sxx - syy + szz]]
+  values, vectors = eigh(n)
+  q0, q1, q2, q3 = [vectors[i][-1] for i in range(4)]
+  rotation = [[q0 * q0 + q1 * q1 - q2 * q2 - q3 * q3, 2 * (q1 * q2 - q0 * q3), 2 * (q1 * q3 + q0 * q2)],
+              [2 * (q1 * q2 + q0 * q3), q0 * q0 - q1 * q1 + q2 * q2 - q3 * q3, 2 * (q2 * q3 - q0 * q1)],
+              [2 * (q1 * q3 - q0 * q2), 2 * (q2 * q3 + q0 * q1), q0 * q0 - q1 * q1 - q2 * q2 + q3 * q3]]
+  squares = sum(x * x + y * y + z * z for x, y, z in moving) + sum(x * x + y * y + z * z for x, y, z in fixed)
+  rmsd = math.sqrt(max(squares - 2.0 * values[-1], 0.0) / len(moving))
+  return rmsd, rotation
+
+
+def _principal_axes(coords):
+  """
+  returns the principal moments and axes (as rows of a matrix) of centered
+  coordinates.
+  """
+  covariance = [[sum(xyz[i] * xyz[j] for xyz in coords) for j in range(3)] for i in range(3)]
+  values, vectors = eigh(covariance)
+  return values, [[vectors[k][i] for k in range(3)] for i in range(3)]
+
+
+def _axis_orders(moments_q, moments_t):
+  """
+  returns the orders in which the principal axes of target are tried on the
+  ones of query. Axes with about the same principal moment in one of both
+  have arbitrary directions and are tried in both orders.
+  """
+  scale = max(moments_q[-1], moments_t[-1], 1e-6)
+  equal = [moments_q[i + 1] - moments_q[i] < DEGENERATE_MOMENTS * scale or
+           moments_t[i + 1] - moments_t[i] < DEGENERATE_MOMENTS * scale for i in range(2)]
+  if all(equal):
+    return list(itertools.permutations(range(3)))
+  if equal[0]:
+    return [(0, 1, 2), (1, 0, 2)]
+  if equal[1]:
+    return [(0, 1, 2), (0, 2, 1)]
+  return [(0, 1, 2)]
+
+
+def _start_rotations(query, target):
+  """
+  yields the rotations that turn the principal axes of query onto the ones
+  of target, one for every sign of the axes that keeps the handedness. If
+  the axes of one of them are not well defined, every axis of query is
+  tried on every axis of target.
+  """
+  moments_q, axes_q = _principal_axes(query)
+  moments_t, axes_t = _principal_axes(target)
+  for order in _axis_orders(moments_q, moments_t):
+    axes = [axes_t[k] for k in order]
+    for signs in ((1, 1, 1), (1, -1, -1), (-1, 1, -1), (-1, -1, 1)):
+      flipped = [[signs[k] * axes_q[k][j] for j in range(3)] for k in range(3)]
+      rotation = [[sum(axes[k][i] * flipped[k][j] for k in range(3)) for j in range(3)] for i in range(3)]
+      # the axes of eigh() may be left-handed:
+      det = (rotation[0][0] * (rotation[1][1] * rotation[2][2] - rotation[1][2] * rotation[2][1]) -
+             rotation[0][1] * (rotation[1][0] * rotation[2][2] - rotation[1][2] * rotation[2][0]) +
+             rotation[0][2] * (rotation[1][0] * rotation[2][1] - rotation[1][1] * rotation[2][0]))
+      if det < 0:
+        rotation = [[-value for value in row] for row in rotation]
+      yield rotation
+
+
+def assign_atoms(query, target, query_numbers, target_numbers):
+  """
+  assigns every query atom to a different target atom, the closest pairs
+  first. Atoms of different elements count as ELEMENT_MISMATCH further
+  apart. query must not have more atoms than target.
+
+  >>> assign_atoms([(0, 0, 0), (1, 0, 0)], [(1.1, 0, 0), (0.1, 0, 0), (5, 5, 5)], [0, 0], [0, 0, 0])
+  [(0, 1), (1, 0)]
+
+  :rtype: list of (query index, target index) pairs sorted by query index
+  """
+  distances = []
+  for i, (qxyz, qnum) in enumerate(zip(query, query_numbers)):
+    for j, (txyz, tnum) in enumerate(zip(target, target_numbers)):
+      dist = (qxyz[0] - txyz[0]) ** 2 + (qxyz[1] - txyz[1]) ** 2 + (qxyz[2] - txyz[2]) ** 2
+      if qnum and tnum and qnum != tnum:
+        dist += ELEMENT_MISMATCH
+      distances.append((dist, i, j))
+  distances.sort()
+  used_q = set()
+  used_t = set()
+  pairs = []
+  for _, i, j in distances:
+    if i in used_q or j in used_t:
+      continue
+    used_q.add(i)
+    used_t.add(j)
+    pairs.append((i, j))
+    if len(pairs) == len(query):
+      break
+  return sorted(pairs)
+
+
+def shape_rmsd(query, target, query_numbers=None, target_numbers=None, iterations=SHAPE_ITERATIONS):
+  """
+  returns the RMSD of the best superposition of the atoms of query onto the
+  atoms of target without knowing which atoms belong together. Starting from
+  the superpositions of the principal axes, the atoms are assigned to each
+  other and superimposed again until the assignment stays the same. If query
+  has more atoms than target, target is superimposed onto query.
+
+  >>> ring = [(math.cos(i * math.pi / 3), math.sin(i * math.pi / 3), 0.0) for i in range(6)]
+  >>> turned = [(y + 3.0, 0.1, x) for x, y, z in ring[2:] + ring[:2]]
+  >>> round(shape_rmsd(turned, ring), 4)
+  0.0
+
+  :param query: cartesian coordinates
+  :param target: cartesian coordinates
+  :param query_numbers: atomic numbers of query, 0 for unknown elements
+  :param target_numbers: atomic numbers of target
+  :rtype: float
+  """
+  query_numbers = query_numbers or [0] * len(query)
+  target_numbers = target_numbers or [0] * len(target)
+  if len(query) > len(target):
+    query, target = target, query
+    query_numbers, target_numbers = target_numbers, query_numbers
+  query, _ = centered(query)
+  target, _ = centered(target)
+  best = None
+  for rotation in _start_rotations(query, target):
+    pairs = None
+    # the target is centered on the atoms that have a partner in query:
+    shifted = target
+    for _ in range(iterations):
+      new_pairs = assign_atoms(rotate(rotation, query), shifted, query_numbers, target_numbers)
+      if new_pairs == pairs:
+        break
+      pairs = new_pairs
+      fixed, shift = centered([shifted[j] for _, j in pairs])
+      rmsd, rotation = superpose([query[i] for i, _ in pairs], fixed)
+      shifted = [tuple(xyz[k] - shift[k] for k in range(3)) for xyz in shifted]
+    if best is None or rmsd < best:
+      best = rmsd
+  return best
+
+
+def distance_profile(histogram):
+  """
+  returns the distance histogram of a geometry fingerprint without the
+  elements of the atom pairs. It compares atoms of unknown element, like
+  q-peaks.
+  """
+  profile = {}
+  for (_, _, distbin), weight in histogram.items():
+    profile[(0, 0, distbin)] = profile.get((0, 0, distbin), 0.0) + weight
+  return profile
+
+
+def rank_by_shape(coords, candidates, k=5, numbers=None):
+  """
+  returns the k candidates with the lowest RMSD after superposition onto
+  coords. Only the candidates with the most similar distance histograms are
+  superimposed. Candidates with another number of atoms than coords rank
+  ATOM_COUNT_PENALTY lower per atom.
+
+  :param coords: cartesian coordinates of the query atoms
+  :type coords: list
+  :param candidates: (Id, Name, coordinates, atomic numbers, fingerprint) of
+                     the candidate fragments
+  :type candidates: iterable
+  :param k: number of results
+  :type k: int
+  :param numbers: atomic numbers of the query atoms, 0 for unknown elements
+  :type numbers: list
+  :rtype: list of [Id, Name, rmsd], the best match first
+  """
+  profile = distance_profile(geometry_fingerprint([0] * len(coords), coords))
+  scored = []
+  for fragid, name, fragcoords, fragnumbers, histogram in candidates:
+    similarity = fingerprint_similarity(profile, distance_profile(histogram))
+    scored.append((-similarity, fragid, name, fragcoords, fragnumbers))
+  scored.sort(key=lambda x: (x[0], x[1]))
+  results = []
+  for _, fragid, name, fragcoords, fragnumbers in scored[:max(k * SHAPE_CANDIDATES, k)]:
+    if len(fragcoords) < 3:
+      continue
+    rmsd = shape_rmsd(coords, fragcoords, numbers, fragnumbers)
+    rank = rmsd + ATOM_COUNT_PENALTY * abs(len(fragcoords) - len(coords))
+    results.append((rank, fragid, name, rmsd))
+  results.sort()
+  return [[fragid, name, rmsd] for _, fragid, name, rmsd in results[:k]]
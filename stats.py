@@ -0,0 +1,135 @@
+'''
+Created on 18.10.2026
+
+Robust statistics for the consistency checks of the restraints. The median
+and the standard deviation of a data set are calculated once and reused for
+the test of every value. With numpy, the tests run on whole arrays.
+
+here are only functions that are completely independent of olex
+'''
+from __future__ import print_function
+
+from math import sqrt
+
+try:
+  import numpy as np
+except ImportError:
+  np = None
+
+# q-values of the Nalimov test for degrees of freedom:
+NALIMOV_Q = {1: 1.409, 2: 1.645, 3: 1.757, 4: 1.814, 5: 1.848, 6: 1.870, 7: 1.885, 8: 1.895,
+             9: 1.903, 10: 1.910, 11: 1.916, 12: 1.920, 13: 1.923, 14: 1.926, 15: 1.928,
+             16: 1.931, 17: 1.933, 18: 1.935, 19: 1.936, 20: 1.937, 30: 1.945}
+# q-value for all other degrees of freedom, less strict than the original:
+NALIMOV_Q_DEFAULT = 1.95
+
+
+def mean(values):
+  """
+  returns mean value of a list of numbers
+
+  >>> mean([1, 2, 3, 4, 1, 2, 3, 4])
+  2.5
+  >>> round(mean([1, 2, 3, 4, 1, 2, 3, 4.1, 1000000]), 4)
+  111113.3444
+  """
+  return sum(values) / float(len(values))
+
+
+def median(nums):
+  """
+  calculates the median of a list of numbers
+  >>> median([1, 2, 3, 4, 1, 2, 3, 4, 1, 2, 3, 4])
+  2.5
+  >>> median([1, 2, 3, 4, 1, 2, 3, 4, 1, 2, 3, 4.1, 1000000])
+  3
+  >>> median([])
+  Traceback (most recent call last):
+  ...
+  ValueError: Need a non-empty iterable
+  """
+  ls = sorted(nums)
+  n = len(ls)
+  if n == 0:
+    raise ValueError("Need a non-empty iterable")
+  # for uneven list length:
+  elif n % 2 == 1:
+    # // is floordiv:
+    return ls[n // 2]
+  else:
+    return sum(ls[int(n / 2 - 1):int(n / 2 + 1)]) / 2.0
+
+
+def std_dev(data):
+  """
+  returns standard deviation of values
+  S = sqrt( (sum(x-xm)^2) / n-1 )
+  xm = sum(x)/n
+  :param data: list with integer or float values
+  :type data: list
+
+  >>> round(std_dev([1.234, 1.222, 1.345, 1.451, 1.000, 1.234, 1.321, 1.222]), 8)
+  0.1303522
+  """
+  if len(data) == 0:
+    return 0
+  K = data[0]
+  n = 0
+  Sum = 0
+  Sum_sqr = 0
+  for x in data:
+    n = n + 1
+    Sum += x - K
+    Sum_sqr += (x - K) * (x - K)
+  variance = (Sum_sqr - (Sum * Sum) / n) / (n - 1)
+  # use n instead of (n-1) if want to compute the exact variance of the given data
+  # use (n-1) if data are samples of a larger population
+  return sqrt(variance)
+
+
+def describe(data):
+  """
+  returns the median and the standard deviation of data in one pass over
+  the sorted values.
+
+  >>> [round(x, 6) for x in describe([1.234, 1.222, 1.345, 1.451, 1.000, 1.234, 1.321, 1.222])]
+  [1.234, 0.130352]
+  """
+  if len(data) < 2:
+    return (median(data), 0.0)
+  if np is not None:
+    values = np.asarray(data, dtype=float)
+    return (float(np.median(values)), float(values.std(ddof=1)))
+  return (median(data), std_dev(data))
+
+
+def nalimov_test(data, center=None, spread=None):
+  """
+  returns a index list of outliers base on the Nalimov test for data.
+  Modified implementation of:
+  "R. Kaiser, G. Gottschalk, Elementare Tests zur Beurteilung von Messdaten
+  Bibliographisches Institut, Mannheim 1972."
+  The median and the standard deviation of data are calculated once if
+  they are not given as center and spread.
+
+  >>> data = [1.120, 1.234, 1.224, 1.469, 1.145, 1.222, 1.123, 1.223, 1.2654, 1.221, 1.215]
+  >>> nalimov_test(data)
+  [3]
+  >>> round(std_dev(data), 5)
+  0.09444
+  >>> nalimov_test([1.5, 1.5, 1.5, 1.5])
+  []
+  """
+  fval = len(data) - 2
+  if fval < 2:
+    return []
+  if center is None or spread is None:
+    center, spread = describe(data)
+  if not spread:
+    return []
+  q_crit = NALIMOV_Q.get(fval, NALIMOV_Q_DEFAULT)
+  fact = sqrt(float(len(data)) / (len(data) - 1)) / spread
+  if np is not None:
+    q = np.abs(np.asarray(data, dtype=float) - center) * fact
+    return [int(num) for num in np.flatnonzero(q > q_crit)]
+  return [num for num, i in enumerate(data) if abs((i - center) * fact) > q_crit]
@@ -0,0 +1,45 @@
+"""
+Shared setup of the tests: the plugin directory is imported as the FragmentDB
+package without its __init__.py, which needs Olex2. The tests work on copies
+of the shipped databases.
+
+Run them with "python -m pytest tests" from the plugin directory.
+"""
+import os
+import shutil
+import sys
+import types
+
+import pytest
+
+PLUGIN_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MAIN_DB = os.path.join(PLUGIN_DIR, 'fragment-database.sqlite')
+USER_DB = os.path.join(PLUGIN_DIR, 'tests', 'tst-usr.sqlite')
+
+_package = types.ModuleType('FragmentDB')
+_package.__path__ = [PLUGIN_DIR]
+sys.modules.setdefault('FragmentDB', _package)
+
+
+@pytest.fixture
+def maindb():
+  """
+  the shipped fragment database. The handler opens it read-only.
+  """
+  return MAIN_DB
+
+
+@pytest.fixture
+def userdb(tmp_path):
+  """
+  a copy of the test user database that the test may change.
+  """
+  path = str(tmp_path / 'user.sqlite')
+  shutil.copy(USER_DB, path)
+  return path
+
+
+@pytest.fixture
+def table(maindb, userdb):
+  from FragmentDB.fragmentdb_handler import FragmentTable
+  return FragmentTable(maindb, userdb)
@@ -0,0 +1,18 @@
+"""
+The doctests of the modules that work without Olex2. The doctests of the
+database handler need the test databases of the original test suite.
+"""
+import doctest
+import importlib
+
+import pytest
+
+MODULES = ['helper_functions', 'schema', 'stats', 'shape', 'graph', 'dfix', 'validate']
+
+
+@pytest.mark.parametrize('name', MODULES)
+def test_doctests(name):
+  module = importlib.import_module('FragmentDB.' + name)
+  failed, attempted = doctest.testmod(module)
+  assert attempted
+  assert not failed
@@ -0,0 +1,102 @@
+import sqlite3
+
+import pytest
+
+from FragmentDB.fragmentdb_handler import USER_ID_OFFSET, fragment_cache
+
+ATOMS = [['C1', '0.0', '0.0', '0.0'], ['C2', '1.52', '0.0', '0.0'], ['C3', '2.03', '1.43', '0.0'],
+         ['O1', '3.46', '1.43', '0.0']]
+RESTRAINTS = [['DFIX', '1.52', 'C1 C2 C2 C3'], ['DFIX', '1.43', 'C3 O1']]
+
+
+def test_store_changes_revision_once(table):
+  before = table.revision()
+  fragid = table.store_fragment('Propanol', ATOMS, 'PROP', RESTRAINTS, 'test')
+  # the fragment row, not every atom or restraint, changes the revision:
+  assert table.revision() == before + 1
+  row = table.database.con.execute('SELECT AtomCount, ElementCount FROM userdb.Fragment WHERE Id = ?',
+                                   (fragid - USER_ID_OFFSET,)).fetchone()
+  assert row == (4, 2)
+  before = table.revision()
+  del table[fragid]
+  assert table.revision() == before + 1
+
+
+def test_cache_follows_changes_from_outside(table, userdb):
+  fragid = table.store_fragment('Propanol', ATOMS, 'PROP', RESTRAINTS, 'test')
+  assert table.get_fragment_bundle(fragid).name == 'Propanol'
+  con = sqlite3.connect(userdb, isolation_level=None)
+  con.execute('UPDATE Fragment SET Name = ? WHERE Id = ?', ('Propan-1-ol', fragid - USER_ID_OFFSET))
+  con.close()
+  # the cache only looks at the database in refresh():
+  assert table.get_fragment_bundle(fragid).name == 'Propanol'
+  table.refresh()
+  assert table.get_fragment_bundle(fragid).name == 'Propan-1-ol'
+  assert fragment_cache.stats()['entries'] >= 1
+
+
+def test_cache_hits_do_not_query_the_database(table):
+  table.refresh()
+  fragid = table.get_all_rowids()[3]
+  table.get_fragment_bundle(fragid)
+  statements = []
+  table.database.con.set_trace_callback(statements.append)
+  try:
+    for _ in range(10):
+      table.get_fragment_bundle(fragid)
+      table.get_fragment_record(fragid)
+      table.get_restraints(fragid)
+      table.get_reference(fragid)
+  finally:
+    table.database.con.set_trace_callback(None)
+  assert statements == []
+
+
+def test_failed_store_is_rolled_back(table):
+  count = len(table)
+  before = table.revision()
+  # a write after the atoms fails:
+  table.database.con.execute('DROP TABLE userdb.Bonds')
+  with pytest.raises(sqlite3.OperationalError):
+    table.store_fragment('Propanol', ATOMS, 'PROP', RESTRAINTS, 'test')
+  assert len(table) == count
+  assert table.revision() == before
+  for name in ('Atoms', 'Restraints', 'Coordinates', 'Fingerprint'):
+    orphans = 'SELECT count(*) FROM userdb.{} WHERE FragmentId NOT IN (SELECT Id FROM userdb.Fragment)'
+    assert table.database.con.execute(orphans.format(name)).fetchone()[0] == 0
+
+
+def test_name_filter_ignores_user_suffix(table):
+  assert table.get_fragment_page(0, 1000, name_filter='user') == []
+  rows = table.get_fragment_page(0, 1000, name_filter='acetate')
+  assert any(row[0] > USER_ID_OFFSET and row[1].endswith('  *user*') for row in rows)
+  assert rows == list(table.iter_fragments(name_filter='ACETATE'))
+
+
+def test_store_fragments_all_or_nothing(table):
+  count = len(table)
+  good = dict(fragment_name='Propanol', atoms=ATOMS, resiclass='PROP', restraints=RESTRAINTS)
+  bad = dict(fragment_name='Broken', atoms=ATOMS, restraints=[5])
+  with pytest.raises(Exception):
+    table.store_fragments([good, bad])
+  assert len(table) == count
+  fragids = table.store_fragments([good, dict(good, fragment_name='Propanol 2')])
+  assert len(table) == count + 2
+  assert [table.get_fragment_name(fragid) for fragid in fragids] == ['Propanol', 'Propanol 2']
+  assert table.get_restraints(fragids[1]) == [('DFIX', '1.52 C1 C2 C2 C3'), ('DFIX', '1.43 C3 O1')]
+
+
+def test_nested_transactions_share_the_connection(table, maindb, userdb):
+  from FragmentDB.fragmentdb_handler import FragmentTable
+  other = FragmentTable(maindb, userdb)
+  assert other.database.con is table.database.con
+  count = len(table)
+  with table.database.transaction():
+    fragid = table.store_fragment('Propanol', ATOMS, 'PROP', RESTRAINTS, 'test')
+    # a failed block of another request on the same connection is a savepoint:
+    with pytest.raises(Exception):
+      with other.database.transaction():
+        other.store_fragment('Broken', ATOMS, restraints=[5])
+  assert len(table) == count + 1
+  assert table.get_fragment_name(fragid) == 'Propanol'
+  assert table.database.pool.depths[table.database.key] == 0
@@ -0,0 +1,57 @@
+import re
+
+import pytest
+
+from FragmentDB import graph
+from FragmentDB.schema import atom_element
+
+ATOMS = [['C1', '0.0', '0.0', '0.0'], ['C2', '1.52', '0.0', '0.0'], ['C3', '2.03', '1.43', '0.0'],
+         ['O1', '3.46', '1.43', '0.0']]
+
+
+def _fragment_with_restraints(table):
+  for fragid in table.get_all_rowids():
+    program = table.get_restraint_program(fragid)
+    if program and len(program.lines) > 1 and not program.unknown_line:
+      return fragid, program
+  raise AssertionError('no fragment with restraints')
+
+
+def test_restraint_program_with_all_atoms(table):
+  fragid, program = _fragment_with_restraints(table)
+  atomids = list(range(len(table[fragid])))
+  lines = program.apply(atomids)
+  assert len(lines) == len(program.lines)
+  assert program.unknown_line_for(len(atomids)) is None
+
+
+def test_restraint_program_with_missing_atoms(table):
+  fragid, program = _fragment_with_restraints(table)
+  lines = program.apply([0])
+  unknown_line = program.unknown_line_for(1)
+  assert unknown_line is not None
+  assert len(lines) == unknown_line - 1
+  # only the one fitted atom:
+  assert set(re.findall(r'#c\d+', ' '.join(line for _, line in lines))) <= set(['#c0'])
+
+
+def test_generated_restraints(table):
+  fragid = table.store_fragment('Propanol', ATOMS, 'PROP', reference='test')
+  restraints = table.get_restraints(fragid, generate=True)
+  assert restraints == [('DFIX', '1.520 C1 C2'), ('DFIX', '1.518 C2 C3'), ('DFIX', '1.430 C3 O1'),
+                        ('DANG', '2.483 C1 C3'), ('DANG', '2.410 C2 O1')]
+  # restraints in the database are not replaced:
+  assert table.get_restraints(fragid, generate=False) == []
+
+
+def test_bond_graph_with_and_without_numpy(table, monkeypatch):
+  if graph.np is None:
+    pytest.skip('numpy is not installed')
+  for fragid in table.get_all_rowids():
+    atoms = table[fragid]
+    numbers = [atom_element(atom[0], atom[1]) for atom in atoms]
+    coordinates = [atom[2:] for atom in atoms]
+    bonds = graph.bond_graph(numbers, coordinates)
+    with monkeypatch.context() as patch:
+      patch.setattr(graph, 'np', None)
+      assert graph.bond_graph(numbers, coordinates) == bonds
@@ -0,0 +1,48 @@
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+
+from conftest import MAIN_DB, PLUGIN_DIR, USER_DB
+
+from FragmentDB import schema
+from FragmentDB.fragmentdb_handler import USER_ID_OFFSET
+
+
+def test_shipped_database_is_current(table):
+  con = sqlite3.connect(MAIN_DB)
+  assert schema.schema_version(con) == schema.SCHEMA_VERSION
+  con.close()
+  # opened from the file and not from an upgraded copy in memory:
+  databases = dict((row[1], row[2]) for row in table.database.con.execute('PRAGMA database_list'))
+  assert os.path.samefile(databases['main'], MAIN_DB)
+
+
+def test_command_line_upgrade(tmp_path):
+  dbfile = str(tmp_path / 'user.sqlite')
+  shutil.copy(USER_DB, dbfile)
+  for message in ('upgraded to layout version', 'is up to date'):
+    output = subprocess.check_output([sys.executable, os.path.join(PLUGIN_DIR, 'schema.py'), dbfile],
+                                     cwd=str(tmp_path))
+    assert message in output.decode()
+
+
+def test_upgrade_deletes_orphans(userdb):
+  con = sqlite3.connect(userdb, isolation_level=None)
+  orphans = 'SELECT count(*) FROM {} WHERE FragmentId NOT IN (SELECT Id FROM Fragment)'
+  assert con.execute(orphans.format('Atoms')).fetchone()[0] > 0
+  assert schema.upgrade(con)
+  assert schema.schema_version(con) == schema.SCHEMA_VERSION
+  for table in ('Atoms', 'Restraints', 'Coordinates'):
+    assert con.execute(orphans.format(table)).fetchone()[0] == 0
+
+
+def test_atoms_agree_with_coordinates(table):
+  userids = [fragid for fragid in table.get_all_rowids() if fragid > USER_ID_OFFSET]
+  assert userids
+  for fragid in userids:
+    labels, xyz = table.get_coordinates(fragid, with_labels=True)
+    atoms = table[fragid]
+    assert labels == [atom[0] for atom in atoms]
+    assert [tuple(row) for row in xyz] == [tuple(atom[2:]) for atom in atoms]
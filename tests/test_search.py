@@ -0,0 +1,52 @@
+def _names(rows):
+  return [row[1] for row in rows]
+
+
+def test_aryl_is_a_single_ring(table):
+  names = _names(table.find_substructure('aryl'))
+  assert names
+  assert not [name for name in names if 'Fullerene' in name or name.startswith('Naphthalene')]
+  # every phenyl group is a benzene ring with substituent:
+  phenyl = _names(table.find_substructure('c1ccccc1*'))
+  assert set(phenyl) <= set(names)
+
+
+def test_bigram_search_ranks_like_a_full_scan(table):
+  for search in ('nona', 'benzene', 'tert-butyl', 'pf6', 'Acetate'):
+    hits = table.find_fragment_by_name(search, selection=5)
+    scanned = table._scan_names(search, selection=len(table))
+    assert len(hits) == 5
+    # the best coefficients are the same, ties may be in another order:
+    assert [hit[2][0] for hit in hits] == [round(hit[2][0], 6) for hit in scanned[:5]]
+  assert table.find_fragment_by_name('pf6', selection=1)[0][1] == 'Hexafluorophosphate, PF6'
+
+
+def test_text_search(table):
+  assert _names(table.search_text('LIBXUR', fields=['reference'])) == ['Acetate anion, C2H3O2-',
+                                                                        'Acetate anion, C2H3O2-  *user*']
+  assert 'Benzene, Benzol, Phenyl, C6H6' in _names(table.search_text('benz*', fields=['name']))
+  assert table.search_text('LIBXUR', fields=['name']) == []
+  # the index follows stored and deleted fragments:
+  fragid = table.store_fragment('Zyxwane', [['C1', 0, 0, 0]], reference='test', comment='quux')
+  assert table.search_text('quux', fields=['comment']) == [[fragid, 'Zyxwane  *user*']]
+  del table[fragid]
+  assert table.search_text('quux', fields=['comment']) == []
+
+
+def test_invalid_text_query_searches_quietly_for_the_text(table, capsys):
+  # the dash is no valid FTS5 syntax:
+  assert _names(table.search_text('C2H3O2-', fields=['name'])) == ['Acetate anion, C2H3O2-',
+                                                                   'Acetate anion, C2H3O2-  *user*']
+  assert capsys.readouterr().out == ''
+
+
+def test_shape_search_finds_moved_fragment(table):
+  fragid = 61
+  atoms = table[fragid]
+  # turned by 90 degrees around z and moved:
+  coords = [(-atom[3] + 5.0, atom[2] - 2.0, atom[4] + 1.0) for atom in atoms]
+  best = table.find_fragment_by_shape(coords, k=3)
+  assert best[0][:2] == [fragid, 'Hexafluorophosphate, PF6']
+  assert best[0][2] < 0.01
+  names = [atom[0] for atom in atoms]
+  assert table.find_fragment_by_shape(coords, k=1, names=names)[0][0] == fragid
@@ -0,0 +1,74 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+from conftest import PLUGIN_DIR
+
+from FragmentDB.validate import validate_fragment, read_fragments, main
+
+
+def test_validate_fragment_finds_problems():
+  atoms = [('C1', 0.0, 0.0, 0.0), ('F1', 1.3, 0.0, 0.0), ('F2', 0.0, 1.3, 0.0), ('F3', 0.0, 0.0, 1.3),
+           ('F4', 0.0, 0.0, -2.0)]
+  restraints = [('SADI', 'C1 F1 C1 F2 C1 F3 C1 F4'), ('DFIX', '1.3 C1 F9')]
+  result = validate_fragment([7, 'CF4', atoms, restraints])
+  kinds = [problem['kind'] for problem in result['problems']]
+  assert result['id'] == 7
+  assert kinds == ['unknown_atom', 'outlier']
+  assert result['problems'][1]['pairs'] == [['C1', 'F4']]
+
+
+def test_main_reports_json(maindb, userdb, capsys):
+  status = main([maindb, userdb, '--jobs', '1'])
+  report = json.loads(capsys.readouterr().out)
+  assert report['fragments'] > 100
+  assert status == (1 if report['invalid'] or report['databases'] else 0)
+  assert all(result['problems'] for result in report['results'])
+
+
+def test_command_line_with_workers(maindb, userdb, tmp_path):
+  # runs the script like a user outside of Olex2 does:
+  command = [sys.executable, os.path.join(PLUGIN_DIR, 'validate.py'), maindb, userdb, '--jobs', '2', '--all']
+  process = subprocess.Popen(command, cwd=str(tmp_path), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+  out, err = process.communicate()
+  assert not err.strip(), err
+  report = json.loads(out.decode('utf-8'))
+  assert len(report['results']) == report['fragments']
+  ids = [result['id'] for result in report['results']]
+  assert ids == sorted(ids)
+  assert any(fragid > 1000000 for fragid in ids)
+
+
+def test_module_outside_of_olex(maindb, tmp_path):
+  # "python -m FragmentDB.validate" runs the __init__.py of the package:
+  try:
+    os.symlink(PLUGIN_DIR, str(tmp_path / 'FragmentDB'))
+  except (OSError, NotImplementedError, AttributeError):
+    pytest.skip('no symbolic links')
+  command = [sys.executable, '-m', 'FragmentDB.validate', maindb, '--jobs', '1']
+  process = subprocess.Popen(command, cwd=str(tmp_path), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+  out, err = process.communicate()
+  assert not err.strip(), err
+  assert json.loads(out.decode('utf-8'))['fragments'] > 100
+
+
+def test_validation_does_not_change_the_databases(maindb, userdb, capsys):
+  with open(userdb, 'rb') as dbfile:
+    before = dbfile.read()
+  assert main([maindb, userdb, '--jobs', '1']) == 1
+  report = json.loads(capsys.readouterr().out)
+  kinds = sorted(finding['kind'] for finding in report['databases'])
+  # the test user database has the original layout and atoms of deleted fragments:
+  assert kinds == ['orphan_rows', 'orphan_rows', 'outdated_layout']
+  with open(userdb, 'rb') as dbfile:
+    assert dbfile.read() == before
+
+
+def test_read_fragments_like_the_handler(maindb, userdb):
+  records = list(read_fragments(maindb, userdb))
+  from FragmentDB.fragmentdb_handler import FragmentTable
+  # FragmentTable upgrades the user database and deletes the orphan rows:
+  assert records == list(FragmentTable(maindb, userdb).iter_fragment_contents())
@@ -16,6 +16,9 @@ xcopy /Y %GIT%\fragment-database.sqlite %FDBDIR2%
 xcopy /Y %GIT%\drawstyle.cds %FDBDIR2%
 xcopy /Y %GIT%\fragmentdb.phil %FDBDIR2%
 
+rem brings the database to the layout of schema.py:
+python %FDBDIR2%\schema.py %FDBDIR2%\fragment-database.sqlite
+
 
 
 pause
\ No newline at end of file
@@ -10,8 +10,16 @@ cp -v $GIT/FragmentDB_handler.py $FDBDIR
 cp -v $GIT/inputfrag.htm $FDBDIR
 cp -v $GIT/helper_functions.py $FDBDIR
 cp -v $GIT/refine_model_tasks.py $FDBDIR
+cp -v $GIT/schema.py $FDBDIR
+cp -v $GIT/shape.py $FDBDIR
+cp -v $GIT/graph.py $FDBDIR
+cp -v $GIT/stats.py $FDBDIR
+cp -v $GIT/validate.py $FDBDIR
+cp -v $GIT/dfix.py $FDBDIR
 
 cp -v $GIT/fragment-database.sqlite $FDBDIR
+# brings the database to the layout of schema.py:
+python $FDBDIR/schema.py $FDBDIR/fragment-database.sqlite
 
 
 #rm $FDBDIR/*.pyc
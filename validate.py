@@ -0,0 +1,213 @@
+'''
+Created on 18.10.2026
+
+Checks all fragments of the main and the user database in one run, like
+the checks of a single fragment before it is stored. The fragments are
+streamed from the databases to a pool of worker processes and the results
+are written as JSON. The databases are opened read-only and are not
+upgraded, an outdated layout is reported instead:
+
+python validate.py fragment-database.sqlite [user-database.sqlite] --jobs 4
+
+or as "python -m FragmentDB.validate ..." from the directory above.
+
+here are only functions that are completely independent of olex
+'''
+from __future__ import print_function
+
+import argparse
+import json
+import multiprocessing
+import os
+import sqlite3
+import sys
+from itertools import groupby
+from operator import itemgetter
+
+try:
+  from urllib.request import pathname2url
+except ImportError:
+  from urllib import pathname2url
+
+if not __package__:
+  # started as script, also in the worker processes: this directory is the
+  # FragmentDB package, its __init__.py is not needed outside of Olex2.
+  import types
+  _package = types.ModuleType('FragmentDB')
+  _package.__path__ = [os.path.dirname(os.path.abspath(__file__))]
+  sys.modules.setdefault('FragmentDB', _package)
+
+from FragmentDB.helper_functions import restraint_findings, sadi_findings
+from FragmentDB.schema import USER_NAME_SUFFIX, SCHEMA_VERSION, schema_version
+from FragmentDB.fragmentdb_handler import USER_ID_OFFSET
+
+__metaclass__ = type  # use new-style classes
+
+# the coordinates in the database are cartesian:
+CARTESIAN_CELL = (1, 1, 1, 90, 90, 90)
+# number of fragments that are sent to a worker process at once:
+VALIDATION_CHUNK = 64
+
+
+def validate_fragment(record):
+  """
+  checks the atoms and restraints of a fragment for duplicate atoms,
+  invalid restraint cards, unknown atoms in restraints and suspicious SADI
+  pairs.
+
+  >>> atoms = [('C1', 0.0, 0.0, 0.0), ('F1', 1.3, 0.0, 0.0), ('F1', 0.0, 1.3, 0.0)]
+  >>> result = validate_fragment([5, 'CF2', atoms, [('DFIX', '1.3 C1 F1 C1 F2'), ('FOO', 'C1')]])
+  >>> result['id'], [problem['kind'] for problem in result['problems']]
+  (5, ['duplicate_atom', 'invalid_card', 'unknown_atom'])
+
+  :param record: [Id, Name, atoms, restraints] of the fragment as from
+                 read_fragments()
+  :type record: list
+  :rtype: dict
+  """
+  fragid, name, atoms, restraints = record
+  atoms = [list(atom) for atom in atoms]
+  restraints = [[card] + (text or '').split() for card, text in restraints]
+  findings = restraint_findings(restraints, atoms, name)
+  findings.extend(sadi_findings(atoms, restraints, CARTESIAN_CELL, name))
+  return {'id': fragid, 'name': name, 'problems': [finding.as_dict() for finding in findings]}
+
+
+def open_read_only(dbfile):
+  """
+  returns a connection to dbfile that can not change the database. Python
+  versions without URI filenames read through a normal connection.
+  """
+  if not os.path.isfile(dbfile):
+    raise IOError('Database {} not found.'.format(dbfile))
+  try:
+    return sqlite3.connect('file:{}?mode=ro'.format(pathname2url(os.path.abspath(dbfile))), uri=True)
+  except TypeError:
+    return sqlite3.connect(dbfile)
+
+
+def _read_database(con, offset=0, suffix=''):
+  fragments = con.execute('SELECT Id, Name FROM Fragment ORDER BY Id')
+  atoms = groupby(con.execute('SELECT FragmentId, Name, x, y, z FROM Atoms ORDER BY FragmentId, Id'),
+                  itemgetter(0))
+  restraints = groupby(con.execute('SELECT FragmentId, ShelxName, Atoms FROM Restraints '
+                                   'ORDER BY FragmentId, Id'), itemgetter(0))
+  next_atoms = next(atoms, None)
+  next_restraints = next(restraints, None)
+  for fragid, name in fragments:
+    # rows of fragments that do not exist any more are skipped:
+    while next_atoms is not None and next_atoms[0] < fragid:
+      next_atoms = next(atoms, None)
+    while next_restraints is not None and next_restraints[0] < fragid:
+      next_restraints = next(restraints, None)
+    frag_atoms, frag_restraints = [], []
+    if next_atoms is not None and next_atoms[0] == fragid:
+      frag_atoms = [tuple(row[1:]) for row in next_atoms[1]]
+      next_atoms = next(atoms, None)
+    if next_restraints is not None and next_restraints[0] == fragid:
+      frag_restraints = [tuple(row[1:]) for row in next_restraints[1]]
+      next_restraints = next(restraints, None)
+    yield [fragid + offset, name + suffix, frag_atoms, frag_restraints]
+
+
+def read_fragments(dbfile, userdb=''):
+  """
+  yields [Id, Name, atoms, restraints] of all fragments of both databases in
+  the order of their ids like FragmentTable.iter_fragment_contents(), but
+  from read-only connections and only from the tables that every layout of
+  the databases has.
+
+  :param dbfile: path of the main database
+  :type dbfile: str
+  :param userdb: path of the user database
+  :type userdb: str
+  """
+  for path, offset, suffix in ((dbfile, 0, ''), (userdb, USER_ID_OFFSET, USER_NAME_SUFFIX)):
+    if not path:
+      continue
+    con = open_read_only(path)
+    try:
+      for record in _read_database(con, offset, suffix):
+        yield record
+    finally:
+      con.close()
+
+
+def check_databases(dbfile, userdb=''):
+  """
+  returns the findings about the databases themselves: an outdated layout
+  and atoms or restraints of fragments that do not exist. FragmentDB fixes
+  both when it opens a database, the validator only reports them.
+
+  :rtype: list of dict
+  """
+  findings = []
+  for path in (dbfile, userdb):
+    if not path:
+      continue
+    con = open_read_only(path)
+    try:
+      version = schema_version(con)
+      if version < SCHEMA_VERSION:
+        findings.append({'kind': 'outdated_layout', 'database': path, 'version': version,
+                         'current': SCHEMA_VERSION})
+      for table in ('Atoms', 'Restraints'):
+        count = con.execute('SELECT COUNT(*) FROM {} WHERE FragmentId NOT IN '
+                            '(SELECT Id FROM Fragment)'.format(table)).fetchone()[0]
+        if count:
+          findings.append({'kind': 'orphan_rows', 'database': path, 'table': table, 'count': count})
+    finally:
+      con.close()
+  return findings
+
+
+def validate_database(dbfile, userdb='', jobs=1):
+  """
+  yields the results of validate_fragment() for all fragments in the order
+  of their ids. With more than one job, the fragments are checked in a pool
+  of worker processes while they are read from the database.
+
+  :param dbfile: path of the main database
+  :type dbfile: str
+  :param userdb: path of the user database
+  :type userdb: str
+  :param jobs: number of worker processes
+  :type jobs: int
+  """
+  records = read_fragments(dbfile, userdb)
+  if jobs <= 1:
+    for record in records:
+      yield validate_fragment(record)
+    return
+  pool = multiprocessing.Pool(jobs)
+  try:
+    for result in pool.imap(validate_fragment, records, VALIDATION_CHUNK):
+      yield result
+  finally:
+    pool.terminate()
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Checks all fragments of the fragment databases.')
+  parser.add_argument('dbfile', help='main database')
+  parser.add_argument('userdb', nargs='?', default='', help='user database')
+  parser.add_argument('-j', '--jobs', type=int, default=multiprocessing.cpu_count(),
+                      help='number of worker processes (default: all processors)')
+  parser.add_argument('-a', '--all', action='store_true', help='also list the fragments without problems')
+  args = parser.parse_args(argv)
+  findings = check_databases(args.dbfile, args.userdb)
+  results = []
+  count = 0
+  for result in validate_database(args.dbfile, args.userdb, args.jobs):
+    count += 1
+    if result['problems'] or args.all:
+      results.append(result)
+  invalid = sum(1 for result in results if result['problems'])
+  report = {'fragments': count, 'invalid': invalid, 'results': results, 'databases': findings}
+  json.dump(report, sys.stdout, indent=1, sort_keys=True)
+  print()
+  return 1 if invalid or findings else 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())